@@ -1,20 +1,26 @@
 import requests
-from requests import Session
 import json
 import pandas as pd
-from bs4 import BeautifulSoup
 from datetime import datetime, timedelta, timezone
 import os
-from concurrent.futures import as_completed, ProcessPoolExecutor
-from requests_futures.sessions import FuturesSession
 import calendar
+from collections import Counter
 import logging
 from logging.handlers import RotatingFileHandler
 from dotenv import load_dotenv
+from transcript_fetcher import fetch_transcripts
+from transcript_extractor import extract_messages
+from message_buffer import (TranscriptMessageBuffer, attach_prospect_columns, compact_frame, concat_compact_frames,
+                            MESSAGE_CATEGORY_COLUMNS, MESSAGE_DATETIME_COLUMNS, PROSPECT_CATEGORY_COLUMNS, PROSPECT_DATETIME_COLUMNS)
+from transcript_state import TranscriptStateStore, hash_transcript_content, record_transcript_states
+from csv_ingest import stream_prospect_batches
+from transcript_storage import append_transcripts
+from metrics import timed, counter
 
 
 load_dotenv('.env')
 pd.options.mode.chained_assignment = None # default='warn'
+TRANSCRIPT_CHANGE_RESULTS = counter('transcript_change_detection_total', 'Fetched transcripts by change detection result.')
 
 def setup_logging(save_dir, logger_name, verbosity=10):
     """
@@ -49,17 +55,23 @@ def setup_logging(save_dir, logger_name, verbosity=10):
     logger.addHandler(handler)
     logger.info('-----------------------------')
     logger.info('--BEGINNING NEW PROGRAM RUN--')
-    logger.info('Start Time: %s' % datetime.datetime.now())
+    logger.info('Start Time: %s' % datetime.now())
     logger.info('-----------------------------')
     logger.info(f'Logging Level set to: {logger.getEffectiveLevel()}')
     return
 
 
-def build_url(logger_name, today=True, year=None, month=None):
+def build_url(logger_name, today=True, year=None, month=None, start_date=None, end_date=None):
     logger = logging.getLogger(f'{logger_name}.build_url')
     full_api_url = ''
     api_url_base = os.getenv('TRANSCRIPT_API_URL_BASE')
-    if today:
+    if start_date != None:
+        # An explicit date range (dates or 'YYYY-MM-DD' strings) takes precedence.
+        if end_date == None:
+            end_date = start_date
+        date_spec = f'&startDate={start_date}&endDate={end_date}'
+        full_api_url = api_url_base + date_spec
+    elif today:
         bothDates_val = datetime.today().strftime('%Y-%m-%d')
         date_spec = f'&startDate={bothDates_val}&endDate={bothDates_val}'
         full_api_url = api_url_base + date_spec
@@ -76,124 +88,216 @@ def build_url(logger_name, today=True, year=None, month=None):
     return full_api_url
 
 
-def call_api_for_daily_csv(full_api_url, logger_name):
-    logger = logging.getLogger(f'{logger_name}.call_api_for_daily_csv')
+def _daily_csv_file_path(full_api_url, logger_name):
+    logger = logging.getLogger(f'{logger_name}._daily_csv_file_path')
+    csv_temp_dir = os.path.join(os.getcwd(), 'csv_temp')
+    if not os.path.exists(csv_temp_dir):
+        os.makedirs(csv_temp_dir, exist_ok=True)
+        logger.info(f'{csv_temp_dir} subdirectory created.')
+    return os.path.join(csv_temp_dir, f'{full_api_url[-39:]}.csv')
+
+
+def stream_daily_csv_batches(full_api_url, logger_name, chunksize=None, use_cache=False):
+    """
+    Yield the daily prospect csv in batches while it downloads into csv_temp under the
+    working directory. See csv_ingest.stream_prospect_batches.
+    """
+    logger = logging.getLogger(f'{logger_name}.stream_daily_csv_batches')
     logger.info(f'Calling daily prospect csv file via url: {full_api_url}')
-    response = requests.get(full_api_url, allow_redirects=True)
-    if not os.path.exists(os.path.join(os.getcwd(), '/csv_temp/')):
-        os.mkdir(os.path.join(os.getcwd(), '/csv_temp/'))
-        logger.info('./csv_temp subdirectory created.')
-    csv_file_path = os.path.join(os.getcwd(), f'/csv_temp/{full_api_url[-39:]}.csv')
-    with open(csv_file_path, 'wb+') as f:
-        f.write(response.content)
-    logger.info('Daily prospect response from chatbot saved in ./csv_temp subdirectory.')
-    df = pd.read_csv(csv_file_path)
+    csv_file_path = _daily_csv_file_path(full_api_url, logger_name)
+    yield from stream_prospect_batches(full_api_url,
+                                       csv_file_path,
+                                       logger_name,
+                                       chunksize=chunksize,
+                                       use_cache=use_cache)
+    logger.info(f'Daily prospect response from chatbot saved to {csv_file_path}.')
+    return
+
+
+def call_api_for_daily_csv(full_api_url, logger_name, use_cache=False):
+    prospect_batches = list(stream_daily_csv_batches(full_api_url, logger_name, use_cache=use_cache))
+    if not prospect_batches:
+        return pd.DataFrame()
+    df = pd.concat(prospect_batches, axis=0, ignore_index=True)
     return df
 
 
-def cross_reference_past_transcript_copies_for_no_change(transcript_source_length_lookup_dict, transcript_response_text, transcript_url, logger_name):
-    """_summary_
+def cross_reference_past_transcript_copies_for_no_change(transcript_state_store, transcript_response, logger_name):
+    """
+    Decide whether a transcript has changed since it was last parsed.
 
     Args:
-        transcript_source_length_lookup_dict (dict): 
-        transcript_response_text (str): _description_
-        transcript_url (str): _description_
+        transcript_state_store (TranscriptStateStore): Store holding the last seen version of every transcript url.
+        transcript_response (TranscriptResponse): The fetched transcript. A 304 response carries no text.
 
     Returns:
-        no_change_val (str): _description_
-        transcript_source_length_lookup_dict (dict): 
-    """    
+        no_change_val (bool): True if the transcript is unchanged and need not be parsed.
+        content_hash (str): sha256 of the response body, or None for a 304 response.
+    """
     logger = logging.getLogger(f'{logger_name}.cross_reference_past_transcript_copies_for_no_change')
-    prior_response_length = transcript_source_length_lookup_dict.get(transcript_url)
-    if prior_response_length == len(transcript_response_text):
+    transcript_url = transcript_response.url
+    if transcript_response.status == 304:
+        logger.debug('Server reported no change (304) for %s.', transcript_url)
+        return True, None
+    content_hash = hash_transcript_content(transcript_response.text)
+    prior_state = transcript_state_store.get(transcript_url)
+    if prior_state is not None and prior_state['content_hash'] == content_hash:
         no_change_val = True
-        logger.info(f'No change in transcript response length for {transcript_url}.')
+        logger.debug('No change in transcript content hash for %s.', transcript_url)
     else:
         no_change_val = False
-        logger.info(f'A change to the transcript response length for {transcript_url} was detected.')
-        transcript_source_length_lookup_dict.update({transcript_url: len(transcript_response_text)})
-        logger.info('Updated transcript_source_length_lookup_dict with new transcript response length.')
-    return no_change_val, transcript_source_length_lookup_dict
+        logger.debug('A change to the transcript content for %s was detected.', transcript_url)
+    return no_change_val, content_hash
 
 
-def read_transcripts(df, logger_name):
+def read_transcripts(df, logger_name, max_in_flight=None, save=True, skip_unchanged=True, normalized=False, pending_state=None):
     """
-    
+    Fetch and parse the transcript of every prospect in df.
+
+    Parameters
+    ----------
+    df : Pandas DataFrame
+        Prospect rows from the chatbot export, each with a 'transcript' url.
+    logger_name : str
+        Name of the parent logger.
+    max_in_flight : int, optional
+        Maximum number of transcript requests in flight at once. The default is None,
+        which defers to transcript_fetcher.TRANSCRIPT_FETCH_MAX_IN_FLIGHT.
+    save : bool, optional
+        Append the parsed messages and prospects to the transcript storage datasets. Pass
+        False when calling per batch and saving the combined result instead. The default
+        is True.
+    skip_unchanged : bool, optional
+        Skip transcripts whose content matches the last recorded version. Pass False to
+        re-parse everything, e.g. when rebuilding history. The default is True.
+    normalized : bool, optional
+        Return the messages and their prospects as two compact frames joined on
+        'transcript' instead of one wide frame with every prospect column repeated on
+        every message. save is ignored. The default is False.
+    pending_state : list, optional
+        Receives the change-detection state (content hash, ETag, Last-Modified) of every
+        parsed transcript instead of it being recorded here. Pass it to
+        transcript_state.record_transcript_states once the messages are stored, so a
+        failure in between doesn't leave them marked as seen. The default is None, which
+        records the state after save has stored the messages; when nothing is saved here
+        the state is then not recorded at all.
+
+    Returns
+    -------
+    day_transcripts_df : Pandas DataFrame
+        One row per message of every new or changed transcript. When normalized is True,
+        a (messages_df, prospects_df) pair instead, with one row per message and one row
+        per transcript respectively.
+
     """
     logger = logging.getLogger(f'{logger_name}.read_transcripts')
-    day_transcripts_df = pd.DataFrame()
-    try:
-        with open(os.path.join(os.getcwd(), '/csv_temp/transcript_source_lookup_length_dict.json'), 'r+') as json_file:
-            transcript_source_length_lookup_dict = json.load(json_file)
-        logger.info('Transcript_source_length_lookup_dict dictionary loaded from memory.')
-    except FileNotFoundError:
-        transcript_source_length_lookup_dict = dict()
-        logger.info('FileNotFoundError occurred. No existing transcript_source_length_lookup_dict found. An empty dict has been created.')
-    s = FuturesSession(executor=ProcessPoolExecutor(max_workers=16), session=Session())
-    futures = []
-    for index, transcript_row in df.iterrows():
-        transcript_url = transcript_row['transcript']
-        future = s.get(transcript_url)
-        futures.append(future)
-        for future in as_completed(futures):
-            response2 = future.result()
-            no_change_flag, transcript_source_length_lookup_dict = cross_reference_past_transcript_copies_for_no_change(transcript_source_length_lookup_dict, response2.text, transcript_url)
-            if no_change_flag:
-                continue
-            transcript_soup = BeautifulSoup(response2.text, features='html.parser')
-            soup_script_string = transcript_soup.find('script').text
-            messages_list = json.loads(soup_script_string[soup_script_string.index('"messages"')+11:-len('},"messageId":null} })')+1])
-            transcript_df = pd.DataFrame()
-            for message in messages_list:
-                temp_df = pd.DataFrame(message, index=[0])
-                transcript_df = pd.concat([transcript_df, temp_df],
-                                          axis=0,
-                                          ignore_index=True)
-            transcript_row_dict = transcript_row.to_dict()
-            for key, value in transcript_row_dict.items():
-                transcript_df[key] = value
-            day_transcripts_df = pd.concat([day_transcripts_df, transcript_df],
-                                            axis=0,
-                                            ignore_index=True)
+    transcript_state_store = TranscriptStateStore()
+    message_buffer = TranscriptMessageBuffer(df)
+    extraction_path_counts = Counter()
+    transcript_states = []
+
+    def parse_transcript_response(transcript_response):
+        with timed('change_detection', items=1):
+            no_change_flag, content_hash = cross_reference_past_transcript_copies_for_no_change(transcript_state_store, transcript_response, logger_name)
+        TRANSCRIPT_CHANGE_RESULTS.inc(result='unchanged' if no_change_flag else 'changed')
+        if no_change_flag and skip_unchanged:
+            return
+        messages_list, extraction_path = extract_messages(transcript_response.text, logger_name)
+        extraction_path_counts[extraction_path] += 1
+        message_buffer.append(transcript_response.key, messages_list)
+        transcript_states.append({'url': transcript_response.url,
+                                  'content_hash': content_hash,
+                                  'etag': transcript_response.headers.get('ETag'),
+                                  'last_modified': transcript_response.headers.get('Last-Modified'),
+                                  'last_message_id': messages_list[-1].get('id') if messages_list else None})
+
+    with transcript_state_store:
+        fetch_transcripts(enumerate(df['transcript']),
+                          parse_transcript_response,
+                          logger_name,
+                          max_in_flight=max_in_flight,
+                          headers_for=transcript_state_store.conditional_headers if skip_unchanged else None)
+    logger.info(f'Transcript extraction paths used: {dict(extraction_path_counts)}')
+    if pending_state is not None:
+        pending_state.extend(transcript_states)
+    if len(message_buffer) == 0:
+        logger.info('No new or changed transcripts were found.')
+        return (pd.DataFrame(), pd.DataFrame()) if normalized else pd.DataFrame()
+    if normalized:
+        messages_df, prospects_df = message_buffer.flush(normalized=True)
+        return (compact_frame(messages_df, MESSAGE_CATEGORY_COLUMNS, MESSAGE_DATETIME_COLUMNS),
+                compact_frame(prospects_df, PROSPECT_CATEGORY_COLUMNS, PROSPECT_DATETIME_COLUMNS))
+    day_transcripts_df = message_buffer.flush()
     day_transcripts_df['timeCreated'] = pd.to_datetime(day_transcripts_df['timeCreated'])
     day_transcripts_df['timeCreated'] = [timestamp.to_pydatetime() for timestamp in day_transcripts_df['timeCreated']]
-    # os.chdir('/csv_temp/')
-    day_transcripts_df.to_csv(os.path.abspath('all_transcripts_df.csv'), index=False)
+    if save:
+        prospect_columns = [column for column in df.columns if column in day_transcripts_df.columns]
+        append_transcripts(day_transcripts_df.drop(columns=[column for column in prospect_columns if column != 'transcript']),
+                           day_transcripts_df[prospect_columns].drop_duplicates('transcript'),
+                           logger_name)
+        if pending_state is None:
+            record_transcript_states(transcript_states)
     return day_transcripts_df
 
 
-def is_target_prospect(single_transcript_df, logger_name):
-    logger = logging.getLogger(f'{logger_name}.is_target_prospect')
-    target_prospect = False
-    last_interaction = single_transcript_df.iloc[-1]
-    prior_interaction = single_transcript_df.iloc[-2]
-    if last_interaction['isInbound']==False and prior_interaction['isInbound']==True:
-        # if last_interaction['messageType']=='VOICE':
-        target_prospect = True
-        logger.info('Prospect is a target. Last interaction was not "isInbound" to chatbot and prior interaction was "isInbound" to chatbot.')
-    else:
-        logger.info('Prospect is not a target. Last interaction was "isInbound" to chatbot or prior interaction was not "isInbound" to chatbot.')
-    return target_prospect
+def _classify_transcripts(day_transcripts_df, now):
+    # Pages fetched concurrently and rows read back from SQL are not guaranteed to be in
+    # message order, and the shift below needs each transcript's messages in time order.
+    message_time = pd.to_datetime(day_transcripts_df['timeCreated'], utc=True)
+    sort_order = (pd.DataFrame({'transcript': day_transcripts_df['transcript'].to_numpy(), 'message_time': message_time.to_numpy()}).
+                  sort_values(['transcript', 'message_time'], kind='stable').index)
+    day_transcripts_df = day_transcripts_df.iloc[sort_order]
+    message_time = message_time.iloc[sort_order]
+    transcript_key = day_transcripts_df['transcript']
+    is_inbound = day_transcripts_df['isInbound']
+    prior_is_inbound = is_inbound.groupby(transcript_key, sort=False, observed=True).shift(1)
+    is_last_message = ~transcript_key.duplicated(keep='last')
+    is_target_last_message = is_last_message & is_inbound.eq(False) & prior_is_inbound.eq(True)
+    seconds_elapsed_by_transcript = pd.Series(
+        (now - message_time[is_target_last_message.to_numpy()]).dt.total_seconds().to_numpy(),
+        index=transcript_key[is_target_last_message.to_numpy()].to_numpy())
+    seconds_elapsed = transcript_key.map(seconds_elapsed_by_transcript)
+    is_target_row = seconds_elapsed.notna()
+    target_transcripts_df = day_transcripts_df[is_target_row].assign(seconds_elapsed=seconds_elapsed[is_target_row])
+    past_hour_mask = target_transcripts_df['seconds_elapsed'] > 3600
+    outreach_flag_df = target_transcripts_df[past_hour_mask].reset_index(drop=True)
+    hour_waitlist_df = target_transcripts_df[~past_hour_mask].reset_index(drop=True)
+    return outreach_flag_df, hour_waitlist_df, len(seconds_elapsed_by_transcript), int(is_last_message.sum())
+
+
+def check_for_targets_and_time_elapsed(day_transcripts_df, logger_name, now=None):
+    """
+    Classify every transcript in one vectorized pass. A transcript is a target when its
+    last message is outbound and the message before it is inbound, i.e. the prospect
+    has not answered the chatbot's latest outreach.
+
+    Parameters
+    ----------
+    day_transcripts_df : Pandas DataFrame
+        One row per message, in any order. Messages are ordered by timeCreated within
+        each transcript before classifying.
+    logger_name : str
+        Name of the parent logger.
+    now : datetime, optional
+        Timezone-aware reference time for seconds_elapsed. The default is the current UTC time.
 
+    Returns
+    -------
+    outreach_flag_df : Pandas DataFrame
+        All messages of target transcripts whose last message is more than an hour old.
+    hour_waitlist_df : Pandas DataFrame
+        All messages of target transcripts whose last message is an hour old or less.
 
-def check_for_targets_and_time_elapsed(day_transcripts_df, logger_name):
+    """
     logger = logging.getLogger(f'{logger_name}.check_for_targets_and_time_elapsed')
-    outreach_flag_df = pd.DataFrame()
-    hour_waitlist_df = pd.DataFrame()
-    for prospect_transcript in day_transcripts_df['transcript'].unique():
-        single_prospect_transcript_df = day_transcripts_df[day_transcripts_df['transcript']==prospect_transcript]
-        target_prospect_bool = is_target_prospect(single_prospect_transcript_df)
-        if target_prospect_bool:
-            seconds_elapsed = (single_prospect_transcript_df['timeCreated'][-1] - datetime.now(timezone.utc)).total_seconds()
-            single_prospect_transcript_df['seconds_elapsed'] = seconds_elapsed
-            if seconds_elapsed > 3600:
-                outreach_flag_df = pd.concat([outreach_flag_df, single_prospect_transcript_df],
-                                            axis=0,
-                                            ignore_index=True)
-            else:
-                hour_waitlist_df = pd.concat([hour_waitlist_df, single_prospect_transcript_df],
-                                            axis=0,
-                                            ignore_index=True)
+    if day_transcripts_df.empty:
+        return pd.DataFrame(), pd.DataFrame()
+    if now is None:
+        now = datetime.now(timezone.utc)
+    with timed('classification', items=len(day_transcripts_df)):
+        outreach_flag_df, hour_waitlist_df, target_count, transcript_count = _classify_transcripts(day_transcripts_df, now)
+    logger.info(f'{target_count} target prospects found among {transcript_count} transcripts: '
+                f'{outreach_flag_df["transcript"].nunique()} for outreach, {hour_waitlist_df["transcript"].nunique()} on the hour waitlist.')
     return outreach_flag_df, hour_waitlist_df
 
 
@@ -202,34 +306,37 @@ def update_outreach_dashboard(outreach_flag_df, logger_name):
     return
 
 
-def save_and_update_hour_waitlist_backups(hour_waitlist_df, logger_name):
-    logger = logging.getLogger(f'{logger_name}.save_and_update_hour_waitlist_backups')
-    if not os.path.exists(os.path.abspath('/hour_waitlist_data/')):
-        os.mkdir(os.path.abspath('/hour_waitlist_data/'))
-    os.chdir(os.path.abspath('/hour_waitlist_data/'))
-    old_hour_waitlist_file_path = os.path.abspath('/most_recent_hour_waitlist.csv')
-    if os.path.exists(old_hour_waitlist_file_path):
-        now_val = datetime.now()
-        os.rename(old_hour_waitlist_file_path, os.path.abspath(f'hour_waitlist_data/hour_waitlist_backup_{now_val.month}-{now_val.date}_{now_val.hour}-{now_val.min}.csv'))
-    hour_waitlist_df.to_csv(old_hour_waitlist_file_path, index=False)
-    list_of_files = os.listdir()
-    full_path = [os.path.abspath(file_name) for file_name in list_of_files]
-    if len(list_of_files) > 10:
-        oldest_file = min(full_path, key=os.path.getctime)
-        os.remove(oldest_file)
-    os.chdir(os.path.dirname(os.getcwd()))
-    return
-
-
 def api_calling_main(logger_name, save_dir, logger_verbosity):
     setup_logging(save_dir=save_dir,
                   logger_name=logger_name,
                   verbosity=logger_verbosity)
-    daily_prospects_df = call_api_for_daily_csv(build_url(logger_name, today=False, year='2022', month='05'), logger_name)
-    daily_transcripts_df = read_transcripts(daily_prospects_df, logger_name)
-    outreach_flag_df, hour_waitlist_df = check_for_targets_and_time_elapsed(daily_transcripts_df, logger_name)
-    update_outreach_dashboard(outreach_flag_df, logger_name)
-    save_and_update_hour_waitlist_backups(hour_waitlist_df, logger_name)
+    # Transcripts for each batch of prospects are fetched while the rest of the export
+    # is still downloading.
+    prospect_batches = []
+    message_batches = []
+    transcript_prospect_batches = []
+    transcript_states = []
+    for prospect_batch_df in stream_daily_csv_batches(build_url(logger_name, today=False, year='2022', month='05'), logger_name):
+        prospect_batches.append(prospect_batch_df)
+        messages_df, transcript_prospects_df = read_transcripts(prospect_batch_df, logger_name, normalized=True, pending_state=transcript_states)
+        message_batches.append(messages_df)
+        transcript_prospect_batches.append(transcript_prospects_df)
+    daily_prospects_df = pd.concat(prospect_batches, axis=0, ignore_index=True) if prospect_batches else pd.DataFrame()
+    daily_messages_df = concat_compact_frames(message_batches)
+    daily_transcript_prospects_df = concat_compact_frames(transcript_prospect_batches)
+    append_transcripts(daily_messages_df, daily_transcript_prospects_df, logger_name)
+    record_transcript_states(transcript_states)
+    outreach_flag_df, hour_waitlist_df = check_for_targets_and_time_elapsed(daily_messages_df, logger_name)
+    update_outreach_dashboard(attach_prospect_columns(outreach_flag_df, daily_transcript_prospects_df), logger_name)
+    # Imported here because waitlist_scheduler builds on this module.
+    from waitlist_scheduler import HourWaitlistScheduler
+    hour_waitlist_scheduler = HourWaitlistScheduler(logger_name,
+                                                    on_promote=lambda promoted_df: update_outreach_dashboard(promoted_df, logger_name))
+    hour_waitlist_scheduler.schedule(hour_waitlist_df, daily_prospects_df)
+    # Promote anything left on the waitlist by earlier runs whose hour has since passed;
+    # the long-running scheduler (python waitlist_scheduler.py, or the Flask app) handles
+    # the rest as their deadlines arrive.
+    hour_waitlist_scheduler.run_due()
     return
 
 
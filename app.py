@@ -1,26 +1,31 @@
 import os
-from flask import Flask, request, redirect, url_for, render_template, send_from_directory
+import threading
+from flask import Flask, request, redirect, url_for, render_template, send_from_directory, jsonify
 from werkzeug.utils import secure_filename
-from sentiment import *
-from api_calling import *
 from datetime import datetime, timedelta
 from dotenv import load_dotenv
-from sqlalchemy import create_engine, MetaData, update, select, func
-from sqlalchemy.types import BIGINT, INTEGER, VARCHAR, FLOAT, DATETIME, BOOLEAN, TINYTEXT
-import pyodbc  # Needs to be imported to support string connector of sql alchemy engine
-import urllib
-import os
-import pandas as pd
+from jobs import JobRunner, JOB_FINISHED, JOB_FAILED
+from followup_cache import FollowupListCache
+from metrics import render_prometheus
+
+# pandas, sqlalchemy, the sentiment libraries and the transcript pipeline are imported
+# inside the routes and jobs that use them, so a cold instance can serve the dashboard
+# without loading them.
 
 
 load_dotenv('.env')
 UPLOAD_FOLDER = os.getenv('UPLOAD_FOLDER')
 ALLOWED_EXTENSIONS = os.getenv('ALLOWED_EXTENSIONS')
+FOLLOWUP_PAGE_SIZE = int(os.getenv('FOLLOWUP_PAGE_SIZE', 50))
 
 tmpl_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'templates')
 static_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'static')
 
 app = Flask(__name__, template_folder=tmpl_dir, static_folder=static_dir, static_url_path='')
+job_runner = JobRunner(logger_name=app.logger.name)
+followup_cache = FollowupListCache()
+_hour_waitlist_scheduler = None
+_hour_waitlist_scheduler_lock = threading.Lock()
 
 # app.config['UPLOAD_FOLDER'] = UPLOAD_FOLDER
 if not os.path.exists(UPLOAD_FOLDER):
@@ -41,134 +46,262 @@ def allowed_file(filename):
         filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
 
 
-@app.route("/get_sentiment")
-def analyze_sentiment(messages_df):
-    data = json.loads(request.data.decode())
-    messages_df = data["messages_df"]
+def get_hour_waitlist_scheduler():
+    """
+    Return the app's HourWaitlistScheduler, creating it on first use.
+    """
+    global _hour_waitlist_scheduler
+    if _hour_waitlist_scheduler is None:
+        with _hour_waitlist_scheduler_lock:
+            if _hour_waitlist_scheduler is None:
+                from waitlist_scheduler import HourWaitlistScheduler
+                _hour_waitlist_scheduler = HourWaitlistScheduler(logger_name=app.logger.name,
+                                                                 on_promote=promote_waitlisted_prospects)
+    return _hour_waitlist_scheduler
+
+
+def run_refresh_pipeline(job, property_name, day):
+    """
+    Fetch the prospects and transcripts for day, score their sentiment, upsert them into
+    SQL and return the follow-up list for property_name. Runs on the job runner.
+    """
+    import pandas as pd
+    from api_calling import read_transcripts, check_for_targets_and_time_elapsed
+    from message_buffer import attach_prospect_columns, concat_compact_frames
+    from sentiment import sentiment_main
+    from feature_store import get_feature_store
+    from transcript_state import record_transcript_states
+    logger_name = app.logger.name
+    job.set_progress('Downloading prospect export.')
+    prospect_batches = []
+    message_batches = []
+    transcript_prospect_batches = []
+    transcript_states = []
+    prospect_count = 0
+    for prospects_df in call_transcript_api(day, logger_name):
+        if property_name is not None and 'property' in prospects_df.columns:
+            prospects_df = prospects_df[prospects_df['property'] == property_name]
+        prospect_batches.append(prospects_df)
+        prospect_count += len(prospects_df)
+        job.set_progress(f'Fetching transcripts for {prospect_count} prospects.')
+        messages_df, transcript_prospects_df = read_transcripts(prospects_df, logger_name, normalized=True, pending_state=transcript_states)
+        message_batches.append(messages_df)
+        transcript_prospect_batches.append(transcript_prospects_df)
+    messages_df = concat_compact_frames(message_batches)
+    if messages_df.empty:
+        record_transcript_states(transcript_states)
+        job.set_progress('No new or changed transcripts.')
+        return load_followup_list_from_db(job, property_name, day)
+    transcript_prospects_df = concat_compact_frames(transcript_prospect_batches)
+    job.set_progress(f'Scoring sentiment for {len(messages_df)} messages.')
     messages_df = sentiment_main(messages_df)
-    return redirect(url_for('post_transcripts_to_db'), file=messages_df)
+    job.set_progress('Writing messages to SQL.')
+    post_transcripts_to_db(messages_df, transcript_prospects_df)
+    get_feature_store().update(messages_df)
+    # Only now are the changed transcripts stored, so only now may later runs skip them.
+    record_transcript_states(transcript_states)
+    outreach_flag_df, hour_waitlist_df = check_for_targets_and_time_elapsed(messages_df, logger_name)
+    hour_waitlist_scheduler = get_hour_waitlist_scheduler()
+    hour_waitlist_scheduler.schedule(hour_waitlist_df, pd.concat(prospect_batches, axis=0, ignore_index=True))
+    hour_waitlist_scheduler.start()
+    if not followup_cache.has(property_name):
+        # This run only classified the changed transcripts. A cold cache holds none of
+        # the unchanged ones, so the whole list is rebuilt from SQL, which now has both.
+        return load_followup_list_from_db(job, property_name, day)
+    followup_cache.update(attach_prospect_columns(outreach_flag_df, transcript_prospects_df), messages_df['transcript'].unique())
+    return followup_cache.get(property_name)[1]
+
+
+def promote_waitlisted_prospects(outreach_flag_df):
+    """
+    Score and rank transcripts the hour waitlist scheduler promoted to outreach. Their
+    messages are not stored here: the scheduler leaves their change-detection state
+    alone, so the next refresh still sees them as changed and writes them to SQL.
+    """
+    from sentiment import sentiment_main
+    outreach_flag_df = sentiment_main(outreach_flag_df)
+    followup_cache.update(outreach_flag_df, outreach_flag_df['transcript'].unique())
+    return
+
+
+def load_followup_list_from_db(job, property_name, day):
+    """
+    Build the follow-up list for property_name from the messages already stored in SQL
+    for transcripts active on day. Runs on the job runner.
+    """
+    import pandas as pd
+    from sqlalchemy import select
+    from api_calling import check_for_targets_and_time_elapsed
+    from database import get_engine, get_table, has_table, SQL_MESSAGES_TABLE_NAME, SQL_PROSPECTS_TABLE_NAME
+    from message_buffer import attach_prospect_columns
+    job.set_progress('Loading stored transcripts.')
+    if not (has_table(SQL_PROSPECTS_TABLE_NAME) and has_table(SQL_MESSAGES_TABLE_NAME)):
+        # Nothing has been stored yet, e.g. a refresh that found no new transcripts on a
+        # fresh database.
+        followup_cache.mark_complete(property_name)
+        return followup_cache.get(property_name)[1]
+    prospects_table = get_table(SQL_PROSPECTS_TABLE_NAME)
+    messages_table = get_table(SQL_MESSAGES_TABLE_NAME)
+    day_start = datetime.strptime(day, '%Y-%m-%d')
+    prospects_statement = select(prospects_table).where(prospects_table.c.timeLastMessage >= day_start)
+    if property_name is not None:
+        prospects_statement = prospects_statement.where(prospects_table.c.property == property_name)
+    active_transcripts = prospects_statement.with_only_columns(prospects_table.c.transcript)
+    messages_statement = (select(messages_table).
+                          where(messages_table.c.transcript.in_(active_transcripts)).
+                          order_by(messages_table.c.transcript, messages_table.c.timeCreated))
+    with get_engine().connect() as connection:
+        prospects_df = pd.read_sql(prospects_statement, connection)
+        messages_df = pd.read_sql(messages_statement, connection)
+    outreach_flag_df, hour_waitlist_df = check_for_targets_and_time_elapsed(messages_df, app.logger.name)
+    followup_cache.update(attach_prospect_columns(outreach_flag_df, prospects_df), messages_df['transcript'].unique())
+    followup_cache.mark_complete(property_name)
+    return followup_cache.get(property_name)[1]
+
+
+def _requested_property():
+    request_data = request.get_json(silent=True) or {}
+    return request_data.get('property') or request.args.get('property')
+
+
+def _yesterday():
+    return (datetime.today()-timedelta(days=1)).strftime('%Y-%m-%d')
 
 
 @app.route("/refresh", methods=['POST'])
 def refresh():
     """
-    
+    Queue a full refresh of yesterday's prospects for the requested property and return
+    the job id to poll at /results/<job_id>.
     """
-    
-    return
+    property_name = _requested_property()
+    day = _yesterday()
+    job_id = job_runner.submit(run_refresh_pipeline, property_name, day, dedupe_key=('refresh', property_name, day))
+    return {'job_id': job_id}, 202
+
+
+@app.route("/health")
+def health():
+    from database import check_database_health
+    if check_database_health(app.logger.name):
+        return {'database': 'ok'}, 200
+    return {'database': 'unavailable'}, 503
+
 
+@app.route("/metrics")
+def metrics():
+    return render_prometheus(), 200, {'Content-Type': 'text/plain; version=0.0.4; charset=utf-8'}
 
-@app.route("/check_refresh_needed")
+
+@app.route("/check_refresh_needed", methods=['GET', 'POST'])
 def check_db_timeLastMessage():
-    sql_connection_string = os.getenv('SQL_CONNECTION_STRING')
-    sql_table_name = os.getenv('SQL_TABLE_NAME')
-    quoted = urllib.parse.quote_plus(sql_connection_string)
-    engine = create_engine('mssql+pyodbc:///?odbc_connect={}'.format(quoted))
-
-    md = MetaData(bind=engine, schema='dbo')
-    md.reflect(only=[sql_table_name])
-    transcript_table = md.tables['dbo.' + sql_table_name]
-    get_timeLastMessage_statement = (select(transcript_table.c.timeLastMessage).
-                                        where(transcript_table.c.timeLastMessage == (
-                                            select(func.max(transcript_table.c.timeLastMessage)))))
-    result = engine.execute(get_timeLastMessage_statement)
-    result_datetime_object = datetime.strptime(result, '%m/%d/%Y %H:%M')
-    if (datetime.today()-timedelta(days=1)).day == result_datetime_object.day:
-        return redirect(url_for('refresh'))
+    """
+    Queue a refresh if SQL does not yet hold yesterday's messages, otherwise queue a
+    job that builds the follow-up list from SQL. Either way the job id is returned.
+    """
+    from sqlalchemy import select, func
+    from database import get_engine, get_table, has_table, SQL_MESSAGES_TABLE_NAME, SQL_PROSPECTS_TABLE_NAME
+    # A fresh database, or one still on the legacy single table, has nothing stored
+    # yet, so the first refresh creates the tables.
+    result = None
+    if has_table(SQL_PROSPECTS_TABLE_NAME) and has_table(SQL_MESSAGES_TABLE_NAME):
+        prospects_table = get_table(SQL_PROSPECTS_TABLE_NAME)
+        get_timeLastMessage_statement = select(func.max(prospects_table.c.timeLastMessage))
+        with get_engine().connect() as connection:
+            result = connection.execute(get_timeLastMessage_statement).scalar()
+    if isinstance(result, str):
+        result = datetime.strptime(result, '%m/%d/%Y %H:%M')
+    property_name = _requested_property()
+    day = _yesterday()
+    if result is not None and (datetime.today()-timedelta(days=1)).day == result.day:
+        if followup_cache.has(property_name):
+            return {'job_id': job_runner.completed(followup_cache.get(property_name)[1])}, 202
+        job_id = job_runner.submit(load_followup_list_from_db, property_name, day, dedupe_key=('load', property_name, day))
     else:
-        return redirect(url_for('call_transcript_api'))
+        job_id = job_runner.submit(run_refresh_pipeline, property_name, day, dedupe_key=('refresh', property_name, day))
+    return {'job_id': job_id}, 202
 
-    
-@app.route('/call_api')
-def call_transcript_api():
+
+@app.route("/prospects/<property_name>")
+def get_prospects(property_name):
+    """
+    Serve a page of the ranked follow-up list for property_name straight from the
+    followup_cache. Answers 304 when If-None-Match matches the page's ETag.
+    """
+    page = request.args.get('page', default=1, type=int)
+    per_page = request.args.get('per_page', default=FOLLOWUP_PAGE_SIZE, type=int)
+    if not followup_cache.has(property_name):
+        return {'error': f'No follow-up list has been built for {property_name}.'}, 404
+    list_etag, rows, total = followup_cache.get(property_name, page=page, per_page=per_page)
+    page_etag = f'{list_etag}-{page}-{per_page}'
+    if request.if_none_match.contains(page_etag):
+        response = app.response_class(status=304)
+    else:
+        response = jsonify({'property': property_name, 'page': page, 'per_page': per_page, 'total': total, 'prospects': rows})
+    response.set_etag(page_etag)
+    return response
+
+
+@app.route("/results/<job_id>")
+def get_results(job_id):
+    job = job_runner.get(job_id)
+    if job is None:
+        return {'error': f'Unknown job {job_id}.'}, 404
+    if job.status == JOB_FINISHED:
+        return jsonify(job.result), 200
+    if job.status == JOB_FAILED:
+        return job.to_dict(), 500
+    return job.to_dict(), 202
+
+
+def call_transcript_api(day, logger_name):
+    """
+    Stream the chatbot prospect export for day ('YYYY-MM-DD') into UPLOAD_FOLDER,
+    yielding batches of prospect rows as they are parsed.
+    """
+    from csv_ingest import stream_prospect_batches
     api_url_base = os.getenv('TRANSCRIPT_API_URL_BASE')
-    yd = datetime.today()-timedelta(days=1) #yesterday
-    date_spec = f'&startDate={yd.year}-{yd.month:02d}-{yd.day:02d}&endDate={yd.year}-{yd.month:02d}-{yd.day:02d}'
+    date_spec = f'&startDate={day}&endDate={day}'
     full_api_url = api_url_base + date_spec
-    response = requests.get(full_api_url, allow_redirects=True)
     csv_file_path = os.path.join(os.path.abspath(UPLOAD_FOLDER), f'{full_api_url[-39:]}.csv')
-    with open(csv_file_path, 'wb+') as f:
-        f.write(response.content)
-    transcript_df = pd.read_csv(csv_file_path)
-    return redirect(url_for('analyze_sentiment'), file=transcript_df)
+    yield from stream_prospect_batches(full_api_url, csv_file_path, logger_name)
+    return
 
 
-@app.route('/post_to_sql')
-def post_transcripts_to_db(transcripts_df):
+def post_transcripts_to_db(messages_df, prospects_df):
     """
-    Post latest transcript messages to SQL Server DB.
+    Upsert the latest transcripts into the SQL Server DB: prospects keyed on transcript
+    and messages keyed on message id, so reprocessing a day updates rows instead of
+    duplicating them.
 
     Parameters
     ----------
-    transcripts_df : Pandas DataFrame
-        The dataframe containing the daily transcript messages from the previous day
-        needing injection into the SQL table.
+    messages_df : Pandas DataFrame
+        One row per message, with sentiment scores and the transcript it belongs to.
+    prospects_df : Pandas DataFrame
+        One row per transcript in messages_df.
 
     Returns
     -------
     None
     
     """
-    sql_connection_string = os.getenv('SQL_CONNECTION_STRING')
-    sql_table_name = os.getenv('SQL_TABLE_NAME')
-    quoted = urllib.parse.quote_plus(sql_connection_string)
-    engine = create_engine('mssql+pyodbc:///?odbc_connect={}'.format(quoted))
-
-    md = MetaData(bind=engine, schema='dbo')
-    md.reflect(only=[sql_table_name])
-
-    transcripts_df.to_sql(name=sql_table_name,
-                          schema="dbo",
-                          con=engine,
-                          if_exists='append',
-                          index=False,
-                          chunksize=100,
-                          dtype={'id': BIGINT,
-                                 'timeCreated': DATETIME,
-                                 'isInbound': BOOLEAN,
-                                 'messageType': VARCHAR(250, collation="SQL_Latin1_General_CP1_CI_AS"),
-                                 'messageStatus': VARCHAR(250, collation="SQL_Latin1_General_CP1_CI_AS"),
-                                 'classification': VARCHAR(250, collation="SQL_Latin1_General_CP1_CI_AS"),
-                                 'routedTo': VARCHAR(250, collation="SQL_Latin1_General_CP1_CI_AS"),
-                                 'leasingAttributionSource': VARCHAR(250, collation="SQL_Latin1_General_CP1_CI_AS"),
-                                 'leasingAttributionSourceDisplayName': VARCHAR(250, collation="SQL_Latin1_General_CP1_CI_AS"),
-                                 'addressFrom': VARCHAR(250, collation="SQL_Latin1_General_CP1_CI_AS"),
-                                 'addressTo': VARCHAR(250, collation="SQL_Latin1_General_CP1_CI_AS"),
-                                 'censoredShortBody': VARCHAR(250, collation="SQL_Latin1_General_CP1_CI_AS"),
-                                 'censoredTranslatedShortBody': VARCHAR(250, collation="SQL_Latin1_General_CP1_CI_AS"),
-                                 'isIlsInbound': BOOLEAN,
-                                 'mediaUrl': VARCHAR(250, collation="SQL_Latin1_General_CP1_CI_AS"),
-                                 'property': VARCHAR(250, collation="SQL_Latin1_General_CP1_CI_AS"),
-                                 'timeFirstMessage': DATETIME,
-                                 'firstName': VARCHAR(250, collation="SQL_Latin1_General_CP1_CI_AS"),
-                                 'lastName': VARCHAR(250, collation="SQL_Latin1_General_CP1_CI_AS"),
-                                 'email': VARCHAR(250, collation="SQL_Latin1_General_CP1_CI_AS"),
-                                 'phone': VARCHAR(250, collation="SQL_Latin1_General_CP1_CI_AS"),
-                                 'channel': VARCHAR(250, collation="SQL_Latin1_General_CP1_CI_AS"),
-                                 'source': VARCHAR(250, collation="SQL_Latin1_General_CP1_CI_AS"),
-                                 'unitTypes': VARCHAR(250, collation="SQL_Latin1_General_CP1_CI_AS"),
-                                 'tourType': VARCHAR(250, collation="SQL_Latin1_General_CP1_CI_AS"),
-                                 'qualified': BOOLEAN,
-                                 'timeLastMessage': DATETIME,
-                                 'conversationLengthInSeconds': BIGINT,
-                                 'countInboundMessages': INTEGER,
-                                 'countOutboundMessages': INTEGER,
-                                 'countCallsAttempted': INTEGER,
-                                 'countShowingsOffered': INTEGER,
-                                 'countShowingsRejected': INTEGER,
-                                 'countShowingsAccepted': INTEGER,
-                                 'countShowingsConfirmationSent': INTEGER,
-                                 'countShowingsConfirmed': INTEGER,
-                                 'countShowingsCanceledByProspect': INTEGER,
-                                 'countShowingsCanceledByLisa': INTEGER,
-                                 'lastAcceptedShowingId': BIGINT,
-                                 'isAcceptedShowingInPast': BOOLEAN,
-                                 'propertyCode': BIGINT,
-                                 'prospectCode': BIGINT,
-                                 'createdProspectSource': VARCHAR(250, collation="SQL_Latin1_General_CP1_CI_AS"),
-                                 'transcript': VARCHAR(250, collation="SQL_Latin1_General_CP1_CI_AS"),
-                                 'plannedNextMessage': BOOLEAN,
-                                 'applicationStatus': VARCHAR(250, collation="SQL_Latin1_General_CP1_CI_AS")})
+    from database import (bulk_upsert_dataframe, get_engine, SQL_SCHEMA, SQL_MESSAGES_TABLE_NAME, SQL_PROSPECTS_TABLE_NAME,
+                          MESSAGE_SQL_DTYPES, PROSPECT_SQL_DTYPES)
+    bulk_upsert_dataframe(prospects_df,
+                          get_engine(),
+                          SQL_PROSPECTS_TABLE_NAME,
+                          logger_name=app.logger.name,
+                          key_columns=('transcript',),
+                          schema=SQL_SCHEMA,
+                          dtype=PROSPECT_SQL_DTYPES)
+    bulk_upsert_dataframe(messages_df,
+                          get_engine(),
+                          SQL_MESSAGES_TABLE_NAME,
+                          logger_name=app.logger.name,
+                          key_columns=('id',),
+                          schema=SQL_SCHEMA,
+                          dtype=MESSAGE_SQL_DTYPES)
     return
 
 
@@ -0,0 +1,175 @@
+import os
+import json
+import argparse
+import logging
+import threading
+from datetime import date, datetime, timedelta, timezone
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from dotenv import load_dotenv
+from api_calling import setup_logging, build_url, stream_daily_csv_batches, read_transcripts
+from message_buffer import concat_compact_frames
+from transcript_storage import append_transcripts
+from transcript_state import record_transcript_states
+
+
+load_dotenv('.env')
+BACKFILL_WORKERS = int(os.getenv('BACKFILL_WORKERS', 4))
+BACKFILL_OUTPUT_DIR = os.getenv('BACKFILL_OUTPUT_DIR', os.path.abspath('backfill_output'))
+
+
+def split_date_range(start_date, end_date, shard='day'):
+    """
+    Split the inclusive range [start_date, end_date] into (shard_start, shard_end) pairs
+    of one day or up to seven days each.
+    """
+    shard_days = {'day': 1, 'week': 7}[shard]
+    shards = []
+    shard_start = start_date
+    while shard_start <= end_date:
+        shard_end = min(shard_start + timedelta(days=shard_days - 1), end_date)
+        shards.append((shard_start, shard_end))
+        shard_start = shard_end + timedelta(days=1)
+    return shards
+
+
+def _shard_key(shard_start, shard_end):
+    return f'{shard_start.isoformat()}_{shard_end.isoformat()}'
+
+
+class BackfillCheckpoint:
+    """
+    JSON record of finished shards. It is rewritten atomically after every shard, so a
+    crashed backfill resumes without refetching finished work.
+    """
+
+    def __init__(self, checkpoint_path):
+        self.checkpoint_path = checkpoint_path
+        self._lock = threading.Lock()
+        try:
+            with open(checkpoint_path, 'r') as checkpoint_file:
+                self._completed_shards = json.load(checkpoint_file)['completed_shards']
+        except FileNotFoundError:
+            self._completed_shards = {}
+
+    def is_complete(self, shard_key):
+        with self._lock:
+            return shard_key in self._completed_shards
+
+    def mark_complete(self, shard_key, message_count):
+        with self._lock:
+            self._completed_shards[shard_key] = {'finished_at': datetime.now(timezone.utc).isoformat(),
+                                                 'messages': message_count}
+            temp_checkpoint_path = self.checkpoint_path + '.tmp'
+            with open(temp_checkpoint_path, 'w') as checkpoint_file:
+                json.dump({'completed_shards': self._completed_shards}, checkpoint_file, indent=2)
+            os.replace(temp_checkpoint_path, self.checkpoint_path)
+        return
+
+
+def run_shard(shard_start, shard_end, storage_dir, logger_name):
+    """
+    Download the export for one shard, re-parse every transcript in it and append the
+    messages and their prospects to the transcript storage datasets under storage_dir.
+    Returns the number of messages written.
+    """
+    logger = logging.getLogger(f'{logger_name}.run_shard')
+    shard_key = _shard_key(shard_start, shard_end)
+    full_api_url = build_url(logger_name, today=False, start_date=shard_start.isoformat(), end_date=shard_end.isoformat())
+    message_batches = []
+    prospect_batches = []
+    transcript_states = []
+    # Past exports never change, so a shard retried after a crash reuses its cached export.
+    for prospect_batch_df in stream_daily_csv_batches(full_api_url, logger_name, use_cache=True):
+        messages_df, transcript_prospects_df = read_transcripts(prospect_batch_df, logger_name, skip_unchanged=False, normalized=True,
+                                                                pending_state=transcript_states)
+        message_batches.append(messages_df)
+        prospect_batches.append(transcript_prospects_df)
+    shard_messages_df = concat_compact_frames(message_batches)
+    shard_prospects_df = concat_compact_frames(prospect_batches)
+    # A shard that fails after appending is appended again on retry; readers of the
+    # storage datasets drop the duplicate rows.
+    append_transcripts(shard_messages_df, shard_prospects_df, logger_name, storage_dir=storage_dir)
+    record_transcript_states(transcript_states)
+    logger.info(f'Shard {shard_key} finished with {len(shard_messages_df)} messages from {len(shard_prospects_df)} transcripts.')
+    return len(shard_messages_df)
+
+
+def run_backfill(start_date, end_date, logger_name, shard='day', workers=BACKFILL_WORKERS, output_dir=BACKFILL_OUTPUT_DIR, checkpoint_path=None,
+                 storage_dir=None):
+    """
+    Backfill every shard of [start_date, end_date] with up to workers shards in flight,
+    skipping shards the checkpoint already records as finished.
+
+    Parameters
+    ----------
+    start_date, end_date : datetime.date
+        Inclusive date range to rebuild.
+    logger_name : str
+        Name of the parent logger.
+    shard : str, optional
+        'day' or 'week'. The default is 'day'.
+    workers : int, optional
+        Maximum number of shards processed at once. The default is the BACKFILL_WORKERS
+        environment variable, or 4.
+    output_dir : str, optional
+        Directory for the checkpoint. The default is the BACKFILL_OUTPUT_DIR environment
+        variable, or ./backfill_output.
+    checkpoint_path : str, optional
+        Checkpoint file. The default is backfill_checkpoint.json inside output_dir.
+    storage_dir : str, optional
+        Root of the transcript storage datasets the shards are appended to. The default
+        is transcript_storage.TRANSCRIPT_STORAGE_DIR.
+
+    Returns
+    -------
+    failed_shards : list of str
+        Keys of the shards that raised. Re-running the same command retries only these.
+
+    """
+    logger = logging.getLogger(f'{logger_name}.run_backfill')
+    os.makedirs(output_dir, exist_ok=True)
+    if checkpoint_path is None:
+        checkpoint_path = os.path.join(output_dir, 'backfill_checkpoint.json')
+    checkpoint = BackfillCheckpoint(checkpoint_path)
+    pending_shards = [(shard_start, shard_end) for shard_start, shard_end in split_date_range(start_date, end_date, shard)
+                      if not checkpoint.is_complete(_shard_key(shard_start, shard_end))]
+    logger.info(f'{len(pending_shards)} shards pending between {start_date} and {end_date}.')
+    failed_shards = []
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix='backfill') as executor:
+        shard_futures = {executor.submit(run_shard, shard_start, shard_end, storage_dir, logger_name): _shard_key(shard_start, shard_end)
+                         for shard_start, shard_end in pending_shards}
+        for shard_future in as_completed(shard_futures):
+            shard_key = shard_futures[shard_future]
+            try:
+                checkpoint.mark_complete(shard_key, shard_future.result())
+            except Exception:
+                logger.exception(f'Shard {shard_key} failed.')
+                failed_shards.append(shard_key)
+    logger.info(f'Backfill finished with {len(failed_shards)} failed shards.')
+    return failed_shards
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Rebuild transcript history for a date range in parallel, resumable shards.')
+    parser.add_argument('--start', required=True, type=date.fromisoformat, help='First day to backfill (YYYY-MM-DD).')
+    parser.add_argument('--end', required=True, type=date.fromisoformat, help='Last day to backfill (YYYY-MM-DD).')
+    parser.add_argument('--shard', choices=('day', 'week'), default='day')
+    parser.add_argument('--workers', type=int, default=BACKFILL_WORKERS)
+    parser.add_argument('--output-dir', default=BACKFILL_OUTPUT_DIR)
+    parser.add_argument('--checkpoint', default=None)
+    parser.add_argument('--storage-dir', default=None, help='Transcript storage root. The default is TRANSCRIPT_STORAGE_DIR.')
+    parser.add_argument('--log-dir', default=os.getcwd())
+    args = parser.parse_args()
+    logger_name = 'chatbot_prospect_backfill'
+    setup_logging(save_dir=args.log_dir, logger_name=logger_name, verbosity=20)
+    failed_shards = run_backfill(args.start, args.end, logger_name,
+                                 shard=args.shard,
+                                 workers=args.workers,
+                                 output_dir=args.output_dir,
+                                 checkpoint_path=args.checkpoint,
+                                 storage_dir=args.storage_dir)
+    return 1 if failed_shards else 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
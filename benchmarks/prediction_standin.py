@@ -0,0 +1,138 @@
+import io
+import time
+import csv
+import gzip
+import json
+import hashlib
+import argparse
+import threading
+from http.server import BaseHTTPRequestHandler
+from benchmarks.standin_server import _StandinHTTPServer
+
+
+class _PredictionRequestHandler(BaseHTTPRequestHandler):
+
+    protocol_version = 'HTTP/1.1'
+
+    def do_POST(self):
+        standin = self.server.standin
+        standin.sleep_latency()
+        path_parts = self.path.strip('/').split('/')
+        request_body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        if len(path_parts) != 5 or path_parts[:3] != ['predApi', 'v1.0', 'deployments'] or path_parts[4] != 'predictions':
+            self._send_json(404, {'message': 'Not found'})
+            return
+        compressed = self.headers.get('Content-Encoding') == 'gzip'
+        if compressed:
+            request_body = gzip.decompress(request_body)
+        feature_rows = list(csv.reader(io.StringIO(request_body.decode('utf-8'))))[1:]
+        standin.record_request(len(feature_rows), compressed, self.headers.get('Content-Type'))
+        self._send_json(200, {'data': [standin.predict_row(row_id, feature_row) for row_id, feature_row in enumerate(feature_rows)]})
+        return
+
+    def _send_json(self, status, payload):
+        body = json.dumps(payload).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+        return
+
+    def log_message(self, format, *args):
+        return
+
+
+class PredictionStandinServer:
+    """
+    Local HTTP server standing in for a DataRobot prediction server. POST
+    /predApi/v1.0/deployments/<id>/predictions takes a CSV body, gzipped or not, and
+    returns a binary signed_contract prediction per row, derived from a hash of the row
+    so the same features always get the same prediction.
+
+    Parameters
+    ----------
+    latency_seconds : float, optional
+        Delay added to every response. The default is 0.
+    host : str, optional
+        Interface to bind. The default is 127.0.0.1.
+    port : int, optional
+        Port to bind. The default is 0, which picks a free port.
+
+    """
+
+    def __init__(self, latency_seconds=0.0, host='127.0.0.1', port=0):
+        self.latency_seconds = latency_seconds
+        self.request_count = 0
+        self.row_count = 0
+        self.compressed_request_count = 0
+        self.content_types = set()
+        self._count_lock = threading.Lock()
+        self._http_server = _StandinHTTPServer((host, port), _PredictionRequestHandler)
+        self._http_server.standin = self
+        self._thread = None
+        self.base_url = f'http://{host}:{self._http_server.server_port}'
+
+    def sleep_latency(self):
+        if self.latency_seconds > 0:
+            time.sleep(self.latency_seconds)
+        return
+
+    def record_request(self, row_count, compressed=False, content_type=None):
+        with self._count_lock:
+            self.request_count += 1
+            self.row_count += row_count
+            self.compressed_request_count += int(compressed)
+            self.content_types.add(content_type)
+        return
+
+    @staticmethod
+    def predict_row(row_id, feature_row):
+        positive_probability = int(hashlib.sha1(','.join(feature_row).encode('utf-8')).hexdigest()[:8], 16) / 0xFFFFFFFF
+        return {'rowId': row_id,
+                'prediction': 1 if positive_probability >= 0.5 else 0,
+                'predictionThreshold': 0.5,
+                'predictionValues': [{'label': 1, 'value': positive_probability},
+                                     {'label': 0, 'value': 1 - positive_probability}]}
+
+    def serve_forever(self):
+        self._http_server.serve_forever()
+        return
+
+    def start(self):
+        self._thread = threading.Thread(target=self._http_server.serve_forever, name='prediction-standin', daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._http_server.shutdown()
+        self._http_server.server_close()
+        if self._thread is not None:
+            self._thread.join()
+        return
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
+        return False
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Serve stand-in DataRobot predictions locally.')
+    parser.add_argument('--latency', type=float, default=0.0, help='Seconds added to every response.')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8766)
+    args = parser.parse_args()
+    standin = PredictionStandinServer(latency_seconds=args.latency, host=args.host, port=args.port)
+    print(f'Set DATAROBOT_PREDICTION_URL_BASE={standin.base_url}')
+    try:
+        standin.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
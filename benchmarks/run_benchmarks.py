@@ -0,0 +1,262 @@
+import os
+import gc
+import sys
+import json
+import time
+import logging
+import argparse
+import platform
+import tempfile
+import tracemalloc
+import importlib.metadata
+from datetime import datetime, timezone
+from benchmarks.standin_server import ChatbotStandinServer
+
+
+BENCHMARK_STAGES = ('ingest', 'fetch_parse', 'classification', 'sentiment', 'sql_write')
+BENCHMARK_PACKAGES = ('pandas', 'numpy', 'aiohttp', 'pyarrow', 'SQLAlchemy', 'vaderSentiment', 'textblob', 'nltk')
+# Synthetic conversations end near this time; classifying against it keeps the
+# outreach/waitlist split identical between runs.
+BENCHMARK_REFERENCE_TIME = datetime(2022, 6, 1, 13, tzinfo=timezone.utc)
+
+
+def _configure_work_dir(work_dir, sql_engine_url):
+    # The pipeline modules read these at import time, so they are set before importing them.
+    os.environ['TRANSCRIPT_STATE_DB_PATH'] = os.path.join(work_dir, 'transcript_state.sqlite3')
+    os.environ['SENTIMENT_CACHE_DB_PATH'] = os.path.join(work_dir, 'sentiment_score_cache.sqlite3')
+    os.environ['HOUR_WAITLIST_DB_PATH'] = os.path.join(work_dir, 'hour_waitlist.sqlite3')
+    os.environ['SQL_ENGINE_URL'] = sql_engine_url or f'sqlite:///{os.path.join(work_dir, "benchmark.sqlite3")}'
+    os.environ['SQL_SCHEMA'] = os.environ.get('SQL_SCHEMA', '') if sql_engine_url else ''
+    return
+
+
+def _package_versions():
+    package_versions = {}
+    for package_name in BENCHMARK_PACKAGES:
+        try:
+            package_versions[package_name] = importlib.metadata.version(package_name)
+        except importlib.metadata.PackageNotFoundError:
+            package_versions[package_name] = None
+    return package_versions
+
+
+def _measure_stage(stage_results, stage_name, trace_memory, stage_function):
+    """
+    Run stage_function, which returns (result, item_count), and record its wall time,
+    throughput and the peak Python heap allocated above the level it started at.
+    """
+    gc.collect()
+    if trace_memory:
+        tracemalloc.reset_peak()
+        baseline_bytes = tracemalloc.get_traced_memory()[0]
+    start_time = time.perf_counter()
+    try:
+        result, item_count = stage_function()
+    except Exception as e:
+        logging.getLogger('chatbot_prospect_benchmark').exception(f'Benchmark stage {stage_name} failed.')
+        stage_results[stage_name] = {'error': repr(e)}
+        return None
+    seconds = time.perf_counter() - start_time
+    stage_results[stage_name] = {'seconds': round(seconds, 6),
+                                 'items': item_count,
+                                 'items_per_second': round(item_count / seconds, 3) if seconds > 0 else None,
+                                 'peak_memory_bytes': tracemalloc.get_traced_memory()[1] - baseline_bytes if trace_memory else None}
+    return result
+
+
+def run_benchmarks(n_prospects, messages_per_transcript=12, latency_seconds=0.0, latency_jitter_seconds=0.0, seed=0,
+                   stages=BENCHMARK_STAGES, max_in_flight=None, sentiment_parallel=False, sentiment_workers=None,
+                   work_dir=None, sql_engine_url=None, engine=None, trace_memory=True, error_rate=0.0, throttle_rate=0.0,
+                   max_concurrency=None):
+    """
+    Run the pipeline stages against a local chatbot stand-in and measure each one.
+
+    Parameters
+    ----------
+    n_prospects : int
+        Number of synthetic prospects, one transcript each.
+    messages_per_transcript : int, optional
+        Average messages per transcript. The default is 12.
+    latency_seconds, latency_jitter_seconds : float, optional
+        Fixed and random extra latency of every stand-in response. The defaults are 0.
+    seed : int, optional
+        Seed for the synthetic data. The default is 0.
+    stages : tuple of str, optional
+        Stages to run, from BENCHMARK_STAGES. Stages after fetch_parse use its messages.
+    max_in_flight : int, optional
+        Passed to read_transcripts. The default defers to TRANSCRIPT_FETCH_MAX_IN_FLIGHT.
+    sentiment_parallel : bool, optional
+        Score sentiment across a process pool. Memory of the pool workers is not traced.
+        The default is False.
+    sentiment_workers : int, optional
+        Pool size for sentiment_parallel. The default defers to SENTIMENT_WORKERS.
+    work_dir : str, optional
+        Directory for the state, cache and SQLite files. The default is a new temporary
+        directory, so every run starts cold.
+    sql_engine_url : str, optional
+        SQLAlchemy url for the sql_write stage. The default is a SQLite file in work_dir.
+    engine : sqlalchemy.engine.Engine, optional
+        Engine for the sql_write stage, used instead of sql_engine_url.
+    trace_memory : bool, optional
+        Record peak memory per stage with tracemalloc. Tracing slows every stage down,
+        so compare runs made with the same setting. The default is True.
+    error_rate, throttle_rate : float, optional
+        Share of stand-in responses that are a 503, or a 429 with Retry-After. The
+        defaults are 0.
+    max_concurrency : int, optional
+        The stand-in answers requests beyond this many in flight with a 429. The default
+        is no limit.
+
+    Returns
+    -------
+    results : dict
+        Run configuration, environment, per-stage results, the faults the stand-in
+        injected and the request controller's per-host state, ready for json.dump.
+
+    """
+    if work_dir is None:
+        work_dir = tempfile.mkdtemp(prefix='chatbot_prospect_benchmark_')
+    os.makedirs(work_dir, exist_ok=True)
+    _configure_work_dir(work_dir, sql_engine_url)
+    import pandas as pd
+    from csv_ingest import stream_prospect_batches
+    from api_calling import read_transcripts, check_for_targets_and_time_elapsed
+    from sentiment import sentiment_main
+    from sentiment_cache import get_score_cache
+    from request_controller import get_request_controller
+    from database import bulk_upsert_dataframe, get_engine, SQL_SCHEMA, MESSAGE_SQL_DTYPES, PROSPECT_SQL_DTYPES
+    from benchmarks.synthetic import generate_prospects
+    logger_name = 'chatbot_prospect_benchmark'
+    stage_results = {}
+
+    def ingest():
+        prospect_batches = list(stream_prospect_batches(f'{standin.export_url_base}&startDate=2022-06-01&endDate=2022-06-01',
+                                                        os.path.join(work_dir, 'prospects.csv'),
+                                                        logger_name))
+        prospects_df = pd.concat(prospect_batches, axis=0, ignore_index=True)
+        return prospects_df, len(prospects_df)
+
+    def fetch_parse():
+        transcript_frames = read_transcripts(prospects_df, logger_name, max_in_flight=max_in_flight, skip_unchanged=False, normalized=True)
+        return transcript_frames, len(prospects_df)
+
+    def classification():
+        return check_for_targets_and_time_elapsed(messages_df, logger_name, now=BENCHMARK_REFERENCE_TIME), len(messages_df)
+
+    def sentiment():
+        return sentiment_main(messages_df.copy(), parallel=sentiment_parallel, n_workers=sentiment_workers), len(messages_df)
+
+    def sql_write():
+        sql_engine = engine if engine is not None else get_engine()
+        rows_loaded = (bulk_upsert_dataframe(transcript_prospects_df, sql_engine, 'benchmark_prospects', logger_name,
+                                             key_columns=('transcript',), schema=SQL_SCHEMA, dtype=PROSPECT_SQL_DTYPES) +
+                       bulk_upsert_dataframe(messages_df, sql_engine, 'benchmark_messages', logger_name,
+                                             schema=SQL_SCHEMA, dtype=MESSAGE_SQL_DTYPES))
+        return rows_loaded, rows_loaded
+
+    if trace_memory:
+        tracemalloc.start()
+    try:
+        with ChatbotStandinServer(n_prospects,
+                                  messages_per_transcript=messages_per_transcript,
+                                  latency_seconds=latency_seconds,
+                                  latency_jitter_seconds=latency_jitter_seconds,
+                                  seed=seed,
+                                  error_rate=error_rate,
+                                  throttle_rate=throttle_rate,
+                                  max_concurrency=max_concurrency) as standin:
+            prospects_df = _measure_stage(stage_results, 'ingest', trace_memory, ingest) if 'ingest' in stages else None
+            if prospects_df is None:
+                prospects_df = generate_prospects(n_prospects, f'{standin.base_url}/transcripts/', seed=seed)
+            transcript_frames = None
+            if 'fetch_parse' in stages:
+                transcript_frames = _measure_stage(stage_results, 'fetch_parse', trace_memory, fetch_parse)
+            fault_counts = dict(standin.fault_counts)
+        if transcript_frames is not None:
+            messages_df, transcript_prospects_df = transcript_frames
+            stage_results['fetch_parse']['messages'] = len(messages_df)
+            stage_results['fetch_parse']['frame_memory_bytes'] = int(messages_df.memory_usage(deep=True).sum() +
+                                                                     transcript_prospects_df.memory_usage(deep=True).sum())
+            if 'classification' in stages:
+                _measure_stage(stage_results, 'classification', trace_memory, classification)
+            if 'sentiment' in stages:
+                scored_messages_df = _measure_stage(stage_results, 'sentiment', trace_memory, sentiment)
+                if scored_messages_df is not None:
+                    stage_results['sentiment']['score_cache'] = get_score_cache().stats()
+                    messages_df = scored_messages_df
+            if 'sql_write' in stages:
+                _measure_stage(stage_results, 'sql_write', trace_memory, sql_write)
+    finally:
+        if trace_memory:
+            tracemalloc.stop()
+    return {'started_at': datetime.now(timezone.utc).isoformat(),
+            'config': {'n_prospects': n_prospects,
+                       'messages_per_transcript': messages_per_transcript,
+                       'latency_seconds': latency_seconds,
+                       'latency_jitter_seconds': latency_jitter_seconds,
+                       'seed': seed,
+                       'stages': list(stages),
+                       'max_in_flight': max_in_flight,
+                       'sentiment_parallel': sentiment_parallel,
+                       'sentiment_workers': sentiment_workers,
+                       'trace_memory': trace_memory,
+                       'error_rate': error_rate,
+                       'throttle_rate': throttle_rate,
+                       'max_concurrency': max_concurrency},
+            'environment': {'python': sys.version.split()[0],
+                            'platform': platform.platform(),
+                            'cpu_count': os.cpu_count(),
+                            'packages': _package_versions()},
+            'stages': stage_results,
+            'faults': fault_counts,
+            'request_controller': get_request_controller().stats()}
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the transcript pipeline against a local chatbot stand-in and write the results as JSON.')
+    parser.add_argument('--prospects', type=int, default=1000)
+    parser.add_argument('--messages-per-transcript', type=int, default=12)
+    parser.add_argument('--latency', type=float, default=0.0, help='Seconds added to every stand-in response.')
+    parser.add_argument('--jitter', type=float, default=0.0, help='Up to this many extra random seconds per response.')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--stages', nargs='+', choices=BENCHMARK_STAGES, default=list(BENCHMARK_STAGES))
+    parser.add_argument('--max-in-flight', type=int, default=None)
+    parser.add_argument('--sentiment-parallel', action='store_true')
+    parser.add_argument('--sentiment-workers', type=int, default=None)
+    parser.add_argument('--sql-engine-url', default=None, help='SQLAlchemy url for sql_write. The default is a SQLite file in the work directory.')
+    parser.add_argument('--work-dir', default=None)
+    parser.add_argument('--error-rate', type=float, default=0.0, help='Share of stand-in responses that are a 503.')
+    parser.add_argument('--throttle-rate', type=float, default=0.0, help='Share of stand-in responses that are a 429.')
+    parser.add_argument('--max-concurrency', type=int, default=None, help='Stand-in answers requests beyond this many in flight with a 429.')
+    parser.add_argument('--no-trace-memory', action='store_true', help='Skip tracemalloc, which slows every stage down.')
+    parser.add_argument('--output', default=None, help='Results file. The default is benchmarks/results/benchmark_<timestamp>.json.')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.WARNING)
+    results = run_benchmarks(args.prospects,
+                             messages_per_transcript=args.messages_per_transcript,
+                             latency_seconds=args.latency,
+                             latency_jitter_seconds=args.jitter,
+                             seed=args.seed,
+                             stages=tuple(args.stages),
+                             max_in_flight=args.max_in_flight,
+                             sentiment_parallel=args.sentiment_parallel,
+                             sentiment_workers=args.sentiment_workers,
+                             work_dir=args.work_dir,
+                             sql_engine_url=args.sql_engine_url,
+                             trace_memory=not args.no_trace_memory,
+                             error_rate=args.error_rate,
+                             throttle_rate=args.throttle_rate,
+                             max_concurrency=args.max_concurrency)
+    output_path = args.output
+    if output_path is None:
+        output_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'results', f'benchmark_{datetime.now().strftime("%Y%m%d_%H%M%S")}.json')
+    os.makedirs(os.path.dirname(os.path.abspath(output_path)), exist_ok=True)
+    with open(output_path, 'w') as results_file:
+        json.dump(results, results_file, indent=2)
+    print(json.dumps({'stages': results['stages'], 'faults': results['faults'], 'request_controller': results['request_controller']}, indent=2))
+    print(f'Results written to {output_path}')
+    return 1 if any('error' in stage_result for stage_result in results['stages'].values()) else 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
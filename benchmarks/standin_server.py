@@ -0,0 +1,228 @@
+import time
+import random
+import hashlib
+import argparse
+import threading
+from functools import lru_cache
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit
+from benchmarks.synthetic import generate_messages, generate_prospects, render_transcript_html
+
+
+class _StandinRequestHandler(BaseHTTPRequestHandler):
+
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        standin = self.server.standin
+        fault = standin.begin_request()
+        try:
+            if fault is not None:
+                fault_status, retry_after_seconds = fault
+                self._send_body(fault_status, b'', 'text/plain', retry_after_seconds=retry_after_seconds)
+                return
+            standin.sleep_latency()
+            self._serve_path(standin, urlsplit(self.path).path)
+        finally:
+            standin.end_request()
+        return
+
+    def _serve_path(self, standin, request_path):
+        if request_path == '/export':
+            self._send_body(200, standin.export_csv, 'text/csv; charset=utf-8')
+        elif request_path.startswith('/transcripts/'):
+            try:
+                transcript_index = int(request_path.rsplit('/', 1)[1])
+            except ValueError:
+                self._send_body(404, b'', 'text/plain')
+                return
+            transcript_html, etag = standin.transcript_page(transcript_index)
+            if self.headers.get('If-None-Match') == etag:
+                self.send_response(304)
+                self.send_header('ETag', etag)
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+                return
+            self._send_body(200, transcript_html, 'text/html; charset=utf-8', etag=etag)
+        else:
+            self._send_body(404, b'', 'text/plain')
+        return
+
+    def _send_body(self, status, body, content_type, etag=None, retry_after_seconds=None):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        if etag is not None:
+            self.send_header('ETag', etag)
+        if retry_after_seconds is not None:
+            self.send_header('Retry-After', f'{retry_after_seconds:g}')
+        self.end_headers()
+        self.wfile.write(body)
+        return
+
+    def log_message(self, format, *args):
+        return
+
+
+class _StandinHTTPServer(ThreadingHTTPServer):
+
+    # The fetcher opens hundreds of connections at once; the default backlog of 5
+    # makes the kernel drop most of them.
+    request_queue_size = 1024
+    daemon_threads = True
+
+
+class ChatbotStandinServer:
+    """
+    Local HTTP server standing in for the chatbot service. GET /export returns a synthetic
+    prospect CSV and GET /transcripts/<n> returns the matching transcript page, with an
+    ETag so conditional requests get a 304.
+
+    Parameters
+    ----------
+    n_prospects : int
+        Rows in the prospect export.
+    messages_per_transcript : int, optional
+        Average number of messages per transcript. The default is 12.
+    latency_seconds : float, optional
+        Delay added to every response. The default is 0.
+    latency_jitter_seconds : float, optional
+        Extra uniformly random delay of up to this many seconds. The default is 0.
+    seed : int, optional
+        Random seed for the synthetic data. The default is 0.
+    host : str, optional
+        Interface to bind. The default is 127.0.0.1.
+    port : int, optional
+        Port to bind. The default is 0, which picks a free port.
+    error_rate : float, optional
+        Share of requests answered with a 503. The default is 0.
+    throttle_rate : float, optional
+        Share of requests answered with a 429 and a Retry-After header. The default is 0.
+    max_concurrency : int, optional
+        Requests beyond this many in flight at once get a 429 with Retry-After, like a
+        rate-limited upstream. The default is no limit.
+    retry_after_seconds : float, optional
+        Retry-After sent with every 429. The default is 1.
+
+    """
+
+    def __init__(self, n_prospects, messages_per_transcript=12, latency_seconds=0.0, latency_jitter_seconds=0.0, seed=0, host='127.0.0.1', port=0,
+                 error_rate=0.0, throttle_rate=0.0, max_concurrency=None, retry_after_seconds=1.0):
+        self.n_prospects = n_prospects
+        self.messages_per_transcript = messages_per_transcript
+        self.latency_seconds = latency_seconds
+        self.latency_jitter_seconds = latency_jitter_seconds
+        self.seed = seed
+        self.error_rate = error_rate
+        self.throttle_rate = throttle_rate
+        self.max_concurrency = max_concurrency
+        self.retry_after_seconds = retry_after_seconds
+        self.fault_counts = {'requests': 0, 'errors': 0, 'throttled': 0, 'over_concurrency': 0}
+        self._in_flight = 0
+        self._fault_lock = threading.Lock()
+        self._http_server = _StandinHTTPServer((host, port), _StandinRequestHandler)
+        self._http_server.standin = self
+        self._thread = None
+        self.base_url = f'http://{host}:{self._http_server.server_port}'
+        self.export_csv = generate_prospects(n_prospects, f'{self.base_url}/transcripts/', seed=seed).to_csv(index=False).encode('utf-8')
+        self.transcript_page = lru_cache(maxsize=4096)(self._render_transcript_page)
+
+    @property
+    def export_url_base(self):
+        # build_url appends '&startDate=...&endDate=...' to TRANSCRIPT_API_URL_BASE.
+        return f'{self.base_url}/export?apiKey=benchmark'
+
+    def begin_request(self):
+        """
+        Count a request as in flight and decide whether to fail it. Returns None to serve
+        it, or (status, retry_after_seconds) for the fault to send instead.
+        """
+        fault_draw = random.random()
+        with self._fault_lock:
+            self._in_flight += 1
+            self.fault_counts['requests'] += 1
+            if self.max_concurrency is not None and self._in_flight > self.max_concurrency:
+                self.fault_counts['over_concurrency'] += 1
+                return 429, self.retry_after_seconds
+            if fault_draw < self.error_rate:
+                self.fault_counts['errors'] += 1
+                return 503, None
+            if fault_draw < self.error_rate + self.throttle_rate:
+                self.fault_counts['throttled'] += 1
+                return 429, self.retry_after_seconds
+        return None
+
+    def end_request(self):
+        with self._fault_lock:
+            self._in_flight -= 1
+        return
+
+    def sleep_latency(self):
+        delay_seconds = self.latency_seconds + random.uniform(0, self.latency_jitter_seconds)
+        if delay_seconds > 0:
+            time.sleep(delay_seconds)
+        return
+
+    def _render_transcript_page(self, transcript_index):
+        transcript_html = render_transcript_html(generate_messages(transcript_index, self.messages_per_transcript, seed=self.seed)).encode('utf-8')
+        return transcript_html, '"' + hashlib.sha1(transcript_html).hexdigest() + '"'
+
+    def serve_forever(self):
+        self._http_server.serve_forever()
+        return
+
+    def start(self):
+        self._thread = threading.Thread(target=self._http_server.serve_forever, name='chatbot-standin', daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._http_server.shutdown()
+        self._http_server.server_close()
+        if self._thread is not None:
+            self._thread.join()
+        return
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
+        return False
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Serve synthetic chatbot prospect exports and transcripts locally.')
+    parser.add_argument('--prospects', type=int, default=1000)
+    parser.add_argument('--messages-per-transcript', type=int, default=12)
+    parser.add_argument('--latency', type=float, default=0.0, help='Seconds added to every response.')
+    parser.add_argument('--jitter', type=float, default=0.0, help='Up to this many extra random seconds per response.')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--error-rate', type=float, default=0.0, help='Share of requests answered with a 503.')
+    parser.add_argument('--throttle-rate', type=float, default=0.0, help='Share of requests answered with a 429.')
+    parser.add_argument('--max-concurrency', type=int, default=None, help='Answer requests beyond this many in flight with a 429.')
+    parser.add_argument('--retry-after', type=float, default=1.0, help='Retry-After seconds sent with every 429.')
+    args = parser.parse_args()
+    standin = ChatbotStandinServer(args.prospects,
+                                   messages_per_transcript=args.messages_per_transcript,
+                                   latency_seconds=args.latency,
+                                   latency_jitter_seconds=args.jitter,
+                                   seed=args.seed,
+                                   host=args.host,
+                                   port=args.port,
+                                   error_rate=args.error_rate,
+                                   throttle_rate=args.throttle_rate,
+                                   max_concurrency=args.max_concurrency,
+                                   retry_after_seconds=args.retry_after)
+    print(f'Set TRANSCRIPT_API_URL_BASE={standin.export_url_base}')
+    try:
+        standin.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
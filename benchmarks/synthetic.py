@@ -0,0 +1,140 @@
+import json
+import random
+from datetime import datetime, timedelta, timezone
+import pandas as pd
+
+
+SYNTHETIC_PROPERTIES = ('Foxchase', 'Brookside', 'Parkview', 'Riverbend', 'Stonegate', 'Willow Creek')
+
+_INBOUND_BODIES = ('Hi, is the two bedroom still available?',
+                   'What is the rent for a one bedroom?',
+                   'Do you allow dogs? I have a small terrier.',
+                   'Can I come by for a tour this weekend?',
+                   'That price is too high for me, thanks anyway.',
+                   'Yes please, Saturday at 10 works great!',
+                   'I never got the application link.',
+                   'Is parking included?')
+_OUTBOUND_BODIES = ('Thanks for reaching out! Would you like to schedule a tour?',
+                    'Our one bedroom homes start at $1,250 per month.',
+                    'We are pet friendly! Up to two pets are welcome.',
+                    'Great, you are confirmed for Saturday at 10am.',
+                    'Just checking in, are you still interested in touring?',
+                    'Here is the link to apply online.',
+                    'Parking is included with every home.')
+
+
+def _transcript_rng(seed, transcript_index):
+    return random.Random(seed * 1000003 + transcript_index)
+
+
+def generate_messages(transcript_index, messages_per_transcript, seed=0, now=None):
+    """
+    Messages of one synthetic transcript, in the chatbot's embedded "messages" format.
+    The same (seed, transcript_index) always gives the same messages, so the stand-in
+    server can rebuild a page on demand instead of holding every page in memory.
+    """
+    if now is None:
+        now = datetime(2022, 6, 1, 12, tzinfo=timezone.utc)
+    rng = _transcript_rng(seed, transcript_index)
+    message_count = max(2, int(rng.gauss(messages_per_transcript, messages_per_transcript / 4)))
+    conversation_start = now - timedelta(hours=rng.uniform(0.25, 20))
+    messages_list = []
+    is_inbound = True
+    for message_index in range(message_count):
+        body = rng.choice(_INBOUND_BODIES if is_inbound else _OUTBOUND_BODIES)
+        messages_list.append({'id': transcript_index * 1000 + message_index,
+                              'timeCreated': (conversation_start + timedelta(minutes=7 * message_index)).isoformat(),
+                              'isInbound': is_inbound,
+                              'messageType': 'SMS',
+                              'messageStatus': 'DELIVERED',
+                              'classification': None if is_inbound else 'AUTOMATED',
+                              'routedTo': None,
+                              'leasingAttributionSource': 'ILS',
+                              'leasingAttributionSourceDisplayName': 'Apartments.com',
+                              'addressFrom': '+15555550100' if is_inbound else '+15555550199',
+                              'addressTo': '+15555550199' if is_inbound else '+15555550100',
+                              'censoredShortBody': body,
+                              'censoredTranslatedShortBody': body,
+                              'isIlsInbound': message_index == 0,
+                              'mediaUrl': None})
+        # Mostly alternate, sometimes the chatbot follows up twice in a row.
+        is_inbound = not is_inbound if rng.random() < 0.85 else is_inbound
+    return messages_list
+
+
+def render_transcript_html(messages_list):
+    """
+    Transcript page with the messages embedded in its first <script> tag, laid out the
+    way the chatbot's pages are, so both transcript_extractor paths can parse it.
+    """
+    state_json = json.dumps({'conversation': {'messages': messages_list, 'messageId': None}}, separators=(',', ':'))
+    return ('<!DOCTYPE html><html><head><title>Transcript</title>'
+            f'<script>window.__INITIAL_STATE__ = {state_json[:-1]} }})</script>'
+            '</head><body><div id="root"></div></body></html>')
+
+
+def generate_prospects(n_prospects, transcript_url_base, seed=0, now=None):
+    """
+    Synthetic chatbot prospect export with the same columns as the real one.
+
+    Parameters
+    ----------
+    n_prospects : int
+        Number of prospect rows.
+    transcript_url_base : str
+        Prefix of the transcript urls, e.g. the stand-in server's /transcripts/ url.
+    seed : int, optional
+        Random seed. The default is 0.
+    now : datetime, optional
+        Reference time the conversations end near. The default is a fixed date so runs
+        are reproducible.
+
+    Returns
+    -------
+    prospects_df : Pandas DataFrame
+        One row per prospect.
+
+    """
+    if now is None:
+        now = datetime(2022, 6, 1, 12, tzinfo=timezone.utc)
+    rng = random.Random(seed)
+    prospect_rows = []
+    for transcript_index in range(n_prospects):
+        time_first_message = now - timedelta(hours=rng.uniform(1, 20))
+        prospect_rows.append({'property': rng.choice(SYNTHETIC_PROPERTIES),
+                              'timeFirstMessage': time_first_message.isoformat(),
+                              'firstName': f'Prospect{transcript_index}',
+                              'lastName': rng.choice(('Smith', 'Garcia', 'Nguyen', 'Johnson', 'Patel')),
+                              'email': f'prospect{transcript_index}@example.com',
+                              'phone': f'555{transcript_index:07d}',
+                              'channel': rng.choice(('SMS', 'EMAIL', 'VOICE')),
+                              'source': 'Apartments.com',
+                              'unitTypes': rng.choice(('1BR', '2BR', '3BR')),
+                              'tourType': rng.choice(('IN_PERSON', 'SELF_GUIDED', 'VIRTUAL')),
+                              'qualified': rng.random() < 0.6,
+                              'timeLastMessage': (time_first_message + timedelta(minutes=rng.uniform(5, 60))).isoformat(),
+                              'conversationLengthInSeconds': rng.randint(60, 7200),
+                              'countInboundMessages': rng.randint(1, 10),
+                              'countOutboundMessages': rng.randint(1, 10),
+                              'countCallsAttempted': rng.randint(0, 2),
+                              'countShowingsOffered': rng.randint(0, 3),
+                              'countShowingsRejected': 0,
+                              'countShowingsAccepted': rng.randint(0, 1),
+                              'countShowingsConfirmationSent': 0,
+                              'countShowingsConfirmed': 0,
+                              'countShowingsCanceledByProspect': 0,
+                              'countShowingsCanceledByLisa': 0,
+                              'lastAcceptedShowingId': rng.randint(10**6, 10**7),
+                              'isAcceptedShowingInPast': False,
+                              'propertyCode': rng.randint(1000, 9999),
+                              'prospectCode': 10**6 + transcript_index,
+                              'createdProspectSource': 'CHATBOT',
+                              'transcript': f'{transcript_url_base}{transcript_index}',
+                              'plannedNextMessage': rng.random() < 0.3,
+                              'applicationStatus': rng.choice(('NONE', 'STARTED', 'SUBMITTED'))})
+    return pd.DataFrame(prospect_rows)
+
+
+def write_prospect_csv(prospects_df, csv_file_path):
+    prospects_df.to_csv(csv_file_path, index=False)
+    return csv_file_path
@@ -0,0 +1,134 @@
+import os
+import logging
+import requests
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+from dotenv import load_dotenv
+from request_controller import get_request_controller
+
+
+load_dotenv('.env')
+PROSPECT_CSV_CHUNK_SIZE = int(os.getenv('PROSPECT_CSV_CHUNK_SIZE', 2000))
+PROSPECT_EXPORT_CONNECT_TIMEOUT_SECONDS = float(os.getenv('PROSPECT_EXPORT_CONNECT_TIMEOUT_SECONDS', 10))
+# Longest wait for the next block of a streaming export, not for the whole download.
+PROSPECT_EXPORT_READ_TIMEOUT_SECONDS = float(os.getenv('PROSPECT_EXPORT_READ_TIMEOUT_SECONDS', 300))
+_DOWNLOAD_BLOCK_SIZE = 1024 * 1024
+
+
+class _TeeReader:
+    """
+    File-like reader over a streaming HTTP body that copies every block it reads to
+    csv_file, so the export is parsed and saved to disk in the same single pass.
+    """
+
+    def __init__(self, raw_stream, csv_file):
+        self._raw_stream = raw_stream
+        self._csv_file = csv_file
+
+    def read(self, size=-1):
+        block = self._raw_stream.read(_DOWNLOAD_BLOCK_SIZE if size is None or size < 0 else size)
+        self._csv_file.write(block)
+        return block
+
+
+def parquet_cache_path(csv_file_path):
+    return os.path.splitext(csv_file_path)[0] + '.parquet'
+
+
+def _iter_parquet_batches(parquet_path, chunksize):
+    parquet_file = pq.ParquetFile(parquet_path, memory_map=True)
+    for record_batch in parquet_file.iter_batches(batch_size=chunksize):
+        yield record_batch.to_pandas()
+
+
+def _open_export_stream(full_api_url):
+    # Retries and throttling cover the request up to the response headers; once rows
+    # have been yielded downstream, a dropped stream cannot be retried transparently.
+    def export_attempt():
+        response = requests.get(full_api_url, allow_redirects=True, stream=True,
+                                timeout=(PROSPECT_EXPORT_CONNECT_TIMEOUT_SECONDS, PROSPECT_EXPORT_READ_TIMEOUT_SECONDS))
+        return response.status_code, response.headers, response
+    return get_request_controller().send(full_api_url, export_attempt, retry_exceptions=(requests.ConnectionError, requests.Timeout))
+
+
+def _iter_streamed_csv_batches(full_api_url, csv_file_path, chunksize, write_parquet, logger):
+    parquet_path = parquet_cache_path(csv_file_path)
+    partial_parquet_path = parquet_path + '.partial'
+    parquet_writer = None
+    completed = False
+    with _open_export_stream(full_api_url) as response:
+        response.raise_for_status()
+        response.raw.decode_content = True
+        with open(csv_file_path, 'wb+') as csv_file:
+            try:
+                for prospect_batch_df in pd.read_csv(_TeeReader(response.raw, csv_file), chunksize=chunksize):
+                    if write_parquet:
+                        try:
+                            batch_table = pa.Table.from_pandas(prospect_batch_df, preserve_index=False)
+                            if parquet_writer is None:
+                                parquet_writer = pq.ParquetWriter(partial_parquet_path, batch_table.schema)
+                            else:
+                                batch_table = batch_table.cast(parquet_writer.schema)
+                            parquet_writer.write_table(batch_table)
+                        except (pa.ArrowException, ValueError) as e:
+                            # Type inference can differ between chunks (e.g. an all-null
+                            # column); the CSV is still complete, only the cache is skipped.
+                            logger.warning(f'Parquet cache disabled for {csv_file_path}: {e!r}')
+                            write_parquet = False
+                    yield prospect_batch_df
+                completed = True
+            finally:
+                if parquet_writer is not None:
+                    parquet_writer.close()
+                if completed and write_parquet and parquet_writer is not None:
+                    os.replace(partial_parquet_path, parquet_path)
+                    logger.info(f'Parsed prospect export cached at {parquet_path}.')
+                elif os.path.exists(partial_parquet_path):
+                    os.remove(partial_parquet_path)
+    return
+
+
+def stream_prospect_batches(full_api_url, csv_file_path, logger_name, chunksize=None, use_cache=False, write_parquet=True):
+    """
+    Yield the chatbot prospect export in batches of rows while it downloads.
+
+    The response body is streamed to csv_file_path and parsed with a chunked read_csv in
+    the same pass, so downstream work can start on the first batch before the last byte
+    arrives. The parsed rows are also written to a Parquet file next to the CSV.
+
+    Parameters
+    ----------
+    full_api_url : str
+        Export url from build_url.
+    csv_file_path : str
+        Where to save the raw CSV export.
+    logger_name : str
+        Name of the parent logger.
+    chunksize : int, optional
+        Rows per batch. The default is the PROSPECT_CSV_CHUNK_SIZE environment variable,
+        or 2000.
+    use_cache : bool, optional
+        Read from a previously written Parquet cache of this export instead of downloading
+        it, when one exists. Only use this for exports that can no longer change, such as
+        past months. The default is False.
+    write_parquet : bool, optional
+        Write the Parquet cache while streaming. The default is True.
+
+    Yields
+    ------
+    prospect_batch_df : Pandas DataFrame
+        Up to chunksize prospect rows.
+
+    """
+    logger = logging.getLogger(f'{logger_name}.stream_prospect_batches')
+    if chunksize is None:
+        chunksize = PROSPECT_CSV_CHUNK_SIZE
+    parquet_path = parquet_cache_path(csv_file_path)
+    if use_cache and os.path.exists(parquet_path):
+        logger.info(f'Reading prospect export from Parquet cache {parquet_path}.')
+        yield from _iter_parquet_batches(parquet_path, chunksize)
+        return
+    logger.info(f'Streaming prospect export from {full_api_url}.')
+    yield from _iter_streamed_csv_batches(full_api_url, csv_file_path, chunksize, write_parquet, logger)
+    return
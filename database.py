@@ -0,0 +1,427 @@
+import os
+import uuid
+import atexit
+import argparse
+import logging
+import threading
+import urllib
+import pandas as pd
+from dotenv import load_dotenv
+from sqlalchemy import MetaData, Table, and_, create_engine, inspect, or_, select, text
+from sqlalchemy.engine import make_url
+from sqlalchemy.exc import SQLAlchemyError
+from sqlalchemy.types import BIGINT, INTEGER, VARCHAR, DATETIME, BOOLEAN, FLOAT, BigInteger, Boolean, DateTime, Float, Text
+from metrics import timed
+
+
+load_dotenv('.env')
+SQL_UPSERT_BATCH_SIZE = int(os.getenv('SQL_UPSERT_BATCH_SIZE', 50000))
+SQL_POOL_SIZE = int(os.getenv('SQL_POOL_SIZE', 5))
+SQL_POOL_MAX_OVERFLOW = int(os.getenv('SQL_POOL_MAX_OVERFLOW', 10))
+SQL_POOL_TIMEOUT_SECONDS = int(os.getenv('SQL_POOL_TIMEOUT_SECONDS', 30))
+SQL_POOL_RECYCLE_SECONDS = int(os.getenv('SQL_POOL_RECYCLE_SECONDS', 1800))
+# Schema of the transcript tables. Set SQL_SCHEMA to an empty string for stand-in
+# databases such as SQLite that have no dbo schema.
+SQL_SCHEMA = os.getenv('SQL_SCHEMA', 'dbo') or None
+# One row per transcript, and one row per message joined to it on transcript.
+SQL_PROSPECTS_TABLE_NAME = os.getenv('SQL_PROSPECTS_TABLE_NAME', 'chatbot_prospects')
+SQL_MESSAGES_TABLE_NAME = os.getenv('SQL_MESSAGES_TABLE_NAME', 'chatbot_messages')
+# The original single table, every prospect column repeated on every message. Only read
+# by migrate_legacy_transcript_table.
+SQL_LEGACY_TABLE_NAME = os.getenv('SQL_TABLE_NAME')
+SQL_MIGRATION_CHUNK_SIZE = int(os.getenv('SQL_MIGRATION_CHUNK_SIZE', 50000))
+
+MESSAGE_SQL_DTYPES = {'id': BIGINT,
+                      'timeCreated': DATETIME,
+                      'isInbound': BOOLEAN,
+                      'messageType': VARCHAR(250, collation="SQL_Latin1_General_CP1_CI_AS"),
+                      'messageStatus': VARCHAR(250, collation="SQL_Latin1_General_CP1_CI_AS"),
+                      'classification': VARCHAR(250, collation="SQL_Latin1_General_CP1_CI_AS"),
+                      'routedTo': VARCHAR(250, collation="SQL_Latin1_General_CP1_CI_AS"),
+                      'leasingAttributionSource': VARCHAR(250, collation="SQL_Latin1_General_CP1_CI_AS"),
+                      'leasingAttributionSourceDisplayName': VARCHAR(250, collation="SQL_Latin1_General_CP1_CI_AS"),
+                      'addressFrom': VARCHAR(250, collation="SQL_Latin1_General_CP1_CI_AS"),
+                      'addressTo': VARCHAR(250, collation="SQL_Latin1_General_CP1_CI_AS"),
+                      'censoredShortBody': VARCHAR(250, collation="SQL_Latin1_General_CP1_CI_AS"),
+                      'censoredTranslatedShortBody': VARCHAR(250, collation="SQL_Latin1_General_CP1_CI_AS"),
+                      'isIlsInbound': BOOLEAN,
+                      'mediaUrl': VARCHAR(250, collation="SQL_Latin1_General_CP1_CI_AS"),
+                      'transcript': VARCHAR(250, collation="SQL_Latin1_General_CP1_CI_AS"),
+                      'no_stopwords_message_text': VARCHAR(250, collation="SQL_Latin1_General_CP1_CI_AS"),
+                      # Only present when the transformer sentiment backend is enabled.
+                      'sentiment_label_TF': VARCHAR(250, collation="SQL_Latin1_General_CP1_CI_AS"),
+                      'sentiment_polarity_TF': FLOAT,
+                      'sentiment_pos_probability_TF': FLOAT}
+
+PROSPECT_SQL_DTYPES = {'property': VARCHAR(250, collation="SQL_Latin1_General_CP1_CI_AS"),
+                       'timeFirstMessage': DATETIME,
+                       'firstName': VARCHAR(250, collation="SQL_Latin1_General_CP1_CI_AS"),
+                       'lastName': VARCHAR(250, collation="SQL_Latin1_General_CP1_CI_AS"),
+                       'email': VARCHAR(250, collation="SQL_Latin1_General_CP1_CI_AS"),
+                       'phone': VARCHAR(250, collation="SQL_Latin1_General_CP1_CI_AS"),
+                       'channel': VARCHAR(250, collation="SQL_Latin1_General_CP1_CI_AS"),
+                       'source': VARCHAR(250, collation="SQL_Latin1_General_CP1_CI_AS"),
+                       'unitTypes': VARCHAR(250, collation="SQL_Latin1_General_CP1_CI_AS"),
+                       'tourType': VARCHAR(250, collation="SQL_Latin1_General_CP1_CI_AS"),
+                       'qualified': BOOLEAN,
+                       'timeLastMessage': DATETIME,
+                       'conversationLengthInSeconds': BIGINT,
+                       'countInboundMessages': INTEGER,
+                       'countOutboundMessages': INTEGER,
+                       'countCallsAttempted': INTEGER,
+                       'countShowingsOffered': INTEGER,
+                       'countShowingsRejected': INTEGER,
+                       'countShowingsAccepted': INTEGER,
+                       'countShowingsConfirmationSent': INTEGER,
+                       'countShowingsConfirmed': INTEGER,
+                       'countShowingsCanceledByProspect': INTEGER,
+                       'countShowingsCanceledByLisa': INTEGER,
+                       'lastAcceptedShowingId': BIGINT,
+                       'isAcceptedShowingInPast': BOOLEAN,
+                       'propertyCode': BIGINT,
+                       'prospectCode': BIGINT,
+                       'createdProspectSource': VARCHAR(250, collation="SQL_Latin1_General_CP1_CI_AS"),
+                       'transcript': VARCHAR(250, collation="SQL_Latin1_General_CP1_CI_AS"),
+                       'plannedNextMessage': BOOLEAN,
+                       'applicationStatus': VARCHAR(250, collation="SQL_Latin1_General_CP1_CI_AS")}
+
+
+_ENGINES = {}
+_REFLECTED_TABLES = {}
+_ENGINE_LOCK = threading.Lock()
+
+
+def build_engine_url():
+    """
+    Return the SQLAlchemy url of the transcript database: SQL_ENGINE_URL when set (used
+    to point the app at a SQLite or Postgres stand-in), otherwise the SQL Server ODBC
+    connection string in SQL_CONNECTION_STRING.
+    """
+    sql_engine_url = os.getenv('SQL_ENGINE_URL')
+    if sql_engine_url:
+        return sql_engine_url
+    quoted = urllib.parse.quote_plus(os.getenv('SQL_CONNECTION_STRING'))
+    return 'mssql+pyodbc:///?odbc_connect={}'.format(quoted)
+
+
+def get_engine():
+    """
+    Return this process's pooled engine, creating it on first use. Engines are kept per
+    process id because pooled connections must not be shared across a fork.
+
+    Pool settings come from SQL_POOL_SIZE, SQL_POOL_MAX_OVERFLOW, SQL_POOL_TIMEOUT_SECONDS
+    and SQL_POOL_RECYCLE_SECONDS. Connections are pre-pinged on checkout so a connection
+    dropped by the server is replaced instead of failing the request.
+    """
+    engine = _ENGINES.get(os.getpid())
+    if engine is not None:
+        return engine
+    with _ENGINE_LOCK:
+        engine = _ENGINES.get(os.getpid())
+        if engine is None:
+            engine_url = build_engine_url()
+            engine_kwargs = {'pool_pre_ping': True}
+            backend_name = make_url(engine_url).get_backend_name()
+            if backend_name != 'sqlite':
+                engine_kwargs.update(pool_size=SQL_POOL_SIZE,
+                                     max_overflow=SQL_POOL_MAX_OVERFLOW,
+                                     pool_timeout=SQL_POOL_TIMEOUT_SECONDS,
+                                     pool_recycle=SQL_POOL_RECYCLE_SECONDS)
+            if backend_name == 'mssql':
+                engine_kwargs['fast_executemany'] = True
+            engine = create_engine(engine_url, **engine_kwargs)
+            _ENGINES[os.getpid()] = engine
+    return engine
+
+
+def get_table(table_name, schema=SQL_SCHEMA):
+    """
+    Return the reflected Table for table_name, reflecting it only the first time it is
+    requested in this process.
+    """
+    table_key = (os.getpid(), schema, table_name)
+    table = _REFLECTED_TABLES.get(table_key)
+    if table is None:
+        # get_engine takes _ENGINE_LOCK itself, so the engine is fetched before it is held.
+        engine = get_engine()
+        with _ENGINE_LOCK:
+            table = _REFLECTED_TABLES.get(table_key)
+            if table is None:
+                table = Table(table_name, MetaData(), schema=schema, autoload_with=engine)
+                _REFLECTED_TABLES[table_key] = table
+    return table
+
+
+def has_table(table_name, schema=SQL_SCHEMA):
+    # Asks the database each time, so a table created by another process is seen.
+    return inspect(get_engine()).has_table(table_name, schema=schema)
+
+
+def forget_table(table_name, schema=SQL_SCHEMA):
+    # Call after altering a table so the next get_table reflects the new layout.
+    _REFLECTED_TABLES.pop((os.getpid(), schema, table_name), None)
+    return
+
+
+def check_database_health(logger_name):
+    """
+    Run a trivial query on a pooled connection.
+
+    Returns
+    -------
+    healthy : bool
+        True if the database answered.
+
+    """
+    logger = logging.getLogger(f'{logger_name}.check_database_health')
+    try:
+        with get_engine().connect() as connection:
+            connection.execute(text('SELECT 1'))
+    except SQLAlchemyError as e:
+        logger.error(f'Database health check failed: {e!r}')
+        return False
+    return True
+
+
+def dispose_engine():
+    # Close this process's pooled connections. Registered with atexit below, so the
+    # app, the daily job and the backfill workers all release their connections on
+    # shutdown instead of leaving them for the server to time out.
+    engine = _ENGINES.pop(os.getpid(), None)
+    if engine is not None:
+        engine.dispose()
+    for table_key in [table_key for table_key in _REFLECTED_TABLES if table_key[0] == os.getpid()]:
+        del _REFLECTED_TABLES[table_key]
+    return
+
+
+atexit.register(dispose_engine)
+
+
+def _qualified_name(engine, table_name, schema):
+    quote = engine.dialect.identifier_preparer.quote
+    return f'{quote(schema)}.{quote(table_name)}' if schema else quote(table_name)
+
+
+def _dialect_dtype(engine, dtype):
+    # The collated VARCHARs only exist on SQL Server; SQLite/Postgres stand-ins take
+    # pandas' inferred types instead, except for integers, whose inferred type follows
+    # the batch's downcast dtype and could be too narrow for later rows.
+    if engine.dialect.name == 'mssql' or dtype is None:
+        return dtype
+    return {column: column_type for column, column_type in dtype.items() if column_type in (BIGINT, INTEGER)} or None
+
+
+def _ensure_target_table(engine, df, table_name, schema, key_columns, dtype):
+    if inspect(engine).has_table(table_name, schema=schema):
+        return
+    df.head(0).to_sql(name=table_name, schema=schema, con=engine, index=False, dtype=_dialect_dtype(engine, dtype))
+    quote = engine.dialect.identifier_preparer.quote
+    index_name = quote(f'ux_{table_name}_{"_".join(key_columns)}')
+    with engine.begin() as connection:
+        connection.execute(text(f'CREATE UNIQUE INDEX {index_name} ON {_qualified_name(engine, table_name, schema)} '
+                                f'({", ".join(quote(column) for column in key_columns)})'))
+    return
+
+
+def _inferred_sql_type(series):
+    if pd.api.types.is_bool_dtype(series.dtype):
+        return Boolean()
+    if pd.api.types.is_integer_dtype(series.dtype):
+        return BigInteger()
+    if pd.api.types.is_float_dtype(series.dtype):
+        return Float()
+    if pd.api.types.is_datetime64_any_dtype(series.dtype):
+        return DateTime()
+    return Text()
+
+
+def _add_missing_columns(engine, df, table_name, schema, dtype, logger):
+    # Columns a newer pipeline adds, such as the transformer sentiment scores, are
+    # added to an existing table instead of failing the merge.
+    existing_columns = {column['name'] for column in inspect(engine).get_columns(table_name, schema=schema)}
+    missing_columns = [column for column in df.columns if column not in existing_columns]
+    if not missing_columns:
+        return
+    column_types = _dialect_dtype(engine, dtype) or {}
+    quote = engine.dialect.identifier_preparer.quote
+    with engine.begin() as connection:
+        for column in missing_columns:
+            column_type = column_types.get(column)
+            column_type = column_type() if isinstance(column_type, type) else column_type
+            if column_type is None:
+                column_type = _inferred_sql_type(df[column])
+            connection.execute(text(f'ALTER TABLE {_qualified_name(engine, table_name, schema)} '
+                                    f'ADD {quote(column)} {column_type.compile(dialect=engine.dialect)}'))
+    forget_table(table_name, schema=schema)
+    logger.info(f'Added columns {missing_columns} to {table_name}.')
+    return
+
+
+def _build_merge_statement(engine, target_name, staging_name, columns, key_columns):
+    quote = engine.dialect.identifier_preparer.quote
+    quoted_columns = [quote(column) for column in columns]
+    update_columns = [quote(column) for column in columns if column not in key_columns]
+    if engine.dialect.name == 'mssql':
+        match_condition = ' AND '.join(f'target.{quote(column)} = staging.{quote(column)}' for column in key_columns)
+        return (f'MERGE INTO {target_name} WITH (HOLDLOCK) AS target '
+                f'USING {staging_name} AS staging ON {match_condition} '
+                f'WHEN MATCHED THEN UPDATE SET {", ".join(f"target.{column} = staging.{column}" for column in update_columns)} '
+                f'WHEN NOT MATCHED THEN INSERT ({", ".join(quoted_columns)}) '
+                f'VALUES ({", ".join(f"staging.{column}" for column in quoted_columns)});')
+    # SQLite and Postgres share INSERT ... ON CONFLICT. "WHERE true" keeps SQLite from
+    # reading ON CONFLICT as part of the SELECT's join clause.
+    conflict_action = (f'DO UPDATE SET {", ".join(f"{column} = excluded.{column}" for column in update_columns)}'
+                       if update_columns else 'DO NOTHING')
+    return (f'INSERT INTO {target_name} ({", ".join(quoted_columns)}) '
+            f'SELECT {", ".join(quoted_columns)} FROM {staging_name} WHERE true '
+            f'ON CONFLICT ({", ".join(quote(column) for column in key_columns)}) {conflict_action}')
+
+
+def bulk_upsert_dataframe(df, engine, table_name, logger_name, key_columns=('id',), schema=None, dtype=None, batch_size=None):
+    """
+    Upsert df into table_name in batches. Each batch is bulk inserted into a private
+    staging table with one executemany call, then merged into the target table with a
+    single set-based MERGE (SQL Server) or INSERT ... ON CONFLICT (SQLite/Postgres),
+    and committed. Re-loading the same rows updates them in place instead of
+    appending duplicates.
+
+    Parameters
+    ----------
+    df : Pandas DataFrame
+        Rows to load. Rows repeating a key keep the last occurrence.
+    engine : sqlalchemy.engine.Engine
+        Target database. For SQL Server, create it with fast_executemany=True.
+    table_name : str
+        Target table. It is created, with a unique index on key_columns, if missing,
+        and columns of df it lacks are added to it.
+    logger_name : str
+        Name of the parent logger.
+    key_columns : tuple of str, optional
+        Columns that identify a row. The default is ('id',).
+    schema : str, optional
+        Schema of the target table. The default is None.
+    dtype : dict, optional
+        Column types used on SQL Server when creating tables. The default is None.
+    batch_size : int, optional
+        Rows per staging batch and commit. The default is the SQL_UPSERT_BATCH_SIZE
+        environment variable, or 50000.
+
+    Returns
+    -------
+    rows_loaded : int
+        Number of distinct rows merged into the target table.
+
+    """
+    logger = logging.getLogger(f'{logger_name}.bulk_upsert_dataframe')
+    if batch_size is None:
+        batch_size = SQL_UPSERT_BATCH_SIZE
+    key_columns = list(key_columns)
+    df = df.drop_duplicates(subset=key_columns, keep='last')
+    if df.empty:
+        return 0
+    _ensure_target_table(engine, df, table_name, schema, key_columns, dtype)
+    _add_missing_columns(engine, df, table_name, schema, dtype, logger)
+    staging_table_name = f'{table_name}_staging_{uuid.uuid4().hex[:12]}'
+    df.head(0).to_sql(name=staging_table_name, schema=schema, con=engine, index=False, dtype=_dialect_dtype(engine, dtype))
+    try:
+        staging_table = Table(staging_table_name, MetaData(), schema=schema, autoload_with=engine)
+        target_name = _qualified_name(engine, table_name, schema)
+        staging_name = _qualified_name(engine, staging_table_name, schema)
+        merge_statement = text(_build_merge_statement(engine, target_name, staging_name, list(df.columns), key_columns))
+        for batch_start in range(0, len(df), batch_size):
+            batch_df = df.iloc[batch_start:batch_start+batch_size]
+            batch_records = batch_df.astype(object).where(batch_df.notna(), None).to_dict('records')
+            with timed('sql_write', items=len(batch_records)), engine.begin() as connection:
+                connection.execute(staging_table.delete())
+                connection.execute(staging_table.insert(), batch_records)
+                connection.execute(merge_statement)
+            logger.info(f'Merged rows {batch_start} to {batch_start+len(batch_df)} of {len(df)} into {table_name}.')
+    finally:
+        staging_table_drop = Table(staging_table_name, MetaData(), schema=schema)
+        staging_table_drop.drop(engine, checkfirst=True)
+    return len(df)
+
+
+def migrate_legacy_transcript_table(logger_name, legacy_table_name=SQL_LEGACY_TABLE_NAME, schema=SQL_SCHEMA, chunksize=SQL_MIGRATION_CHUNK_SIZE):
+    """
+    Copy the rows of the original single transcript table into the prospects and
+    messages tables. Rows are read in timeCreated order, so each transcript's prospect
+    row ends up with the values from its latest message. The legacy table is left
+    untouched and the copy can be re-run, since both tables are upserted.
+
+    Parameters
+    ----------
+    logger_name : str
+        Name of the parent logger.
+    legacy_table_name : str, optional
+        The single table to copy from. The default is the SQL_TABLE_NAME environment
+        variable.
+    schema : str, optional
+        Schema of all three tables. The default is SQL_SCHEMA.
+    chunksize : int, optional
+        Legacy rows read per chunk. The default is the SQL_MIGRATION_CHUNK_SIZE
+        environment variable, or 50000.
+
+    Returns
+    -------
+    migrated_rows : int
+        Number of legacy rows read.
+
+    """
+    logger = logging.getLogger(f'{logger_name}.migrate_legacy_transcript_table')
+    if not legacy_table_name:
+        raise ValueError('No legacy table given. Set SQL_TABLE_NAME or pass legacy_table_name.')
+    engine = get_engine()
+    legacy_table = get_table(legacy_table_name, schema=schema)
+    legacy_statement = select(legacy_table).order_by(legacy_table.c.timeCreated, legacy_table.c.id).limit(chunksize)
+    migrated_rows = 0
+    while True:
+        # Each chunk is read on its own connection and continues after the last row
+        # read, so no cursor is left open on the legacy table while the upserts write.
+        chunk_statement = legacy_statement
+        if migrated_rows:
+            chunk_statement = legacy_statement.where(or_(legacy_table.c.timeCreated > last_time_created,
+                                                         and_(legacy_table.c.timeCreated == last_time_created,
+                                                              legacy_table.c.id > last_id)))
+        with engine.connect() as connection:
+            legacy_df = pd.read_sql(chunk_statement, connection)
+        if legacy_df.empty:
+            break
+        last_time_created, last_id = legacy_df['timeCreated'].iloc[-1], int(legacy_df['id'].iloc[-1])
+        for column, column_type in {**MESSAGE_SQL_DTYPES, **PROSPECT_SQL_DTYPES}.items():
+            if column_type is DATETIME and column in legacy_df.columns:
+                legacy_df[column] = pd.to_datetime(legacy_df[column])
+        prospect_columns = [column for column in legacy_df.columns if column in PROSPECT_SQL_DTYPES]
+        message_columns = [column for column in legacy_df.columns if column not in PROSPECT_SQL_DTYPES or column == 'transcript']
+        bulk_upsert_dataframe(legacy_df[prospect_columns],
+                              engine,
+                              SQL_PROSPECTS_TABLE_NAME,
+                              logger_name=logger_name,
+                              key_columns=('transcript',),
+                              schema=schema,
+                              dtype=PROSPECT_SQL_DTYPES)
+        bulk_upsert_dataframe(legacy_df[message_columns],
+                              engine,
+                              SQL_MESSAGES_TABLE_NAME,
+                              logger_name=logger_name,
+                              key_columns=('id',),
+                              schema=schema,
+                              dtype=MESSAGE_SQL_DTYPES)
+        migrated_rows += len(legacy_df)
+        logger.info(f'Migrated {migrated_rows} rows from {legacy_table_name}.')
+    return migrated_rows
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Copy the legacy single transcript table into the prospects and messages tables.')
+    parser.add_argument('--legacy-table', default=SQL_LEGACY_TABLE_NAME, help='The default is SQL_TABLE_NAME.')
+    parser.add_argument('--chunksize', type=int, default=SQL_MIGRATION_CHUNK_SIZE)
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    migrate_legacy_transcript_table('chatbot_prospect_migration', legacy_table_name=args.legacy_table, chunksize=args.chunksize)
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -4,6 +4,7 @@ import datarobot as dr
 from datarobot.models.modeljob import wait_for_async_model_creation
 import pandas as pd
 from IPython.display import display
+from datarobot_scoring import score_prospects
 #import matplotlib.pyplot as plt
 #%matplotlib inline
 
@@ -20,9 +21,16 @@ def load_environment_and_client():
     return
 
 
-def load_datasets():
+def load_datasets(labels_df=None, scoring_since_day=None):
     # Set to the location of your project.csv and project-test.csv data files
     # Example: dataset_file_path = '/Users/myuser/Downloads/project-test.csv'
+    # Or set DR_FEATURE_STORE_LABELS_FILEPATH (or pass labels_df) to a table of transcript,
+    # as_of and signed_contract, to build both datasets from the feature store instead
+    labels_file_path = os.getenv('DR_FEATURE_STORE_LABELS_FILEPATH')
+    if labels_df is None and labels_file_path:
+        labels_df = pd.read_csv(labels_file_path)
+    if labels_df is not None:
+        return load_feature_store_datasets(labels_df, scoring_since_day=scoring_since_day)
     train_dataset_file_path = os.getenv('DR_TRAIN_DATASET_FILEPATH')
     test_dataset_file_path = os.getenv('DR_TEST_DATASET_FILEPATH')
 
@@ -35,6 +43,23 @@ def load_datasets():
     return train_dataset, test_dataset
 
 
+def load_feature_store_datasets(labels_df, scoring_since_day=None):
+    # Training rows get the features each transcript had at its as_of time; the test rows are
+    # every transcript active since scoring_since_day (default yesterday), as of now
+    from feature_store import get_feature_store
+    feature_store = get_feature_store()
+    training_data_df = feature_store.feature_snapshot(labels_df)
+    now = pd.Timestamp.now(tz='UTC')
+    if scoring_since_day is None:
+        scoring_since_day = (now - pd.Timedelta(days=1)).strftime('%Y-%m-%d')
+    scoring_entities_df = pd.DataFrame({'transcript': feature_store.active_transcripts(scoring_since_day)})
+    scoring_entities_df['as_of'] = now
+    test_data_df = feature_store.feature_snapshot(scoring_entities_df)
+    train_dataset = dr.Dataset.create_from_in_memory_data(training_data_df)
+    test_dataset = dr.Dataset.create_from_in_memory_data(test_data_df)
+    return train_dataset, test_dataset
+
+
 def create_project_and_target(training_dataset):
     # Create a new project based on dataset
     project = dr.Project.create_from_dataset(training_dataset.id, project_name=f'Prospect_Sentiment')
@@ -106,6 +131,17 @@ def predict_against_model(project, model, test_dataset):
     return predictions
 
 
+def predict_against_deployment(deployment, prospects_df, feature_columns=None, logger_name='datarobot'):
+    # Score through the deployment's real-time prediction API in concurrent gzipped chunks,
+    # skipping prospects whose features already have a cached prediction from this model
+    prediction_server = deployment.default_prediction_server
+    predictions_df = score_prospects(prospects_df, deployment.id, deployment.model['id'], logger_name,
+                                     feature_columns=feature_columns,
+                                     url_base=prediction_server['url'],
+                                     datarobot_key=prediction_server.get('datarobot-key'))
+    return predictions_df
+
+
 def main():
     load_environment_and_client()
     train_dataset, test_dataset = load_datasets()
@@ -0,0 +1,200 @@
+import asyncio
+import aiohttp
+import gzip
+import os
+import time
+import logging
+import pandas as pd
+from dotenv import load_dotenv
+from metrics import counter, timed
+from prediction_cache import get_prediction_cache, hash_prospect_features
+
+
+load_dotenv('.env')
+# Prediction server of the deployment, e.g. https://example.orm.datarobot.com. Point it
+# at benchmarks.prediction_standin to test without DataRobot.
+DATAROBOT_PREDICTION_URL_BASE = os.getenv('DATAROBOT_PREDICTION_URL_BASE', '')
+DATAROBOT_SCORING_CHUNK_ROWS = int(os.getenv('DATAROBOT_SCORING_CHUNK_ROWS', 1000))
+DATAROBOT_SCORING_MAX_IN_FLIGHT = int(os.getenv('DATAROBOT_SCORING_MAX_IN_FLIGHT', 4))
+DATAROBOT_SCORING_MAX_REQUESTS_PER_SECOND = float(os.getenv('DATAROBOT_SCORING_MAX_REQUESTS_PER_SECOND', 10))
+DATAROBOT_SCORING_TIMEOUT_SECONDS = float(os.getenv('DATAROBOT_SCORING_TIMEOUT_SECONDS', 600))
+
+PREDICTION_ROWS = counter('datarobot_prediction_rows_total', 'Prospect rows predicted, by whether the prediction came from the cache or was scored.')
+
+
+class DataRobotScoringError(RuntimeError):
+    pass
+
+
+def build_prediction_url(deployment_id, url_base=None):
+    if url_base is None:
+        url_base = DATAROBOT_PREDICTION_URL_BASE
+    return f'{url_base.rstrip("/")}/predApi/v1.0/deployments/{deployment_id}/predictions'
+
+
+class _RateLimiter:
+    """
+    Spaces request starts at least 1 / max_per_second apart across every coroutine
+    sharing it. A max_per_second of 0 or less disables the cap.
+    """
+
+    def __init__(self, max_per_second):
+        self._interval = 1 / max_per_second if max_per_second > 0 else 0
+        self._next_start = 0.0
+        self._lock = asyncio.Lock()
+
+    async def wait(self):
+        async with self._lock:
+            now = time.monotonic()
+            delay = self._next_start - now
+            self._next_start = max(now, self._next_start) + self._interval
+        if delay > 0:
+            await asyncio.sleep(delay)
+        return
+
+
+def _parse_prediction_rows(response_json, row_count):
+    # rowId is the row's position in the uploaded chunk.
+    predictions = [None] * row_count
+    for prediction_row in response_json['data']:
+        predictions[prediction_row['rowId']] = {'prediction': prediction_row['prediction'],
+                                                'values': {str(prediction_value['label']): prediction_value['value']
+                                                           for prediction_value in prediction_row.get('predictionValues', [])}}
+    if any(prediction is None for prediction in predictions):
+        raise DataRobotScoringError(f'Prediction response covered {len(response_json["data"])} of {row_count} rows.')
+    return predictions
+
+
+async def _score_chunk(session, semaphore, rate_limiter, prediction_url, request_headers, chunk_df, on_chunk_scored, logger):
+    # Compressing before taking a slot keeps the CPU work off the request critical path.
+    request_body = gzip.compress(chunk_df.to_csv(index=False).encode('utf-8'), compresslevel=6)
+    async with semaphore:
+        await rate_limiter.wait()
+        request_start_time = time.perf_counter()
+        async with session.post(prediction_url, data=request_body, headers=request_headers) as response:
+            if response.status != 200:
+                response_text = await response.text()
+                raise DataRobotScoringError(f'Prediction request failed with HTTP {response.status}: {response_text[:500]}')
+            response_json = await response.json(content_type=None)
+    logger.debug('Scored %s rows in %.3fs.', len(chunk_df), time.perf_counter() - request_start_time)
+    predictions = _parse_prediction_rows(response_json, len(chunk_df))
+    on_chunk_scored(predictions)
+    return predictions
+
+
+async def _score_chunks(chunk_frames, prediction_url, request_headers, max_in_flight, max_requests_per_second, on_chunk_scored, logger):
+    connector = aiohttp.TCPConnector(limit=max_in_flight)
+    timeout = aiohttp.ClientTimeout(total=DATAROBOT_SCORING_TIMEOUT_SECONDS)
+    semaphore = asyncio.Semaphore(max_in_flight)
+    rate_limiter = _RateLimiter(max_requests_per_second)
+    async with aiohttp.ClientSession(connector=connector, timeout=timeout) as session:
+        # gather returns the chunk results in submission order, whatever order they finish in.
+        return await asyncio.gather(*(_score_chunk(session, semaphore, rate_limiter, prediction_url, request_headers,
+                                                   chunk_df, lambda predictions, chunk_index=chunk_index: on_chunk_scored(chunk_index, predictions), logger)
+                                      for chunk_index, chunk_df in enumerate(chunk_frames)),
+                                    return_exceptions=True)
+
+
+def _predictions_to_frame(predictions, index):
+    value_labels = list(dict.fromkeys(label for prediction in predictions for label in prediction['values']))
+    prediction_columns = {'prediction': [prediction['prediction'] for prediction in predictions]}
+    for label in value_labels:
+        prediction_columns[f'prediction_value_{label}'] = [prediction['values'].get(label) for prediction in predictions]
+    return pd.DataFrame(prediction_columns, index=index)
+
+
+def score_prospects(prospects_df, deployment_id, model_id, logger_name, feature_columns=None, url_base=None,
+                    api_token=None, datarobot_key=None, chunk_rows=None, max_in_flight=None,
+                    max_requests_per_second=None, use_cache=True):
+    """
+    Score prospects against a DataRobot deployment's real-time prediction API.
+
+    Prospects whose features already have a cached prediction from model_id are not
+    sent. The rest are deduplicated by feature hash, split into gzipped CSV chunks and
+    posted concurrently, and the predictions are put back in prospects_df's row order.
+    Every chunk is cached as soon as it is scored, so a failed run only re-sends the
+    chunks that failed.
+
+    Parameters
+    ----------
+    prospects_df : Pandas DataFrame
+        One row per prospect.
+    deployment_id : str
+        DataRobot deployment id.
+    model_id : str
+        Id of the model currently behind the deployment, part of the cache key.
+    logger_name : str
+        Name of the parent logger.
+    feature_columns : list of str, optional
+        Columns to send and hash. The default is every column of prospects_df.
+    url_base : str, optional
+        Prediction server url. The default is DATAROBOT_PREDICTION_URL_BASE.
+    api_token, datarobot_key : str, optional
+        Credentials. The defaults are the DATAROBOT_API_TOKEN and DATAROBOT_KEY
+        environment variables. Neither header is sent when unset.
+    chunk_rows : int, optional
+        Rows per request. The default is DATAROBOT_SCORING_CHUNK_ROWS, or 1000.
+    max_in_flight : int, optional
+        Most concurrent requests. The default is DATAROBOT_SCORING_MAX_IN_FLIGHT, or 4.
+    max_requests_per_second : float, optional
+        Cap on request starts per second, 0 for none. The default is
+        DATAROBOT_SCORING_MAX_REQUESTS_PER_SECOND, or 10.
+    use_cache : bool, optional
+        Read and write the process's PredictionCache. The default is True.
+
+    Returns
+    -------
+    predictions_df : Pandas DataFrame
+        A 'prediction' column and one 'prediction_value_<label>' column per class,
+        indexed like prospects_df.
+
+    """
+    logger = logging.getLogger(f'{logger_name}.score_prospects')
+    if chunk_rows is None:
+        chunk_rows = DATAROBOT_SCORING_CHUNK_ROWS
+    if max_in_flight is None:
+        max_in_flight = DATAROBOT_SCORING_MAX_IN_FLIGHT
+    if max_requests_per_second is None:
+        max_requests_per_second = DATAROBOT_SCORING_MAX_REQUESTS_PER_SECOND
+    if api_token is None:
+        api_token = os.getenv('DATAROBOT_API_TOKEN')
+    if datarobot_key is None:
+        datarobot_key = os.getenv('DATAROBOT_KEY')
+    features_df = prospects_df if feature_columns is None else prospects_df[list(feature_columns)]
+    with timed('prediction_scoring', items=len(features_df)):
+        feature_hashes = hash_prospect_features(features_df)
+        prediction_cache = get_prediction_cache() if use_cache else None
+        predictions = prediction_cache.get_many(feature_hashes, model_id) if prediction_cache is not None else [None] * len(feature_hashes)
+        # One request row per distinct uncached feature hash.
+        missed_positions = {}
+        for position, (feature_hash, prediction) in enumerate(zip(feature_hashes, predictions)):
+            if prediction is None and feature_hash not in missed_positions:
+                missed_positions[feature_hash] = position
+        PREDICTION_ROWS.inc(len(feature_hashes) - len(missed_positions), source='cache')
+        if missed_positions:
+            missed_hashes = list(missed_positions)
+            missed_df = features_df.iloc[list(missed_positions.values())]
+            chunk_frames = [missed_df.iloc[chunk_start:chunk_start+chunk_rows] for chunk_start in range(0, len(missed_df), chunk_rows)]
+            request_headers = {'Content-Type': 'text/csv; charset=UTF-8', 'Content-Encoding': 'gzip'}
+            if api_token:
+                request_headers['Authorization'] = f'Bearer {api_token}'
+            if datarobot_key:
+                request_headers['DataRobot-Key'] = datarobot_key
+
+            def on_chunk_scored(chunk_index, chunk_predictions):
+                PREDICTION_ROWS.inc(len(chunk_predictions), source='scored')
+                if prediction_cache is not None:
+                    prediction_cache.put_many(missed_hashes[chunk_index*chunk_rows:(chunk_index+1)*chunk_rows], model_id, chunk_predictions)
+                return
+
+            logger.info(f'Scoring {len(missed_df)} of {len(features_df)} prospects in {len(chunk_frames)} chunks.')
+            chunk_results = asyncio.run(_score_chunks(chunk_frames, build_prediction_url(deployment_id, url_base), request_headers,
+                                                      max_in_flight, max_requests_per_second, on_chunk_scored, logger))
+            chunk_errors = [chunk_result for chunk_result in chunk_results if isinstance(chunk_result, BaseException)]
+            if chunk_errors:
+                raise DataRobotScoringError(f'{len(chunk_errors)} of {len(chunk_frames)} prediction chunks failed; '
+                                            f'the scored chunks are cached. First error: {chunk_errors[0]!r}')
+            scored_by_hash = dict(zip(missed_hashes, (prediction for chunk_predictions in chunk_results for prediction in chunk_predictions)))
+            predictions = [prediction if prediction is not None else scored_by_hash[feature_hash]
+                           for feature_hash, prediction in zip(feature_hashes, predictions)]
+    return _predictions_to_frame(predictions, prospects_df.index)
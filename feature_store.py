@@ -0,0 +1,255 @@
+import sqlite3
+import os
+import threading
+from datetime import datetime, timezone
+import pandas as pd
+from dotenv import load_dotenv
+from metrics import timed
+
+
+load_dotenv('.env')
+FEATURE_STORE_DB_PATH = os.getenv('FEATURE_STORE_DB_PATH', os.path.abspath('feature_store.sqlite3'))
+FEATURE_STORE_TREND_DAYS = int(os.getenv('FEATURE_STORE_TREND_DAYS', 7))
+_SQLITE_MAX_PARAMETERS = 500
+
+# Message score columns from sentiment_main, and the feature name each is stored under.
+# Only inbound messages are summed: the prospect's sentiment is what predicts a lease.
+FEATURE_SCORE_COLUMNS = {'compound_polarity_VS': 'vader_compound',
+                         'sentiment_polarity_TB_PA': 'textblob_polarity',
+                         'sentiment_pos_percent_TB_NBA': 'textblob_nba_pos',
+                         'sentiment_polarity_TF': 'transformer_polarity'}
+FEATURE_COUNT_COLUMNS = ('message_count', 'inbound_count', 'outbound_count', 'reply_count', 'reply_latency_seconds_sum')
+_SCORE_AGGREGATE_COLUMNS = tuple(f'{feature_name}_{aggregate}' for feature_name in FEATURE_SCORE_COLUMNS.values() for aggregate in ('sum', 'count'))
+
+
+def aggregate_daily_features(messages_df):
+    """
+    Sum one or more complete transcripts' messages into one row per (transcript, day).
+
+    Parameters
+    ----------
+    messages_df : Pandas DataFrame
+        Messages with 'transcript', 'timeCreated' and 'isInbound' columns, and
+        optionally 'id' and the FEATURE_SCORE_COLUMNS sentiment scores.
+
+    Returns
+    -------
+    daily_features_df : Pandas DataFrame
+        One row per transcript and UTC day, with the FEATURE_COUNT_COLUMNS, the first
+        and last message times, and a sum and count column for each score column
+        present in messages_df.
+
+    """
+    if 'id' in messages_df.columns:
+        messages_df = messages_df.drop_duplicates('id')
+    message_times = pd.to_datetime(messages_df['timeCreated'], utc=True, errors='coerce')
+    messages_df = messages_df.assign(_time=message_times).dropna(subset=['_time']).sort_values(['transcript', '_time'], kind='stable')
+    transcripts = messages_df['transcript'].astype(str)
+    is_inbound = messages_df['isInbound'].astype(str).str.lower().eq('true')
+    # A reply is an inbound message straight after an outbound one, timed from it.
+    previous_is_inbound = is_inbound.groupby(transcripts).shift()
+    previous_times = messages_df['_time'].groupby(transcripts).shift()
+    is_reply = is_inbound & previous_is_inbound.eq(False)
+    reply_latency_seconds = (messages_df['_time'] - previous_times).dt.total_seconds().where(is_reply, 0.0)
+    feature_frame = pd.DataFrame({'transcript': transcripts,
+                                  'day': messages_df['_time'].dt.strftime('%Y-%m-%d'),
+                                  'message_count': 1,
+                                  'inbound_count': is_inbound.astype(int),
+                                  'reply_count': is_reply.astype(int),
+                                  'reply_latency_seconds_sum': reply_latency_seconds,
+                                  'first_message_time': messages_df['_time'],
+                                  'last_message_time': messages_df['_time']})
+    aggregations = {'message_count': 'sum', 'inbound_count': 'sum', 'reply_count': 'sum', 'reply_latency_seconds_sum': 'sum',
+                    'first_message_time': 'min', 'last_message_time': 'max'}
+    for score_column, feature_name in FEATURE_SCORE_COLUMNS.items():
+        if score_column in messages_df.columns:
+            inbound_scores = pd.to_numeric(messages_df[score_column], errors='coerce').where(is_inbound)
+            feature_frame[f'{feature_name}_sum'] = inbound_scores.fillna(0.0)
+            feature_frame[f'{feature_name}_count'] = inbound_scores.notna().astype(int)
+            aggregations[f'{feature_name}_sum'] = 'sum'
+            aggregations[f'{feature_name}_count'] = 'sum'
+    daily_features_df = feature_frame.groupby(['transcript', 'day'], sort=False).agg(aggregations).reset_index()
+    daily_features_df['outbound_count'] = daily_features_df['message_count'] - daily_features_df['inbound_count']
+    for time_column in ('first_message_time', 'last_message_time'):
+        daily_features_df[time_column] = daily_features_df[time_column].dt.strftime('%Y-%m-%dT%H:%M:%S.%f%z')
+    return daily_features_df
+
+
+class FeatureStore:
+    """
+    SQLite store of per-transcript daily aggregates, from which point-in-time feature
+    snapshots for any set of (transcript, as-of time) pairs are summed in one query,
+    without going back to the message history.
+
+    Parameters
+    ----------
+    db_path : str, optional
+        Path of the SQLite file. The default is the FEATURE_STORE_DB_PATH environment
+        variable, or feature_store.sqlite3 in the working directory.
+
+    """
+
+    def __init__(self, db_path=None):
+        if db_path is None:
+            db_path = FEATURE_STORE_DB_PATH
+        if db_path != ':memory:':
+            os.makedirs(os.path.dirname(os.path.abspath(db_path)), exist_ok=True)
+        self.db_path = db_path
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(db_path, timeout=30, check_same_thread=False)
+        self._connection.execute('PRAGMA journal_mode=WAL')
+        aggregate_column_definitions = ',\n'.join(f'{column} REAL' for column in FEATURE_COUNT_COLUMNS + _SCORE_AGGREGATE_COLUMNS)
+        self._connection.execute(f'''CREATE TABLE IF NOT EXISTS transcript_daily_features (
+                                         transcript TEXT NOT NULL,
+                                         day TEXT NOT NULL,
+                                         {aggregate_column_definitions},
+                                         first_message_time TEXT,
+                                         last_message_time TEXT,
+                                         updated_at TEXT NOT NULL,
+                                         PRIMARY KEY (transcript, day))''')
+        self._connection.execute('CREATE INDEX IF NOT EXISTS transcript_daily_features_day ON transcript_daily_features (day)')
+        self._connection.commit()
+
+    def update(self, messages_df):
+        """
+        Recompute the daily rows of every transcript in messages_df and upsert them.
+
+        messages_df must hold every message of each transcript it contains, as
+        read_transcripts returns them, so re-running a day replaces its rows rather than
+        double counting them. Score sums are only overwritten when messages_df carries
+        the score column, so unscored messages never erase earlier scores.
+
+        Returns
+        -------
+        row_count : int
+            Number of (transcript, day) rows written.
+
+        """
+        if messages_df.empty:
+            return 0
+        with timed('feature_store_update', items=len(messages_df)):
+            daily_features_df = aggregate_daily_features(messages_df)
+            daily_features_df['updated_at'] = datetime.now(timezone.utc).isoformat()
+            columns = list(daily_features_df.columns)
+            update_columns = [column for column in columns if column not in ('transcript', 'day')]
+            insert_sql = f'''INSERT INTO transcript_daily_features ({", ".join(columns)})
+                             VALUES ({", ".join("?" * len(columns))})
+                             ON CONFLICT(transcript, day) DO UPDATE SET
+                                 {", ".join(f"{column} = excluded.{column}" for column in update_columns)}'''
+            with self._lock:
+                self._connection.executemany(insert_sql, daily_features_df.itertuples(index=False, name=None))
+                self._connection.commit()
+        return len(daily_features_df)
+
+    def daily_features(self, transcripts=None, since_day=None):
+        """
+        Return the stored daily rows, optionally only for transcripts and only for days
+        on or after since_day ('YYYY-MM-DD').
+        """
+        conditions = []
+        parameters = []
+        if since_day is not None:
+            conditions.append('day >= ?')
+            parameters.append(since_day)
+        with self._lock:
+            if transcripts is None:
+                where_sql = f' WHERE {" AND ".join(conditions)}' if conditions else ''
+                return pd.read_sql_query(f'SELECT * FROM transcript_daily_features{where_sql}', self._connection, params=parameters)
+            transcripts = list(dict.fromkeys(transcripts))
+            daily_frames = []
+            for batch_start in range(0, len(transcripts), _SQLITE_MAX_PARAMETERS):
+                batch_transcripts = transcripts[batch_start:batch_start+_SQLITE_MAX_PARAMETERS]
+                batch_conditions = conditions + [f'transcript IN ({",".join("?" * len(batch_transcripts))})']
+                daily_frames.append(pd.read_sql_query(f'SELECT * FROM transcript_daily_features WHERE {" AND ".join(batch_conditions)}',
+                                                      self._connection, params=parameters + batch_transcripts))
+        if not daily_frames:
+            return pd.read_sql_query('SELECT * FROM transcript_daily_features WHERE 0', self._connection)
+        return pd.concat(daily_frames, axis=0, ignore_index=True)
+
+    def active_transcripts(self, since_day):
+        with self._lock:
+            rows = self._connection.execute('SELECT DISTINCT transcript FROM transcript_daily_features WHERE day >= ?', (since_day,)).fetchall()
+        return [row[0] for row in rows]
+
+    def feature_snapshot(self, entities_df, as_of_column='as_of', transcript_column='transcript', trend_days=None):
+        """
+        Add point-in-time features to every (transcript, as-of time) row of entities_df.
+
+        Only days that ended before the as-of day are summed, so a row never sees
+        messages from its own as-of day or later, and a label timestamped at the as-of
+        time cannot leak into its features.
+
+        Parameters
+        ----------
+        entities_df : Pandas DataFrame
+            One row per example, e.g. transcript, as_of and the signed_contract target.
+        as_of_column : str, optional
+            Column of as-of times. The default is 'as_of'.
+        transcript_column : str, optional
+            Column of transcript urls. The default is 'transcript'.
+        trend_days : int, optional
+            Length of the recent window the *_trend features compare against the
+            transcript's whole history. The default is FEATURE_STORE_TREND_DAYS, or 7.
+
+        Returns
+        -------
+        snapshot_df : Pandas DataFrame
+            entities_df with the feature columns appended, in the same row order.
+
+        """
+        if trend_days is None:
+            trend_days = FEATURE_STORE_TREND_DAYS
+        as_of_times = pd.to_datetime(entities_df[as_of_column], utc=True)
+        entity_keys = pd.DataFrame({'_entity': range(len(entities_df)),
+                                    'transcript': entities_df[transcript_column].astype(str).to_numpy(),
+                                    '_as_of_time': as_of_times.to_numpy(),
+                                    '_as_of_day': as_of_times.dt.strftime('%Y-%m-%d').to_numpy(),
+                                    '_trend_start_day': (as_of_times - pd.Timedelta(days=trend_days)).dt.strftime('%Y-%m-%d').to_numpy()})
+        daily_features_df = self.daily_features(entity_keys['transcript'].unique())
+        history_df = entity_keys.merge(daily_features_df, on='transcript', how='inner')
+        history_df = history_df[history_df['day'] < history_df['_as_of_day']]
+        sum_columns = list(FEATURE_COUNT_COLUMNS + _SCORE_AGGREGATE_COLUMNS)
+        entity_groups = history_df.groupby('_entity')
+        totals_df = entity_groups[sum_columns].sum(min_count=1)
+        totals_df['days_active'] = entity_groups['day'].nunique()
+        totals_df['first_message_time'] = pd.to_datetime(entity_groups['first_message_time'].min(), utc=True)
+        totals_df['last_message_time'] = pd.to_datetime(entity_groups['last_message_time'].max(), utc=True)
+        recent_df = history_df[history_df['day'] >= history_df['_trend_start_day']].groupby('_entity')[list(_SCORE_AGGREGATE_COLUMNS)].sum(min_count=1)
+        totals_df = entity_keys.set_index('_entity').join(totals_df).join(recent_df.add_prefix('recent_'))
+
+        features_df = pd.DataFrame(index=totals_df.index)
+        for column in FEATURE_COUNT_COLUMNS[:-1] + ('days_active',):
+            features_df[column] = totals_df[column].fillna(0).astype('int64')
+        outbound_counts = features_df['outbound_count'].where(features_df['outbound_count'] > 0)
+        features_df['inbound_outbound_ratio'] = features_df['inbound_count'] / outbound_counts
+        features_df['mean_reply_latency_seconds'] = totals_df['reply_latency_seconds_sum'] / features_df['reply_count'].where(features_df['reply_count'] > 0)
+        features_df['days_since_first_message'] = (totals_df['_as_of_time'] - totals_df['first_message_time']).dt.total_seconds() / 86400
+        features_df['days_since_last_message'] = (totals_df['_as_of_time'] - totals_df['last_message_time']).dt.total_seconds() / 86400
+        for feature_name in FEATURE_SCORE_COLUMNS.values():
+            mean_score = totals_df[f'{feature_name}_sum'] / totals_df[f'{feature_name}_count'].where(totals_df[f'{feature_name}_count'] > 0)
+            recent_mean_score = totals_df[f'recent_{feature_name}_sum'] / totals_df[f'recent_{feature_name}_count'].where(totals_df[f'recent_{feature_name}_count'] > 0)
+            features_df[f'mean_{feature_name}'] = mean_score
+            features_df[f'{feature_name}_trend'] = recent_mean_score - mean_score
+        snapshot_df = entities_df.reset_index(drop=True)
+        return pd.concat([snapshot_df, features_df.reset_index(drop=True)], axis=1)
+
+    def close(self):
+        if self._connection is not None:
+            self._connection.close()
+            self._connection = None
+        return
+
+
+_FEATURE_STORES = {}
+
+
+def get_feature_store():
+    """
+    Return this process's shared FeatureStore, kept per process id like the sentiment
+    score cache.
+    """
+    feature_store = _FEATURE_STORES.get(os.getpid())
+    if feature_store is None:
+        feature_store = FeatureStore()
+        _FEATURE_STORES[os.getpid()] = feature_store
+    return feature_store
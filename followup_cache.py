@@ -0,0 +1,154 @@
+import heapq
+import hashlib
+import json
+import math
+import threading
+
+
+# Sentiment columns from sentiment_main used to rank prospects, most significant first.
+# Prospects whose own (inbound) messages read most positive are followed up first.
+# sentiment_polarity_TF is only present when transformer scores are enabled; when it is
+# missing every prospect ties on it and the remaining columns decide the order.
+FOLLOWUP_RANKING_COLUMNS = ('sentiment_polarity_TF', 'compound_polarity_VS', 'sentiment_pos_percent_TB_NBA', 'sentiment_polarity_TB_PA')
+
+
+def _prospect_score(transcript_messages_df):
+    inbound_messages_df = transcript_messages_df[transcript_messages_df['isInbound'].eq(True)]
+    if inbound_messages_df.empty:
+        inbound_messages_df = transcript_messages_df
+    score = []
+    for column in FOLLOWUP_RANKING_COLUMNS:
+        column_mean = inbound_messages_df[column].mean() if column in inbound_messages_df.columns else math.nan
+        score.append(-math.inf if math.isnan(column_mean) else float(column_mean))
+    return tuple(score)
+
+
+def _json_value(value):
+    if value is None or (isinstance(value, float) and math.isnan(value)):
+        return None
+    return value.item() if hasattr(value, 'item') else value
+
+
+def _list_etag(property_name, rows):
+    return hashlib.sha1(json.dumps([property_name, rows], default=str).encode('utf-8')).hexdigest()
+
+
+def _followup_row(last_message):
+    name = ' '.join(str(last_message[column]) for column in ('firstName', 'lastName')
+                    if _json_value(last_message.get(column)) is not None)
+    return [name, _json_value(last_message.get('phone')), _json_value(last_message.get('email')), last_message['transcript']]
+
+
+class FollowupListCache:
+    """
+    Materialized follow-up lists, one per property, ranked by FOLLOWUP_RANKING_COLUMNS.
+
+    update() is incremental: only the transcripts it is given are re-scored, and only
+    the properties they belong to are re-sorted. Each list carries an ETag that changes
+    whenever the list does, so pollers can revalidate with If-None-Match.
+
+    Incremental updates only ever see changed transcripts, so a list is complete only
+    once every active transcript of its property has been loaded and mark_complete has
+    been called for it; has() reports that. A property_name of None stands for every
+    property: get(None) ranks the union of all lists.
+    """
+
+    def __init__(self):
+        self._entries = {}
+        self._property_by_transcript = {}
+        self._ranked_lists = {}
+        self._all_properties_list = (None, [])
+        self._complete_properties = set()
+        self._lock = threading.Lock()
+
+    def update(self, outreach_flag_df, refreshed_transcripts):
+        """
+        Parameters
+        ----------
+        outreach_flag_df : Pandas DataFrame
+            Messages of the refreshed transcripts that qualify for outreach, as returned
+            by check_for_targets_and_time_elapsed, with sentiment columns.
+        refreshed_transcripts : iterable of str
+            Every transcript that was re-classified, whether or not it qualified. Those
+            that no longer qualify are dropped from their list.
+
+        """
+        new_entries = {}
+        if not outreach_flag_df.empty:
+            for transcript, transcript_messages_df in outreach_flag_df.groupby('transcript', sort=False):
+                last_message = transcript_messages_df.iloc[-1]
+                new_entries[transcript] = (last_message.get('property'),
+                                           _prospect_score(transcript_messages_df),
+                                           _followup_row(last_message))
+        with self._lock:
+            changed_properties = set()
+            for transcript in set(refreshed_transcripts) | set(new_entries):
+                old_property = self._property_by_transcript.pop(transcript, None)
+                if old_property is not None:
+                    self._entries[old_property].pop(transcript, None)
+                    changed_properties.add(old_property)
+            for transcript, (property_name, score, row) in new_entries.items():
+                self._entries.setdefault(property_name, {})[transcript] = (score, row)
+                self._property_by_transcript[transcript] = property_name
+                changed_properties.add(property_name)
+            for property_name in changed_properties:
+                self._rebuild(property_name)
+            if changed_properties:
+                self._rebuild_all_properties()
+        return changed_properties
+
+    def _rebuild(self, property_name):
+        ranked_entries = sorted(self._entries.get(property_name, {}).values(), key=lambda entry: entry[0], reverse=True)
+        rows = [row for score, row in ranked_entries]
+        self._ranked_lists[property_name] = (_list_etag(property_name, rows), rows, ranked_entries)
+        return
+
+    def _rebuild_all_properties(self):
+        # Every property's entries are already sorted, so the union is a k-way merge.
+        rows = [row for score, row in heapq.merge(*(ranked_entries for etag, rows, ranked_entries in self._ranked_lists.values()),
+                                                  key=lambda entry: entry[0], reverse=True)]
+        self._all_properties_list = (_list_etag(None, rows), rows)
+        return
+
+    def mark_complete(self, property_name):
+        """
+        Record that every active transcript of property_name (or of every property, for
+        None) has been passed to update().
+        """
+        with self._lock:
+            self._complete_properties.add(property_name)
+            if self._all_properties_list[0] is None:
+                self._rebuild_all_properties()
+        return
+
+    def has(self, property_name):
+        """
+        True once the list for property_name is complete, see mark_complete.
+        """
+        with self._lock:
+            return None in self._complete_properties or property_name in self._complete_properties
+
+    def get(self, property_name, page=1, per_page=None):
+        """
+        Returns
+        -------
+        etag : str
+            Version of the whole ranked list for property_name, or of the union of every
+            list when property_name is None.
+        rows : list
+            [name, phone, email, transcript] rows of the requested page, best ranked first.
+        total : int
+            Number of prospects in the whole list.
+
+        """
+        with self._lock:
+            if property_name is None:
+                etag, rows = self._all_properties_list
+            else:
+                etag, rows = self._ranked_lists.get(property_name, (_list_etag(property_name, []), [], []))[:2]
+        if per_page is not None:
+            page_start = (max(page, 1) - 1) * per_page
+            page_rows = rows[page_start:page_start+per_page]
+        else:
+            page_rows = rows
+        return etag, page_rows, len(rows)
@@ -0,0 +1,136 @@
+import os
+import uuid
+import time
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from dotenv import load_dotenv
+
+
+load_dotenv('.env')
+JOB_WORKERS = int(os.getenv('JOB_WORKERS', 2))
+JOB_RETENTION_SECONDS = int(os.getenv('JOB_RETENTION_SECONDS', 3600))
+
+JOB_QUEUED = 'queued'
+JOB_RUNNING = 'running'
+JOB_FINISHED = 'finished'
+JOB_FAILED = 'failed'
+
+
+class Job:
+    """
+    State of one background job. The job function receives its Job and may call
+    set_progress to report what it is doing to pollers.
+    """
+
+    def __init__(self, job_id, dedupe_key=None):
+        self.job_id = job_id
+        self.dedupe_key = dedupe_key
+        self.status = JOB_QUEUED
+        self.progress = None
+        self.result = None
+        self.error = None
+        self.created_at = time.time()
+        self.finished_at = None
+
+    def set_progress(self, progress):
+        self.progress = progress
+        return
+
+    @property
+    def done(self):
+        return self.status in (JOB_FINISHED, JOB_FAILED)
+
+    def to_dict(self):
+        return {'job_id': self.job_id,
+                'status': self.status,
+                'progress': self.progress,
+                'error': self.error}
+
+
+class JobRunner:
+    """
+    In-process job queue backed by a thread pool. Submitting a job returns its id
+    immediately. A job submitted with the dedupe_key of a job that is still queued or
+    running is merged into that job, and both callers poll the same id.
+
+    Parameters
+    ----------
+    logger_name : str
+        Name of the parent logger.
+    max_workers : int, optional
+        Number of jobs that run at once. The default is the JOB_WORKERS environment
+        variable, or 2.
+    retention_seconds : int, optional
+        How long finished jobs stay available for polling. The default is the
+        JOB_RETENTION_SECONDS environment variable, or 3600.
+
+    """
+
+    def __init__(self, logger_name, max_workers=JOB_WORKERS, retention_seconds=JOB_RETENTION_SECONDS):
+        self.logger = logging.getLogger(f'{logger_name}.JobRunner')
+        self.retention_seconds = retention_seconds
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='job')
+        self._jobs = {}
+        self._active_jobs_by_key = {}
+        self._lock = threading.Lock()
+
+    def submit(self, job_function, *args, dedupe_key=None, **kwargs):
+        with self._lock:
+            self._prune_finished_jobs()
+            if dedupe_key is not None:
+                active_job_id = self._active_jobs_by_key.get(dedupe_key)
+                if active_job_id is not None:
+                    self.logger.info(f'Merged duplicate job request for {dedupe_key} into job {active_job_id}.')
+                    return active_job_id
+            job = Job(uuid.uuid4().hex, dedupe_key=dedupe_key)
+            self._jobs[job.job_id] = job
+            if dedupe_key is not None:
+                self._active_jobs_by_key[dedupe_key] = job.job_id
+        self._executor.submit(self._run, job, job_function, args, kwargs)
+        self.logger.info(f'Queued job {job.job_id} for {dedupe_key}.')
+        return job.job_id
+
+    def completed(self, result):
+        """
+        Register a job whose result is already known, such as a cache hit, so callers
+        can use the same polling flow without queueing any work.
+        """
+        job = Job(uuid.uuid4().hex)
+        job.result = result
+        job.status = JOB_FINISHED
+        job.finished_at = time.time()
+        with self._lock:
+            self._prune_finished_jobs()
+            self._jobs[job.job_id] = job
+        return job.job_id
+
+    def get(self, job_id):
+        with self._lock:
+            return self._jobs.get(job_id)
+
+    def _run(self, job, job_function, args, kwargs):
+        job.status = JOB_RUNNING
+        try:
+            job.result = job_function(job, *args, **kwargs)
+            job.status = JOB_FINISHED
+        except Exception as e:
+            self.logger.exception(f'Job {job.job_id} failed.')
+            job.error = repr(e)
+            job.status = JOB_FAILED
+        finally:
+            job.finished_at = time.time()
+            with self._lock:
+                if job.dedupe_key is not None and self._active_jobs_by_key.get(job.dedupe_key) == job.job_id:
+                    del self._active_jobs_by_key[job.dedupe_key]
+        return
+
+    def _prune_finished_jobs(self):
+        expiry = time.time() - self.retention_seconds
+        for job_id in [job_id for job_id, job in self._jobs.items() if job.done and job.finished_at is not None and job.finished_at < expiry]:
+            del self._jobs[job_id]
+        return
+
+    def shutdown(self, wait=True):
+        self._executor.shutdown(wait=wait)
+        return
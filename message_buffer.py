@@ -0,0 +1,152 @@
+import numpy as np
+import pandas as pd
+
+
+# Low-cardinality string columns stored as categoricals. The transcript url itself is
+# left as plain objects: every message of a transcript already references the same
+# string, so it costs one pointer per row.
+MESSAGE_CATEGORY_COLUMNS = ('messageType', 'messageStatus', 'classification', 'routedTo', 'leasingAttributionSource',
+                            'leasingAttributionSourceDisplayName', 'addressFrom', 'addressTo', 'mediaUrl')
+MESSAGE_DATETIME_COLUMNS = ('timeCreated',)
+PROSPECT_CATEGORY_COLUMNS = ('property', 'channel', 'source', 'unitTypes', 'tourType', 'createdProspectSource', 'applicationStatus')
+PROSPECT_DATETIME_COLUMNS = ('timeFirstMessage', 'timeLastMessage')
+# Keys and ids stay int64 whatever the batch holds: tables are created from the dtypes
+# of the first batch written, and a narrow id column would overflow on later batches.
+WIDE_INTEGER_COLUMNS = ('id', 'lastAcceptedShowingId', 'propertyCode', 'prospectCode')
+
+
+def compact_frame(df, category_columns=(), datetime_columns=(), wide_integer_columns=WIDE_INTEGER_COLUMNS):
+    """
+    Return df with compact dtypes: category_columns as categoricals, datetime_columns as
+    datetime64, object columns holding only True/False as bool, wide_integer_columns as
+    int64, and other integer columns downcast to the narrowest type that holds their
+    values.
+    """
+    compact_columns = {}
+    for column in df.columns:
+        series = df[column]
+        if column in category_columns:
+            compact_columns[column] = series.astype('category')
+        elif column in datetime_columns:
+            try:
+                compact_columns[column] = pd.to_datetime(series)
+            except (ValueError, TypeError):
+                # Mixed offsets or unparseable values stay as they are.
+                continue
+        elif series.dtype == object and pd.api.types.infer_dtype(series, skipna=False) == 'boolean':
+            compact_columns[column] = series.astype(bool)
+        elif pd.api.types.is_integer_dtype(series.dtype) and not pd.api.types.is_bool_dtype(series.dtype):
+            if column in wide_integer_columns:
+                compact_columns[column] = series.astype('int64')
+            else:
+                compact_columns[column] = pd.to_numeric(series, downcast='integer')
+    return df.assign(**compact_columns) if compact_columns else df
+
+
+def concat_compact_frames(frames):
+    """
+    pd.concat for frames from compact_frame. Categorical columns are given the union
+    of their categories first, since concatenating categoricals whose categories differ
+    falls back to object dtype. Empty frames are skipped.
+    """
+    frames = [frame for frame in frames if not frame.empty]
+    if not frames:
+        return pd.DataFrame()
+    category_columns = [column for column in frames[0].columns if isinstance(frames[0][column].dtype, pd.CategoricalDtype)]
+    for column in category_columns:
+        column_categoricals = [frame[column] for frame in frames if column in frame.columns and isinstance(frame[column].dtype, pd.CategoricalDtype)]
+        categories = pd.api.types.union_categoricals(column_categoricals, ignore_order=True).categories
+        frames = [frame.assign(**{column: frame[column].cat.set_categories(categories)})
+                  if column in frame.columns and isinstance(frame[column].dtype, pd.CategoricalDtype) else frame
+                  for frame in frames]
+    return pd.concat(frames, axis=0, ignore_index=True)
+
+
+def attach_prospect_columns(messages_df, prospects_df, join_key='transcript'):
+    """
+    Join the prospect columns onto messages_df, for the few rows that need them at once,
+    such as the messages of prospects flagged for outreach.
+    """
+    if messages_df.empty:
+        return messages_df
+    prospect_columns = [column for column in prospects_df.columns if column == join_key or column not in messages_df.columns]
+    return messages_df.merge(prospects_df[prospect_columns].drop_duplicates(subset=join_key, keep='last'),
+                             on=join_key, how='left')
+
+
+class TranscriptMessageBuffer:
+    """
+    Collects parsed transcript messages as flat records and builds the messages
+    DataFrame once per batch, instead of one pd.concat per message.
+
+    Prospect-level fields are never copied per message while buffering. Each message
+    only remembers the position of its prospect row, and the prospect columns are
+    attached in one vectorized gather (to_frame) or returned as a separate frame
+    joined on join_key (to_frames).
+
+    Parameters
+    ----------
+    prospects_df : Pandas DataFrame
+        Prospect rows from the chatbot export. Positions passed to append refer to
+        rows of this frame.
+    join_key : str, optional
+        Prospect column that identifies a transcript. The default is 'transcript'.
+
+    """
+
+    def __init__(self, prospects_df, join_key='transcript'):
+        self.prospects_df = prospects_df
+        self.join_key = join_key
+        self._records = []
+        self._prospect_positions = []
+
+    def __len__(self):
+        return len(self._records)
+
+    def append(self, prospect_position, messages_list):
+        self._records.extend(messages_list)
+        self._prospect_positions.extend([prospect_position] * len(messages_list))
+        return
+
+    def _build_messages_df(self):
+        messages_df = pd.DataFrame.from_records(self._records)
+        # Prospect values win over message fields of the same name, as they did when
+        # every prospect column was broadcast onto the transcript frame.
+        overlapping_columns = [column for column in messages_df.columns if column in self.prospects_df.columns]
+        return messages_df.drop(columns=overlapping_columns)
+
+    def to_frames(self):
+        """
+        Returns
+        -------
+        messages_df : Pandas DataFrame
+            One row per buffered message, with join_key identifying its transcript.
+        prospects_df : Pandas DataFrame
+            One row per transcript present in the buffer.
+
+        """
+        positions = np.asarray(self._prospect_positions, dtype=np.intp)
+        messages_df = self._build_messages_df()
+        messages_df[self.join_key] = self.prospects_df[self.join_key].to_numpy()[positions]
+        prospects_df = self.prospects_df.iloc[pd.unique(positions)].reset_index(drop=True)
+        return messages_df, prospects_df
+
+    def to_frame(self):
+        """
+        Returns
+        -------
+        transcripts_df : Pandas DataFrame
+            One row per buffered message with every prospect column attached, in the
+            same column layout read_transcripts has always produced.
+
+        """
+        positions = np.asarray(self._prospect_positions, dtype=np.intp)
+        messages_df = self._build_messages_df()
+        prospect_columns_df = self.prospects_df.take(positions).reset_index(drop=True)
+        return pd.concat([messages_df, prospect_columns_df], axis=1)
+
+    def flush(self, normalized=False):
+        frames = self.to_frames() if normalized else self.to_frame()
+        self._records = []
+        self._prospect_positions = []
+        return frames
@@ -0,0 +1,165 @@
+import time
+import bisect
+import threading
+from contextlib import contextmanager
+
+
+DEFAULT_LATENCY_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+_REGISTRY = {}
+_REGISTRY_LOCK = threading.Lock()
+
+
+def _label_key(labels):
+    return tuple(sorted((name, str(value)) for name, value in labels.items()))
+
+
+def _escape_label_value(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_labels(label_key, extra_labels=()):
+    label_pairs = list(label_key) + list(extra_labels)
+    if not label_pairs:
+        return ''
+    return '{' + ','.join(f'{name}="{_escape_label_value(value)}"' for name, value in label_pairs) + '}'
+
+
+class Counter:
+
+    metric_type = 'counter'
+
+    def __init__(self, name, documentation):
+        self.name = name
+        self.documentation = documentation
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1, **labels):
+        label_key = _label_key(labels)
+        with self._lock:
+            self._values[label_key] = self._values.get(label_key, 0) + amount
+        return
+
+    def render(self):
+        with self._lock:
+            values = dict(self._values)
+        return [f'{self.name}{_format_labels(label_key)} {value}' for label_key, value in sorted(values.items())]
+
+
+class Gauge:
+
+    metric_type = 'gauge'
+
+    def __init__(self, name, documentation):
+        self.name = name
+        self.documentation = documentation
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def set(self, value, **labels):
+        label_key = _label_key(labels)
+        with self._lock:
+            self._values[label_key] = value
+        return
+
+    def render(self):
+        with self._lock:
+            values = dict(self._values)
+        return [f'{self.name}{_format_labels(label_key)} {value}' for label_key, value in sorted(values.items())]
+
+
+class Histogram:
+
+    metric_type = 'histogram'
+
+    def __init__(self, name, documentation, buckets=DEFAULT_LATENCY_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.buckets = tuple(sorted(buckets))
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value, **labels):
+        label_key = _label_key(labels)
+        bucket_index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(label_key)
+            if series is None:
+                series = self._series[label_key] = {'bucket_counts': [0] * (len(self.buckets) + 1), 'sum': 0.0, 'count': 0}
+            series['bucket_counts'][bucket_index] += 1
+            series['sum'] += value
+            series['count'] += 1
+        return
+
+    def render(self):
+        with self._lock:
+            all_series = {label_key: {'bucket_counts': list(series['bucket_counts']), 'sum': series['sum'], 'count': series['count']}
+                          for label_key, series in self._series.items()}
+        lines = []
+        for label_key, series in sorted(all_series.items()):
+            cumulative_count = 0
+            for upper_bound, bucket_count in zip(self.buckets, series['bucket_counts']):
+                cumulative_count += bucket_count
+                lines.append(f'{self.name}_bucket{_format_labels(label_key, [("le", upper_bound)])} {cumulative_count}')
+            lines.append(f'{self.name}_bucket{_format_labels(label_key, [("le", "+Inf")])} {series["count"]}')
+            lines.append(f'{self.name}_sum{_format_labels(label_key)} {series["sum"]}')
+            lines.append(f'{self.name}_count{_format_labels(label_key)} {series["count"]}')
+        return lines
+
+
+def _get_or_create(metric_class, name, documentation, **kwargs):
+    metric = _REGISTRY.get(name)
+    if metric is None:
+        with _REGISTRY_LOCK:
+            metric = _REGISTRY.get(name)
+            if metric is None:
+                metric = _REGISTRY[name] = metric_class(name, documentation, **kwargs)
+    return metric
+
+
+def counter(name, documentation):
+    return _get_or_create(Counter, name, documentation)
+
+
+def gauge(name, documentation):
+    return _get_or_create(Gauge, name, documentation)
+
+
+def histogram(name, documentation, buckets=DEFAULT_LATENCY_BUCKETS):
+    return _get_or_create(Histogram, name, documentation, buckets=buckets)
+
+
+STAGE_SECONDS = histogram('prospect_pipeline_stage_seconds', 'Time spent in each pipeline stage.')
+STAGE_ITEMS = counter('prospect_pipeline_stage_items_total', 'Items processed by each pipeline stage.')
+
+
+@contextmanager
+def timed(stage, items=None):
+    """
+    Time the enclosed block into prospect_pipeline_stage_seconds{stage=...} and, when
+    items is given, add it to prospect_pipeline_stage_items_total{stage=...}.
+    """
+    start_time = time.perf_counter()
+    try:
+        yield
+    finally:
+        STAGE_SECONDS.observe(time.perf_counter() - start_time, stage=stage)
+        if items is not None:
+            STAGE_ITEMS.inc(items, stage=stage)
+
+
+def render_prometheus():
+    """
+    Render every registered metric in the Prometheus text exposition format (0.0.4).
+    Metrics are per process; scores computed in sentiment_main's pool workers are not
+    included.
+    """
+    with _REGISTRY_LOCK:
+        metrics = sorted(_REGISTRY.values(), key=lambda metric: metric.name)
+    lines = []
+    for metric in metrics:
+        lines.append(f'# HELP {metric.name} {metric.documentation}')
+        lines.append(f'# TYPE {metric.name} {metric.metric_type}')
+        lines.extend(metric.render())
+    return '\n'.join(lines) + '\n'
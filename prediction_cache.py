@@ -0,0 +1,130 @@
+import sqlite3
+import hashlib
+import json
+import os
+import threading
+import pandas as pd
+from dotenv import load_dotenv
+
+
+load_dotenv('.env')
+PREDICTION_CACHE_DB_PATH = os.getenv('PREDICTION_CACHE_DB_PATH', os.path.abspath('prediction_cache.sqlite3'))
+_SQLITE_MAX_PARAMETERS = 500
+
+
+def hash_prospect_features(features_df):
+    """
+    sha256 of every row's feature names and values, so a prospect whose features have
+    not changed hashes the same from one run to the next.
+
+    Parameters
+    ----------
+    features_df : Pandas DataFrame
+        One row per prospect, holding only the columns sent to the model.
+
+    Returns
+    -------
+    feature_hashes : list of str
+        One hex digest per row, in row order.
+
+    """
+    feature_hashes = []
+    for feature_record in features_df.to_dict('records'):
+        # NaN, NaT, None and pd.NA are all written as null. pd.NA cannot be compared,
+        # so missing values are detected with pd.isna rather than value != value.
+        feature_record = {name: None if pd.api.types.is_scalar(value) and pd.isna(value) else value
+                          for name, value in feature_record.items()}
+        record_json = json.dumps(feature_record, sort_keys=True, separators=(',', ':'), default=str)
+        feature_hashes.append(hashlib.sha256(record_json.encode('utf-8')).hexdigest())
+    return feature_hashes
+
+
+class PredictionCache:
+    """
+    SQLite store of model predictions keyed by (feature hash, model id). Retraining or
+    replacing the deployed model changes the model id, so old predictions are never
+    returned for a new model.
+
+    Parameters
+    ----------
+    db_path : str, optional
+        Path of the SQLite file. The default is the PREDICTION_CACHE_DB_PATH environment
+        variable, or prediction_cache.sqlite3 in the working directory.
+
+    """
+
+    def __init__(self, db_path=None):
+        if db_path is None:
+            db_path = PREDICTION_CACHE_DB_PATH
+        if db_path != ':memory:':
+            os.makedirs(os.path.dirname(os.path.abspath(db_path)), exist_ok=True)
+        self.db_path = db_path
+        self._lock = threading.Lock()
+        self._stats = {'hits': 0, 'misses': 0}
+        self._connection = sqlite3.connect(db_path, timeout=30, check_same_thread=False)
+        self._connection.execute('PRAGMA journal_mode=WAL')
+        self._connection.execute('''CREATE TABLE IF NOT EXISTS predictions (
+                                        feature_hash TEXT NOT NULL,
+                                        model_id TEXT NOT NULL,
+                                        prediction TEXT NOT NULL,
+                                        PRIMARY KEY (feature_hash, model_id))''')
+        self._connection.commit()
+
+    def get_many(self, feature_hashes, model_id):
+        """
+        Look up feature_hashes for model_id, returning a list of prediction dicts aligned
+        with them and None for every miss.
+        """
+        predictions_by_hash = {}
+        unique_hashes = list(dict.fromkeys(feature_hashes))
+        with self._lock:
+            for batch_start in range(0, len(unique_hashes), _SQLITE_MAX_PARAMETERS):
+                batch_hashes = unique_hashes[batch_start:batch_start+_SQLITE_MAX_PARAMETERS]
+                placeholders = ','.join('?' * len(batch_hashes))
+                rows = self._connection.execute(f'''SELECT feature_hash, prediction FROM predictions
+                                                    WHERE model_id = ? AND feature_hash IN ({placeholders})''',
+                                                [model_id, *batch_hashes]).fetchall()
+                for feature_hash, prediction_json in rows:
+                    predictions_by_hash[feature_hash] = json.loads(prediction_json)
+            results = [predictions_by_hash.get(feature_hash) for feature_hash in feature_hashes]
+            hit_count = sum(prediction is not None for prediction in results)
+            self._stats['hits'] += hit_count
+            self._stats['misses'] += len(results) - hit_count
+        return results
+
+    def put_many(self, feature_hashes, model_id, predictions):
+        with self._lock:
+            self._connection.executemany('INSERT OR REPLACE INTO predictions (feature_hash, model_id, prediction) VALUES (?, ?, ?)',
+                                         [(feature_hash, model_id, json.dumps(prediction))
+                                          for feature_hash, prediction in zip(feature_hashes, predictions)])
+            self._connection.commit()
+        return
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+        lookups = stats['hits'] + stats['misses']
+        stats['lookups'] = lookups
+        stats['hit_rate'] = stats['hits'] / lookups if lookups else 0.0
+        return stats
+
+    def close(self):
+        if self._connection is not None:
+            self._connection.close()
+            self._connection = None
+        return
+
+
+_PREDICTION_CACHES = {}
+
+
+def get_prediction_cache():
+    """
+    Return this process's shared PredictionCache, kept per process id like the
+    sentiment score cache.
+    """
+    prediction_cache = _PREDICTION_CACHES.get(os.getpid())
+    if prediction_cache is None:
+        prediction_cache = PredictionCache()
+        _PREDICTION_CACHES[os.getpid()] = prediction_cache
+    return prediction_cache
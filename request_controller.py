@@ -0,0 +1,411 @@
+import os
+import time
+import random
+import asyncio
+import logging
+import threading
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+from urllib.parse import urlsplit
+from dotenv import load_dotenv
+from metrics import counter, gauge
+
+
+load_dotenv('.env')
+REQUEST_INITIAL_CONCURRENCY = int(os.getenv('REQUEST_INITIAL_CONCURRENCY', 16))
+REQUEST_MIN_CONCURRENCY = int(os.getenv('REQUEST_MIN_CONCURRENCY', 1))
+REQUEST_MAX_CONCURRENCY = int(os.getenv('REQUEST_MAX_CONCURRENCY', 2048))
+# Grow the limit by one per success, doubling it every round trip, until a host first
+# shows overload, so a healthy host reaches thousands of requests in flight in a few
+# round trips instead of the many thousands that additive increase would take.
+REQUEST_SLOW_START = os.getenv('REQUEST_SLOW_START', 'true').lower() in ('1', 'true', 'yes')
+REQUEST_LATENCY_TARGET_SECONDS = float(os.getenv('REQUEST_LATENCY_TARGET_SECONDS', 5))
+REQUEST_DECREASE_FACTOR = float(os.getenv('REQUEST_DECREASE_FACTOR', 0.5))
+REQUEST_MAX_RETRIES = int(os.getenv('REQUEST_MAX_RETRIES', 4))
+REQUEST_BACKOFF_BASE_SECONDS = float(os.getenv('REQUEST_BACKOFF_BASE_SECONDS', 0.5))
+REQUEST_BACKOFF_MAX_SECONDS = float(os.getenv('REQUEST_BACKOFF_MAX_SECONDS', 30))
+REQUEST_RETRY_AFTER_MAX_SECONDS = float(os.getenv('REQUEST_RETRY_AFTER_MAX_SECONDS', 120))
+REQUEST_CIRCUIT_FAILURE_THRESHOLD = int(os.getenv('REQUEST_CIRCUIT_FAILURE_THRESHOLD', 20))
+REQUEST_CIRCUIT_RESET_SECONDS = float(os.getenv('REQUEST_CIRCUIT_RESET_SECONDS', 30))
+RETRYABLE_STATUSES = frozenset({429, 500, 502, 503, 504})
+# Waiters re-check their host at least this often, so an open circuit that has reached
+# its reset time lets a probe through even when no request finishes to wake them.
+_WAIT_POLL_SECONDS = 0.5
+
+REQUEST_RETRIES = counter('http_request_retries_total', 'Requests retried after a throttle, server error or connection failure, by host and reason.')
+REQUEST_DROPS = counter('http_request_drops_total', 'Requests given up on after their last retry or refused by an open circuit, by host and reason.')
+REQUEST_CONCURRENCY_LIMIT = gauge('http_request_concurrency_limit', 'Adaptive concurrency limit of each host.')
+REQUEST_CIRCUIT_OPEN = gauge('http_request_circuit_open', '1 while the circuit breaker of a host is open, else 0.')
+
+
+class CircuitOpenError(RuntimeError):
+    pass
+
+
+def parse_retry_after(header_value):
+    """
+    Seconds to wait from a Retry-After header, given as seconds or as an HTTP date.
+    Returns None when the header is missing or unparseable.
+    """
+    if not header_value:
+        return None
+    try:
+        return max(0.0, float(header_value))
+    except ValueError:
+        pass
+    try:
+        retry_at = parsedate_to_datetime(header_value)
+    except (TypeError, ValueError):
+        return None
+    if retry_at.tzinfo is None:
+        retry_at = retry_at.replace(tzinfo=timezone.utc)
+    return max(0.0, (retry_at - datetime.now(timezone.utc)).total_seconds())
+
+
+def _resolve_waiter(waiter):
+    if not waiter.done():
+        waiter.set_result(None)
+    return
+
+
+class _HostLimiter:
+    """
+    Concurrency limit and circuit breaker of one host.
+
+    Until its first overload the limit grows by one for every successful request (slow
+    start). From then on it grows by one for every limit's worth of successful requests
+    (additive increase) and is multiplied by decrease_factor on a throttle, a server error, a
+    connection failure or a response slower than the latency target (multiplicative
+    decrease). Decreases are spaced at least one smoothed response time apart, so a
+    burst of failures from requests that were all in flight together counts once.
+
+    After failure_threshold overloaded responses in a row the circuit opens and every
+    request fails fast for reset_seconds. Only failures of requests sent after the last
+    counted failure count, so the same burst of requests in flight together counts once
+    here too. When the circuit's time is up, one probe request is let through: its success
+    closes the circuit and its failure opens it again.
+    """
+
+    def __init__(self, host, controller):
+        self.host = host
+        self.controller = controller
+        self.limit = float(controller.initial_concurrency)
+        self.slow_start = controller.slow_start
+        self.in_flight = 0
+        self.consecutive_failures = 0
+        self.last_counted_failure_time = float('-inf')
+        self.open_until = None
+        self.probe_in_flight = False
+        self.smoothed_latency = None
+        self.last_decrease_time = 0.0
+        self._lock = threading.Lock()
+        self._condition = threading.Condition(self._lock)
+        self._async_waiters = []
+        REQUEST_CONCURRENCY_LIMIT.set(int(self.limit), host=host)
+        REQUEST_CIRCUIT_OPEN.set(0, host=host)
+
+    def _try_acquire(self):
+        if self.open_until is not None:
+            if time.monotonic() < self.open_until or self.probe_in_flight:
+                raise CircuitOpenError(f'Circuit breaker for {self.host} is open.')
+            self.probe_in_flight = True
+            self.in_flight += 1
+            return True
+        if self.in_flight < int(self.limit):
+            self.in_flight += 1
+            return True
+        return False
+
+    def acquire(self):
+        with self._condition:
+            while not self._try_acquire():
+                self._condition.wait(timeout=_WAIT_POLL_SECONDS)
+        return
+
+    async def acquire_async(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            with self._lock:
+                if self._try_acquire():
+                    return
+                waiter = loop.create_future()
+                self._async_waiters.append((loop, waiter))
+            try:
+                await asyncio.wait({waiter}, timeout=_WAIT_POLL_SECONDS)
+            finally:
+                with self._lock:
+                    if (loop, waiter) in self._async_waiters:
+                        self._async_waiters.remove((loop, waiter))
+
+    def _wake_waiters(self):
+        self._condition.notify_all()
+        for loop, waiter in self._async_waiters:
+            try:
+                loop.call_soon_threadsafe(_resolve_waiter, waiter)
+            except RuntimeError:
+                # The waiter's event loop has already closed.
+                pass
+        self._async_waiters.clear()
+        return
+
+    def _decrease(self, now):
+        self.slow_start = False
+        if now - self.last_decrease_time >= (self.smoothed_latency or 0.0):
+            self.limit = max(float(self.controller.min_concurrency), self.limit * self.controller.decrease_factor)
+            self.last_decrease_time = now
+        return
+
+    def release(self, latency_seconds, overloaded):
+        controller = self.controller
+        with self._lock:
+            self.in_flight -= 1
+            now = time.monotonic()
+            was_probe = self.probe_in_flight
+            self.probe_in_flight = False
+            if overloaded:
+                if now - latency_seconds >= self.last_counted_failure_time:
+                    self.consecutive_failures += 1
+                    self.last_counted_failure_time = now
+                self._decrease(now)
+                if was_probe or self.consecutive_failures >= controller.failure_threshold:
+                    if self.open_until is None:
+                        controller.logger.warning(f'Opening the circuit for {self.host} for {controller.reset_seconds}s after '
+                                                  f'{self.consecutive_failures} failed requests in a row.')
+                    self.open_until = now + controller.reset_seconds
+                    REQUEST_CIRCUIT_OPEN.set(1, host=self.host)
+            else:
+                self.consecutive_failures = 0
+                if was_probe:
+                    controller.logger.info(f'Closing the circuit for {self.host}.')
+                    self.open_until = None
+                    REQUEST_CIRCUIT_OPEN.set(0, host=self.host)
+                self.smoothed_latency = latency_seconds if self.smoothed_latency is None else 0.8 * self.smoothed_latency + 0.2 * latency_seconds
+                if latency_seconds > controller.latency_target_seconds:
+                    self._decrease(now)
+                else:
+                    self.limit = min(float(controller.max_concurrency), self.limit + (1 if self.slow_start else 1 / self.limit))
+            REQUEST_CONCURRENCY_LIMIT.set(int(self.limit), host=self.host)
+            self._wake_waiters()
+        return
+
+    def stats(self):
+        with self._lock:
+            return {'limit': int(self.limit),
+                    'in_flight': self.in_flight,
+                    'smoothed_latency_seconds': self.smoothed_latency,
+                    'circuit_open': self.open_until is not None}
+
+
+class RequestController:
+    """
+    Shared retry, adaptive concurrency and circuit breaking policy for outgoing HTTP
+    requests, kept separately for every host.
+
+    Requests are made through send (blocking) or send_async (asyncio) with a callable
+    that performs one attempt. A throttle (429), a server error (500, 502, 503, 504) or
+    one of the caller's retry_exceptions is retried after the Retry-After delay when the
+    server sent one, or else after a full-jitter exponential backoff.
+
+    Parameters
+    ----------
+    initial_concurrency, min_concurrency, max_concurrency : int, optional
+        Starting, lowest and highest concurrency limit per host. The defaults are the
+        REQUEST_INITIAL_CONCURRENCY (16), REQUEST_MIN_CONCURRENCY (1) and
+        REQUEST_MAX_CONCURRENCY (2048) environment variables.
+    slow_start : bool, optional
+        Grow each host's limit by one per success until its first overload. The default
+        is REQUEST_SLOW_START, or True.
+    latency_target_seconds : float, optional
+        Responses slower than this shrink the limit. The default is
+        REQUEST_LATENCY_TARGET_SECONDS, or 5.
+    decrease_factor : float, optional
+        Multiplier applied to the limit on overload. The default is
+        REQUEST_DECREASE_FACTOR, or 0.5.
+    max_retries : int, optional
+        Retries per request after the first attempt. The default is
+        REQUEST_MAX_RETRIES, or 4.
+    backoff_base_seconds, backoff_max_seconds : float, optional
+        The backoff before retry n is uniform in [0, min(max, base * 2**n)]. The
+        defaults are REQUEST_BACKOFF_BASE_SECONDS (0.5) and REQUEST_BACKOFF_MAX_SECONDS (30).
+    failure_threshold : int, optional
+        Overloaded responses in a row that open a host's circuit. The default is
+        REQUEST_CIRCUIT_FAILURE_THRESHOLD, or 20.
+    reset_seconds : float, optional
+        How long an open circuit refuses requests before a probe. The default is
+        REQUEST_CIRCUIT_RESET_SECONDS, or 30.
+    logger_name : str, optional
+        Name of the parent logger.
+
+    """
+
+    def __init__(self, initial_concurrency=None, min_concurrency=None, max_concurrency=None, slow_start=None, latency_target_seconds=None,
+                 decrease_factor=None, max_retries=None, backoff_base_seconds=None, backoff_max_seconds=None,
+                 failure_threshold=None, reset_seconds=None, logger_name='request_controller'):
+        self.min_concurrency = REQUEST_MIN_CONCURRENCY if min_concurrency is None else min_concurrency
+        self.max_concurrency = REQUEST_MAX_CONCURRENCY if max_concurrency is None else max_concurrency
+        initial_concurrency = REQUEST_INITIAL_CONCURRENCY if initial_concurrency is None else initial_concurrency
+        self.initial_concurrency = min(max(initial_concurrency, self.min_concurrency), self.max_concurrency)
+        self.slow_start = REQUEST_SLOW_START if slow_start is None else slow_start
+        self.latency_target_seconds = REQUEST_LATENCY_TARGET_SECONDS if latency_target_seconds is None else latency_target_seconds
+        self.decrease_factor = REQUEST_DECREASE_FACTOR if decrease_factor is None else decrease_factor
+        self.max_retries = REQUEST_MAX_RETRIES if max_retries is None else max_retries
+        self.backoff_base_seconds = REQUEST_BACKOFF_BASE_SECONDS if backoff_base_seconds is None else backoff_base_seconds
+        self.backoff_max_seconds = REQUEST_BACKOFF_MAX_SECONDS if backoff_max_seconds is None else backoff_max_seconds
+        self.failure_threshold = REQUEST_CIRCUIT_FAILURE_THRESHOLD if failure_threshold is None else failure_threshold
+        self.reset_seconds = REQUEST_CIRCUIT_RESET_SECONDS if reset_seconds is None else reset_seconds
+        self.logger = logging.getLogger(f'{logger_name}.RequestController')
+        self._hosts = {}
+        self._hosts_lock = threading.Lock()
+        self._stats = {}
+
+    def host_limiter(self, url):
+        host = urlsplit(url).netloc
+        host_limiter = self._hosts.get(host)
+        if host_limiter is None:
+            with self._hosts_lock:
+                host_limiter = self._hosts.get(host)
+                if host_limiter is None:
+                    host_limiter = self._hosts[host] = _HostLimiter(host, self)
+                    self._stats[host] = {'requests': 0, 'retries': 0, 'drops': 0}
+        return host_limiter
+
+    def _count(self, host, stat_name):
+        with self._hosts_lock:
+            self._stats[host][stat_name] += 1
+        return
+
+    def _retry_delay(self, retry_number, headers):
+        retry_after_seconds = parse_retry_after(headers.get('Retry-After')) if headers is not None else None
+        if retry_after_seconds is not None:
+            return min(retry_after_seconds, REQUEST_RETRY_AFTER_MAX_SECONDS)
+        return random.uniform(0, min(self.backoff_max_seconds, self.backoff_base_seconds * 2 ** retry_number))
+
+    def _finish_attempt(self, host_limiter, url, retry_number, start_time, status, headers, result, error):
+        """
+        Record one attempt's outcome. Returns the seconds to wait before retrying, or
+        None when the attempt's result is final.
+        """
+        overloaded = error is not None or status in RETRYABLE_STATUSES
+        host_limiter.release(time.perf_counter() - start_time, overloaded)
+        if not overloaded:
+            return None
+        reason = type(error).__name__ if error is not None else f'http_{status}'
+        if retry_number >= self.max_retries:
+            REQUEST_DROPS.inc(host=host_limiter.host, reason=reason)
+            self._count(host_limiter.host, 'drops')
+            self.logger.warning(f'Giving up on {url} after {retry_number + 1} attempts ({reason}).')
+            return None
+        REQUEST_RETRIES.inc(host=host_limiter.host, reason=reason)
+        self._count(host_limiter.host, 'retries')
+        close_result = getattr(result, 'close', None)
+        if close_result is not None:
+            close_result()
+        return self._retry_delay(retry_number, headers)
+
+    def _refuse(self, host_limiter):
+        REQUEST_DROPS.inc(host=host_limiter.host, reason='circuit_open')
+        self._count(host_limiter.host, 'drops')
+        return
+
+    def send(self, url, attempt, retry_exceptions=()):
+        """
+        Make a request to url with retries, blocking while its host is at its limit.
+
+        Parameters
+        ----------
+        url : str
+            Request url. Limits and circuits are kept per host.
+        attempt : callable
+            Makes one attempt and returns (status, headers, result). The host's slot is
+            held only while it runs, so a streamed body should be read after send returns.
+        retry_exceptions : tuple of type, optional
+            Exceptions from attempt that are retried like a server error, e.g. connection
+            errors and timeouts. Other exceptions propagate at once.
+
+        Returns
+        -------
+        result
+            The result of the last attempt. After the last retry this can still be a
+            throttled or server error response.
+
+        Raises
+        ------
+        CircuitOpenError
+            When the host's circuit is open.
+
+        """
+        host_limiter = self.host_limiter(url)
+        self._count(host_limiter.host, 'requests')
+        for retry_number in range(self.max_retries + 1):
+            try:
+                host_limiter.acquire()
+            except CircuitOpenError:
+                self._refuse(host_limiter)
+                raise
+            start_time = time.perf_counter()
+            status = headers = result = error = None
+            try:
+                status, headers, result = attempt()
+            except retry_exceptions as e:
+                error = e
+            except BaseException:
+                host_limiter.release(time.perf_counter() - start_time, False)
+                raise
+            retry_delay = self._finish_attempt(host_limiter, url, retry_number, start_time, status, headers, result, error)
+            if retry_delay is None:
+                break
+            time.sleep(retry_delay)
+        if error is not None:
+            raise error
+        return result
+
+    async def send_async(self, url, attempt, retry_exceptions=()):
+        """
+        asyncio version of send. attempt is a coroutine function returning
+        (status, headers, result).
+        """
+        host_limiter = self.host_limiter(url)
+        self._count(host_limiter.host, 'requests')
+        for retry_number in range(self.max_retries + 1):
+            try:
+                await host_limiter.acquire_async()
+            except CircuitOpenError:
+                self._refuse(host_limiter)
+                raise
+            start_time = time.perf_counter()
+            status = headers = result = error = None
+            try:
+                status, headers, result = await attempt()
+            except retry_exceptions as e:
+                error = e
+            except BaseException:
+                host_limiter.release(time.perf_counter() - start_time, False)
+                raise
+            retry_delay = self._finish_attempt(host_limiter, url, retry_number, start_time, status, headers, result, error)
+            if retry_delay is None:
+                break
+            await asyncio.sleep(retry_delay)
+        if error is not None:
+            raise error
+        return result
+
+    def stats(self):
+        with self._hosts_lock:
+            hosts = dict(self._hosts)
+            request_stats = {host: dict(host_stats) for host, host_stats in self._stats.items()}
+        return {host: {**request_stats[host], **host_limiter.stats()} for host, host_limiter in hosts.items()}
+
+
+_REQUEST_CONTROLLERS = {}
+
+
+def get_request_controller():
+    """
+    Return this process's shared RequestController, so the limit learned for a host
+    carries over from one batch of requests to the next.
+    """
+    request_controller = _REQUEST_CONTROLLERS.get(os.getpid())
+    if request_controller is None:
+        request_controller = RequestController()
+        _REQUEST_CONTROLLERS[os.getpid()] = request_controller
+    return request_controller
@@ -1,106 +1,352 @@
-#import fast_bert
-#from fast_bert.data_cls import BertDataBunch
 from vaderSentiment.vaderSentiment import SentimentIntensityAnalyzer
 import pandas as pd
-from textblob import TextBlob
-from textblob.sentiments import NaiveBayesAnalyzer
+from textblob.sentiments import NaiveBayesAnalyzer, PatternAnalyzer
 from nltk.corpus import stopwords
-from nltk.tokenize import word_tokenize
-#from flair.models import TextClassifier
-#from flair.data import Sentence
+from nltk.tokenize import NLTKWordTokenizer
 import string
+import threading
+import os
+import importlib.metadata
+from concurrent.futures import ProcessPoolExecutor
+from dotenv import load_dotenv
+from sentiment_cache import get_score_cache
+from model_snapshot import get_snapshot, load_sentence_tokenizer
+from transformer_sentiment import TransformerSentimentScorer, transformer_model_version, transformer_sentiment_enabled
+from metrics import timed
+
+
+load_dotenv('.env')
+SENTIMENT_WORKERS = int(os.getenv('SENTIMENT_WORKERS', os.cpu_count() or 1))
+SENTIMENT_CHUNK_SIZE = int(os.getenv('SENTIMENT_CHUNK_SIZE', 5000))
+SENTIMENT_ANALYZERS = ('vader', 'textblob_pa', 'textblob_nba') + (('transformer',) if transformer_sentiment_enabled() else ())
+
+_ANALYZER_REGISTRY = {}
+_ANALYZER_REGISTRY_LOCK = threading.Lock()
+_TEXT_RESOURCES = {}
+_TEXT_RESOURCES_LOCK = threading.Lock()
+
+
+def _build_naive_bayes_analyzer():
+    # NaiveBayesAnalyzer trains on the movie_reviews corpus the first time it analyzes
+    # anything; training here keeps that cost out of the first scored message.
+    analyzer = NaiveBayesAnalyzer()
+    analyzer.train()
+    return analyzer
+
+
+_ANALYZER_FACTORIES = {'vader': SentimentIntensityAnalyzer,
+                       'textblob_pa': PatternAnalyzer,
+                       'textblob_nba': _build_naive_bayes_analyzer,
+                       'transformer': TransformerSentimentScorer}
+
+
+def get_analyzer(analyzer_name):
+    """
+    Return the process-wide instance of a sentiment analyzer, taking it from the model
+    snapshot when one is configured, otherwise building (and for the Naive Bayes
+    analyzer, training) it on first use only.
+    """
+    analyzer = _ANALYZER_REGISTRY.get(analyzer_name)
+    if analyzer is None:
+        with _ANALYZER_REGISTRY_LOCK:
+            analyzer = _ANALYZER_REGISTRY.get(analyzer_name)
+            if analyzer is None:
+                snapshot = get_snapshot()
+                if snapshot is not None and analyzer_name in snapshot['analyzers']:
+                    analyzer = snapshot['analyzers'][analyzer_name]
+                else:
+                    analyzer = _ANALYZER_FACTORIES[analyzer_name]()
+                _ANALYZER_REGISTRY[analyzer_name] = analyzer
+    return analyzer
+
+
+def _get_text_resource(resource_key, build_resource):
+    resource = _TEXT_RESOURCES.get(resource_key)
+    if resource is None:
+        with _TEXT_RESOURCES_LOCK:
+            resource = _TEXT_RESOURCES.get(resource_key)
+            if resource is None:
+                resource = _TEXT_RESOURCES[resource_key] = build_resource()
+    return resource
+
+
+def get_stopwords(language='english'):
+    """
+    Return the stopwords of language as a frozenset, loaded once per process from the
+    model snapshot when one is configured, otherwise from the NLTK corpus.
+    """
+    def build_stopwords():
+        snapshot = get_snapshot()
+        if snapshot is not None and language in snapshot['stopwords']:
+            return snapshot['stopwords'][language]
+        return frozenset(stopwords.words(language))
+    return _get_text_resource(('stopwords', language), build_stopwords)
+
+
+def _get_tokenizers(language):
+    def build_tokenizers():
+        snapshot = get_snapshot()
+        if snapshot is not None and language in snapshot['sentence_tokenizers']:
+            return snapshot['sentence_tokenizers'][language], snapshot['word_tokenizer']
+        return load_sentence_tokenizer(language), NLTKWordTokenizer()
+    return _get_text_resource(('tokenizers', language), build_tokenizers)
+
+
+def tokenize_words(text, language='english'):
+    # Same tokens as nltk's word_tokenize, with the tokenizers loaded once per process.
+    sentence_tokenizer, word_tokenizer = _get_tokenizers(language)
+    return [token for sentence in sentence_tokenizer.tokenize(text) for token in word_tokenizer.tokenize(sentence)]
+
+
+def warm_analyzers(analyzer_names=SENTIMENT_ANALYZERS):
+    for analyzer_name in analyzer_names:
+        get_analyzer(analyzer_name)
+    return
+
+
+def _score_vader(analyzer, message):
+    vader_scores = analyzer.polarity_scores(message)
+    return vader_scores['compound'], vader_scores['pos'], vader_scores['neg'], vader_scores['neu']
+
+
+def _score_textblob_pa(analyzer, message):
+    pa_sentiment = analyzer.analyze(message)
+    return pa_sentiment.polarity, pa_sentiment.subjectivity
+
+
+def _score_textblob_nba(analyzer, message):
+    nba_sentiment = analyzer.analyze(message)
+    return nba_sentiment.classification, nba_sentiment.p_pos
+
+
+_ANALYZER_SCORERS = {'vader': _score_vader,
+                     'textblob_pa': _score_textblob_pa,
+                     'textblob_nba': _score_textblob_nba}
+
+# Analyzers that score a whole list of texts per call rather than one message at a time.
+_ANALYZER_BATCH_SCORERS = {'transformer': lambda analyzer, texts: analyzer.score(texts)}
+
+# Output column names per analyzer, in the order the scorer returns its metrics.
+_ANALYZER_OUTPUT_COLUMNS = {'vader': ('compound_polarity{filtered_flag}_VS',
+                                      'positive_ratio{filtered_flag}_VS',
+                                      'negative_ratio{filtered_flag}_VS',
+                                      'neutral_ratio{filtered_flag}_VS'),
+                            'textblob_pa': ('sentiment_polarity{filtered_flag}_TB_PA',
+                                            'sentiment_subjectivity{filtered_flag}_TB_PA'),
+                            'textblob_nba': ('sentiment_classification{filtered_flag}_TB_NBA',
+                                             'sentiment_pos_percent_TB{filtered_flag}_NBA'),
+                            'transformer': ('sentiment_label{filtered_flag}_TF',
+                                            'sentiment_polarity{filtered_flag}_TF',
+                                            'sentiment_pos_probability{filtered_flag}_TF')}
+
+
+def _analyzer_version(analyzer_name):
+    if analyzer_name == 'transformer':
+        return transformer_model_version()
+    package_name = 'vaderSentiment' if analyzer_name == 'vader' else 'textblob'
+    try:
+        package_version = importlib.metadata.version(package_name)
+    except importlib.metadata.PackageNotFoundError:
+        package_version = 'unknown'
+    return f'{analyzer_name}:{package_name}-{package_version}'
+
+
+def _score_texts(analyzer_name, texts):
+    analyzer = get_analyzer(analyzer_name)
+    if analyzer_name in _ANALYZER_BATCH_SCORERS:
+        return _ANALYZER_BATCH_SCORERS[analyzer_name](analyzer, texts)
+    scorer = _ANALYZER_SCORERS[analyzer_name]
+    return [scorer(analyzer, text) for text in texts]
+
+
+def _score_texts_with_cache(analyzer_name, texts, score_cache):
+    analyzer_version = _analyzer_version(analyzer_name)
+    cache_keys = [score_cache.make_key(analyzer_version, text) for text in texts]
+    metric_rows = score_cache.get_many(cache_keys)
+    # Each distinct uncached text is scored once, however often it repeats.
+    missed_texts = {}
+    for cache_key, text, metrics in zip(cache_keys, texts, metric_rows):
+        if metrics is None and cache_key not in missed_texts:
+            missed_texts[cache_key] = text
+    if missed_texts:
+        missed_keys = list(missed_texts)
+        missed_metric_rows = _score_texts(analyzer_name, list(missed_texts.values()))
+        score_cache.put_many(missed_keys, missed_metric_rows)
+        scored_by_key = dict(zip(missed_keys, missed_metric_rows))
+        metric_rows = [metrics if metrics is not None else scored_by_key[cache_key]
+                       for cache_key, metrics in zip(cache_keys, metric_rows)]
+    return metric_rows
+
+
+def score_batch(texts, filtered=False, analyzer_names=SENTIMENT_ANALYZERS, use_cache=True):
+    """
+    Score every text with each requested analyzer, calling every analyzer at most once
+    per distinct text and reusing the shared analyzer instances from get_analyzer.
+
+    Parameters
+    ----------
+    texts : iterable of str
+        Messages to score. Missing values are scored as empty strings.
+    filtered : bool, optional
+        Whether texts have had stopwords removed. Only changes the output column names.
+        The default is False.
+    analyzer_names : tuple of str, optional
+        Analyzers to run, from SENTIMENT_ANALYZERS. The default is all of them.
+    use_cache : bool, optional
+        Look scores up in the process's SentimentScoreCache before computing them, and
+        store newly computed scores there. The default is True.
+
+    Returns
+    -------
+    score_columns : dict of str to list
+        Output column name mapped to one score per text.
+
+    """
+    filtered_flag = '_filtered' if filtered else ''
+    texts = [text if isinstance(text, str) else '' for text in texts]
+    score_cache = get_score_cache() if use_cache else None
+    score_columns = {}
+    for analyzer_name in analyzer_names:
+        with timed(f'sentiment_{analyzer_name}', items=len(texts)):
+            if score_cache is None:
+                metric_rows = _score_texts(analyzer_name, texts)
+            else:
+                metric_rows = _score_texts_with_cache(analyzer_name, texts, score_cache)
+        column_names = [column.format(filtered_flag=filtered_flag) for column in _ANALYZER_OUTPUT_COLUMNS[analyzer_name]]
+        metric_columns = zip(*metric_rows) if metric_rows else [()] * len(column_names)
+        for column_name, metric_column in zip(column_names, metric_columns):
+            score_columns[column_name] = list(metric_column)
+    return score_columns
+
+
+def _target_column(filtered):
+    return 'no_stopwords_message_text' if filtered else 'censoredShortBody'
 
 
 def calculate_vader_sentiment(messages_df, filtered=False):
     # calculate score from vaderSentiment
-    if filtered:
-        target_col = 'no_stopwords_message_text'
-        filtered_flag = '_filtered'
-    else:
-        target_col = 'censoredShortBody'
-        filtered_flag = ''
-    analyzer = SentimentIntensityAnalyzer()
-    scored_messages_df = pd.DataFrame()
-    for index, sentence_transcript_entry in enumerate(messages_df):
-        vader_scores = analyzer.polarity_scores(sentence_transcript_entry[target_col])
-        temp_df = pd.DataFrame({f'compound_polarity{filtered_flag}_VS': vader_scores['compound'],
-                                f'positive_ratio{filtered_flag}_VS': vader_scores['pos'],
-                                f'negative_ratio{filtered_flag}_VS': vader_scores['neg'],
-                                f'neutral_ratio{filtered_flag}_VS': vader_scores['neu']},
-                               index=[0])
-        temp_df = pd.concat([sentence_transcript_entry.to_frame().T, temp_df],
-                            axis=1,
-                            ignore_index=True)
-        scored_messages_df = pd.concat([scored_messages_df, temp_df], axis=0, ignore_index=True)
-    return scored_messages_df
+    score_columns = score_batch(messages_df[_target_column(filtered)], filtered=filtered, analyzer_names=('vader',))
+    for column_name, scores in score_columns.items():
+        messages_df[column_name] = scores
+    return messages_df
 
 
 def calculate_textblob_sentiment(messages_df, filtered=False):
     # calculate score from TextBlob - uses both the default PatternAnalyzer and the alternative NaiveBayesAnalyzer
-    if filtered:
-        target_col = 'no_stopwords_message_text'
-        filtered_flag = '_filtered'
-    else:
-        target_col = 'censoredShortBody'
-        filtered_flag = ''
-    tb_sentiment_PA_polarity = [TextBlob(message).sentiment.polarity for message in messages_df[target_col]]
-    tb_sentiment_PA_subj = [TextBlob(message).sentiment.subjectivity for message in messages_df[target_col]]
-    tb_sentiment_NBA = [TextBlob(message, analyzer=NaiveBayesAnalyzer()).sentiment for message in messages_df[target_col]]
-    tb_sentiment_NBA_class = [sentiment['classification'] for sentiment in tb_sentiment_NBA]
-    tb_sentiment_NBA_pos_ratio = [sentiment['p_pos'] for sentiment in tb_sentiment_NBA]
-    messages_df[f'sentiment_polarity{filtered_flag}_TB_PA'] = tb_sentiment_PA_polarity
-    messages_df[f'sentiment_subjectivity{filtered_flag}_TB_PA'] = tb_sentiment_PA_subj
-    messages_df[f'sentiment_classification{filtered_flag}_TB_NBA'] = tb_sentiment_NBA_class
-    messages_df[f'sentiment_pos_percent_TB{filtered_flag}_NBA'] = tb_sentiment_NBA_pos_ratio
+    score_columns = score_batch(messages_df[_target_column(filtered)], filtered=filtered, analyzer_names=('textblob_pa', 'textblob_nba'))
+    for column_name, scores in score_columns.items():
+        messages_df[column_name] = scores
     return messages_df
 
 
+def filter_stopwords_batch(texts, language='english', filter_punctuation=True):
+    """
+    Remove stopwords, and optionally punctuation, from every text.
+
+    Each distinct text is tokenized once, however often it repeats, and each distinct
+    token is looked up once against a frozen stopword set.
+
+    Parameters
+    ----------
+    texts : iterable of str
+        Messages to filter. Missing values become empty strings.
+    language : str, optional
+        NLTK stopword and punkt language. The default is 'english'.
+    filter_punctuation : bool, optional
+        Also drop tokens made only of punctuation, such as '.', '?!' or '...'. The
+        default is True.
+
+    Returns
+    -------
+    filtered_texts : list of str
+        The remaining tokens of each text joined by single spaces.
+
+    """
+    stop_words = get_stopwords(language)
+    keep_by_token = {}
+    filtered_by_text = {}
+    filtered_texts = []
+    for text in texts:
+        if not isinstance(text, str):
+            text = ''
+        filtered_text = filtered_by_text.get(text)
+        if filtered_text is None:
+            kept_tokens = []
+            for token in tokenize_words(text, language):
+                keep_token = keep_by_token.get(token)
+                if keep_token is None:
+                    keep_token = keep_by_token[token] = (token.lower() not in stop_words and
+                                                         not (filter_punctuation and not token.strip(string.punctuation)))
+                if keep_token:
+                    kept_tokens.append(token)
+            filtered_text = filtered_by_text[text] = ' '.join(kept_tokens)
+        filtered_texts.append(filtered_text)
+    return filtered_texts
+
+
 def remove_stopwords_from_mesages(messages_df, filter_punctuation=True):
-    stop_words = set(stopwords.words('english'))
-    if filter_punctuation:
-        stop_words = stop_words + list(string.punctuation)
-    no_sw_message_list = []
-    for index, sentence_transcript_entry in enumerate(messages_df):
-        message_word_tokens = word_tokenize(sentence_transcript_entry['censoredShortBody'])
-        filtered_sentence = [word for word in message_word_tokens if not word.lower() in stop_words]
-        no_sw_message_list.append(filtered_sentence)
-    messages_df['no_stopwords_message_text'] = no_sw_message_list
+    messages_df['no_stopwords_message_text'] = filter_stopwords_batch(messages_df['censoredShortBody'], filter_punctuation=filter_punctuation)
+    return messages_df
+
+
+def calculate_transformer_sentiment(messages_df, filtered=False):
+    # calculate score from the SENTIMENT_TRANSFORMER_MODEL classifier, in length-bucketed batches
+    score_columns = score_batch(messages_df[_target_column(filtered)], filtered=filtered, analyzer_names=('transformer',))
+    for column_name, scores in score_columns.items():
+        messages_df[column_name] = scores
     return messages_df
 
 
-#def calculate_flair_sentiment(messages_df, filtered=False):
-#    classifier = TextClassifier.load('en-sentiment')
-#    flair_sentiment_score_list = []
-#    if filtered:
-#        target_col = 'no_stopwords_message_text'
-#        filtered_flag = '_filtered'
-#    else:
-#        target_col = 'censoredShortBody'
-#        filtered_flag = ''
-#    for message in messages_df[target_col]:
-#        message = Sentence(message)
-#        classifier.predict(message)
-#        value = message.labels[0].to_dict()['value']
-#        if value == 'POSITIVE':
-#            result = message.to_dict()['labels'][0]['confidence']
-#        else:
-#            result = -(message.to_dict()['labels'][0]['confidence'])
-#        result = round(result, 3)
-#        flair_sentiment_score_list.append(result)
-#    messages_df[f'flair_sentiment_score{filtered_flag}'] = flair_sentiment_score_list
-#    return messages_df
-
-
-def sentiment_main(messages_df):
+def _score_messages(messages_df):
     messages_df = calculate_vader_sentiment(messages_df)
     messages_df = calculate_textblob_sentiment(messages_df)
-    # messages_df = calculate_flair_sentiment(messages_df)
+    # The transformer reads negations and context that stopword removal strips out, so
+    # it only scores the unfiltered text.
+    if transformer_sentiment_enabled():
+        messages_df = calculate_transformer_sentiment(messages_df)
     messages_df = remove_stopwords_from_mesages(messages_df, filter_punctuation=True)
     messages_df = calculate_vader_sentiment(messages_df, filtered=True)
     messages_df = calculate_textblob_sentiment(messages_df, filtered=True)
-    # messages_df = calculate_flair_sentiment(messages_df, filtered=True)
     return messages_df
 
 
+def sentiment_main(messages_df, parallel=False, n_workers=None, chunk_size=None):
+    """
+    Add every sentiment score column to messages_df.
+
+    Parameters
+    ----------
+    messages_df : Pandas DataFrame
+        Transcript messages with a 'censoredShortBody' column.
+    parallel : bool, optional
+        Shard messages_df into chunks and score them across a process pool. Each worker
+        warms its analyzers once when it starts. The output columns and row order are
+        identical to the serial path. The default is False.
+    n_workers : int, optional
+        Number of worker processes. The default is the SENTIMENT_WORKERS environment
+        variable, or the number of CPUs.
+    chunk_size : int, optional
+        Number of messages per chunk. The default is the SENTIMENT_CHUNK_SIZE
+        environment variable, or 5000.
+
+    Returns
+    -------
+    messages_df : Pandas DataFrame
+        messages_df with the sentiment score columns added.
+
+    """
+    if chunk_size is None:
+        chunk_size = SENTIMENT_CHUNK_SIZE
+    if not parallel or len(messages_df) <= chunk_size:
+        return _score_messages(messages_df)
+    if n_workers is None:
+        n_workers = SENTIMENT_WORKERS
+    message_chunks = [messages_df.iloc[chunk_start:chunk_start+chunk_size]
+                      for chunk_start in range(0, len(messages_df), chunk_size)]
+    with ProcessPoolExecutor(max_workers=n_workers, initializer=warm_analyzers) as executor:
+        scored_chunks = list(executor.map(_score_messages, message_chunks))
+    return pd.concat(scored_chunks, axis=0)
+
+
 if __name__=='__main__':
     sentiment_main(messages_df='')
\ No newline at end of file
@@ -0,0 +1,134 @@
+import sqlite3
+import hashlib
+import json
+import os
+import threading
+from collections import OrderedDict
+from dotenv import load_dotenv
+
+
+load_dotenv('.env')
+SENTIMENT_CACHE_DB_PATH = os.getenv('SENTIMENT_CACHE_DB_PATH', os.path.abspath('sentiment_score_cache.sqlite3'))
+SENTIMENT_CACHE_MEMORY_ENTRIES = int(os.getenv('SENTIMENT_CACHE_MEMORY_ENTRIES', 200000))
+_SQLITE_MAX_PARAMETERS = 500
+
+
+def normalize_message_text(message):
+    # Only whitespace is normalized. Case and punctuation change VADER scores
+    # (capitalized words and "!" are boosted), so they are part of the key.
+    return ' '.join(message.split())
+
+
+class SentimentScoreCache:
+    """
+    Content-addressed cache of sentiment scores: an in-memory LRU in front of a SQLite
+    store. Entries are keyed by a sha256 of the analyzer version and the normalized
+    message text, so upgrading an analyzer never returns stale scores.
+
+    Parameters
+    ----------
+    db_path : str, optional
+        Path of the SQLite file, or None to keep the cache in memory only. The default
+        is the SENTIMENT_CACHE_DB_PATH environment variable, or
+        sentiment_score_cache.sqlite3 in the working directory.
+    max_memory_entries : int, optional
+        Size of the in-memory LRU. The default is the SENTIMENT_CACHE_MEMORY_ENTRIES
+        environment variable, or 200000.
+
+    """
+
+    def __init__(self, db_path=SENTIMENT_CACHE_DB_PATH, max_memory_entries=SENTIMENT_CACHE_MEMORY_ENTRIES):
+        self.max_memory_entries = max_memory_entries
+        self._memory = OrderedDict()
+        self._lock = threading.Lock()
+        self._stats = {'memory_hits': 0, 'disk_hits': 0, 'misses': 0}
+        self._connection = None
+        if db_path is not None:
+            self._connection = sqlite3.connect(db_path, timeout=30, check_same_thread=False)
+            self._connection.execute('PRAGMA journal_mode=WAL')
+            self._connection.execute('''CREATE TABLE IF NOT EXISTS sentiment_scores (
+                                            cache_key TEXT PRIMARY KEY,
+                                            scores TEXT NOT NULL)''')
+            self._connection.commit()
+
+    @staticmethod
+    def make_key(analyzer_version, message):
+        return hashlib.sha256(f'{analyzer_version}\0{normalize_message_text(message)}'.encode('utf-8')).hexdigest()
+
+    def _remember(self, cache_key, scores):
+        self._memory[cache_key] = scores
+        self._memory.move_to_end(cache_key)
+        if len(self._memory) > self.max_memory_entries:
+            self._memory.popitem(last=False)
+        return
+
+    def get_many(self, cache_keys):
+        """
+        Look up cache_keys, returning a list of score tuples aligned with them and None
+        for every miss.
+        """
+        with self._lock:
+            results = [None] * len(cache_keys)
+            disk_lookups = {}
+            for position, cache_key in enumerate(cache_keys):
+                scores = self._memory.get(cache_key)
+                if scores is not None:
+                    self._memory.move_to_end(cache_key)
+                    results[position] = scores
+                    self._stats['memory_hits'] += 1
+                else:
+                    disk_lookups.setdefault(cache_key, []).append(position)
+            if disk_lookups and self._connection is not None:
+                lookup_keys = list(disk_lookups)
+                for batch_start in range(0, len(lookup_keys), _SQLITE_MAX_PARAMETERS):
+                    batch_keys = lookup_keys[batch_start:batch_start+_SQLITE_MAX_PARAMETERS]
+                    placeholders = ','.join('?' * len(batch_keys))
+                    rows = self._connection.execute(f'SELECT cache_key, scores FROM sentiment_scores WHERE cache_key IN ({placeholders})',
+                                                    batch_keys).fetchall()
+                    for cache_key, scores_json in rows:
+                        scores = tuple(json.loads(scores_json))
+                        self._remember(cache_key, scores)
+                        for position in disk_lookups.pop(cache_key):
+                            results[position] = scores
+                            self._stats['disk_hits'] += 1
+            self._stats['misses'] += sum(len(positions) for positions in disk_lookups.values())
+        return results
+
+    def put_many(self, cache_keys, score_rows):
+        with self._lock:
+            for cache_key, scores in zip(cache_keys, score_rows):
+                self._remember(cache_key, tuple(scores))
+            if self._connection is not None:
+                self._connection.executemany('INSERT OR REPLACE INTO sentiment_scores (cache_key, scores) VALUES (?, ?)',
+                                             [(cache_key, json.dumps(list(scores))) for cache_key, scores in zip(cache_keys, score_rows)])
+                self._connection.commit()
+        return
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+        lookups = stats['memory_hits'] + stats['disk_hits'] + stats['misses']
+        stats['lookups'] = lookups
+        stats['hit_rate'] = (stats['memory_hits'] + stats['disk_hits']) / lookups if lookups else 0.0
+        return stats
+
+    def close(self):
+        if self._connection is not None:
+            self._connection.close()
+            self._connection = None
+        return
+
+
+_SCORE_CACHES = {}
+
+
+def get_score_cache():
+    """
+    Return this process's shared SentimentScoreCache. Caches are kept per process id
+    so pool workers never share a SQLite connection inherited across a fork.
+    """
+    score_cache = _SCORE_CACHES.get(os.getpid())
+    if score_cache is None:
+        score_cache = SentimentScoreCache()
+        _SCORE_CACHES[os.getpid()] = score_cache
+    return score_cache
@@ -19,10 +19,10 @@
       var userInput = $scope.url;
 
       // fire the API request
-      $http.post('/check_refresh_needed').
+      $http.post('/check_refresh_needed', {property: $scope.selectedProperty}).
         success(function(results) {
           $log.log(results);
-          getProspects(results);
+          getProspects(results.job_id);
           $scope.prospects = null;
           $scope.loading = true;
           $scope.refreshButtonText = 'Loading...';
@@ -0,0 +1,14 @@
+import os
+import sys
+import pytest
+
+# The modules live at the repository root rather than in a package.
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+@pytest.fixture
+def sqlite_engine(tmp_path):
+    from sqlalchemy import create_engine
+    engine = create_engine(f'sqlite:///{tmp_path / "transcripts.sqlite3"}')
+    yield engine
+    engine.dispose()
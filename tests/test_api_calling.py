@@ -0,0 +1,37 @@
+from datetime import datetime, timezone
+import pandas as pd
+from api_calling import check_for_targets_and_time_elapsed
+
+
+NOW = datetime(2022, 5, 2, 12, 0, tzinfo=timezone.utc)
+
+
+def _messages(rows):
+    return pd.DataFrame(rows, columns=['id', 'transcript', 'timeCreated', 'isInbound'])
+
+
+def test_targets_are_found_in_message_order():
+    messages_df = _messages([(1, 't/1', '2022-05-02T09:00:00Z', True),
+                             (2, 't/1', '2022-05-02T09:05:00Z', False),
+                             (3, 't/2', '2022-05-02T11:30:00Z', True),
+                             (4, 't/2', '2022-05-02T11:35:00Z', False),
+                             (5, 't/3', '2022-05-02T09:00:00Z', False),
+                             (6, 't/3', '2022-05-02T09:05:00Z', True)])
+    outreach_flag_df, hour_waitlist_df = check_for_targets_and_time_elapsed(messages_df, 'test', now=NOW)
+    assert outreach_flag_df['id'].tolist() == [1, 2]
+    assert hour_waitlist_df['id'].tolist() == [3, 4]
+
+
+def test_out_of_order_messages_are_sorted_before_classifying():
+    # t/1 reads inbound-then-outbound only once sorted by time; t/3 ends on an inbound
+    # reply even though that reply comes first in the frame.
+    messages_df = _messages([(6, 't/3', '2022-05-02T09:05:00Z', True),
+                             (2, 't/1', '2022-05-02T09:05:00Z', False),
+                             (4, 't/2', '2022-05-02T11:35:00Z', False),
+                             (5, 't/3', '2022-05-02T09:00:00Z', False),
+                             (1, 't/1', '2022-05-02T09:00:00Z', True),
+                             (3, 't/2', '2022-05-02T11:30:00Z', True)])
+    outreach_flag_df, hour_waitlist_df = check_for_targets_and_time_elapsed(messages_df, 'test', now=NOW)
+    assert outreach_flag_df['id'].tolist() == [1, 2]
+    assert outreach_flag_df['seconds_elapsed'].tolist() == [10500.0, 10500.0]
+    assert hour_waitlist_df['id'].tolist() == [3, 4]
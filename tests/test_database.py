@@ -0,0 +1,91 @@
+import pandas as pd
+from sqlalchemy import inspect
+from database import bulk_upsert_dataframe, MESSAGE_SQL_DTYPES
+from message_buffer import compact_frame, MESSAGE_CATEGORY_COLUMNS, MESSAGE_DATETIME_COLUMNS
+
+
+def _day_messages(status='SENT'):
+    return compact_frame(pd.DataFrame({'id': [1, 2, 3],
+                                       'transcript': ['t/1', 't/1', 't/2'],
+                                       'timeCreated': ['2022-05-01T10:00:00', '2022-05-01T10:05:00', '2022-05-01T11:00:00'],
+                                       'isInbound': [True, False, True],
+                                       'messageStatus': [status] * 3,
+                                       'compound_polarity_VS': [0.1, 0.2, 0.3]}),
+                         MESSAGE_CATEGORY_COLUMNS, MESSAGE_DATETIME_COLUMNS)
+
+
+def _upsert(messages_df, engine):
+    return bulk_upsert_dataframe(messages_df, engine, 'chatbot_messages', logger_name='test', key_columns=('id',), dtype=MESSAGE_SQL_DTYPES)
+
+
+def test_reupserting_a_day_updates_rows_in_place(sqlite_engine):
+    assert _upsert(_day_messages(), sqlite_engine) == 3
+    assert _upsert(_day_messages(status='DELIVERED'), sqlite_engine) == 3
+    stored_df = pd.read_sql('SELECT id, messageStatus FROM chatbot_messages ORDER BY id', sqlite_engine)
+    assert stored_df['id'].tolist() == [1, 2, 3]
+    assert stored_df['messageStatus'].tolist() == ['DELIVERED'] * 3
+
+
+def test_repeated_keys_in_one_frame_keep_the_last_row(sqlite_engine):
+    messages_df = pd.concat([_day_messages(), _day_messages(status='READ').iloc[[0]]], ignore_index=True)
+    assert _upsert(messages_df, sqlite_engine) == 3
+    assert pd.read_sql('SELECT messageStatus FROM chatbot_messages WHERE id = 1', sqlite_engine)['messageStatus'].tolist() == ['READ']
+
+
+def test_new_columns_are_added_to_an_existing_table(sqlite_engine):
+    _upsert(_day_messages(), sqlite_engine)
+    transformer_scored_df = _day_messages().assign(no_stopwords_message_text='hello',
+                                                   sentiment_label_TF='POSITIVE',
+                                                   sentiment_polarity_TF=[0.5, -0.25, 0.75],
+                                                   sentiment_pos_probability_TF=[0.75, 0.375, 0.875])
+    assert _upsert(transformer_scored_df, sqlite_engine) == 3
+    stored_columns = {column['name'] for column in inspect(sqlite_engine).get_columns('chatbot_messages')}
+    assert {'sentiment_label_TF', 'sentiment_polarity_TF', 'sentiment_pos_probability_TF', 'no_stopwords_message_text'} <= stored_columns
+    stored_df = pd.read_sql('SELECT id, sentiment_polarity_TF FROM chatbot_messages ORDER BY id', sqlite_engine)
+    assert stored_df['sentiment_polarity_TF'].tolist() == [0.5, -0.25, 0.75]
+
+
+def test_ids_outgrowing_the_first_batch_fit_the_table(sqlite_engine):
+    _upsert(_day_messages(), sqlite_engine)
+    large_id_df = _day_messages().assign(id=[2**40, 2**40 + 1, 2**40 + 2])
+    assert large_id_df['id'].dtype == 'int64'
+    _upsert(large_id_df, sqlite_engine)
+    assert pd.read_sql('SELECT MAX(id) AS max_id FROM chatbot_messages', sqlite_engine)['max_id'].iloc[0] == 2**40 + 2
+
+
+def test_get_table_on_a_cold_process(sqlite_engine, monkeypatch):
+    import threading
+    import database
+    monkeypatch.setenv('SQL_ENGINE_URL', sqlite_engine.url.render_as_string(hide_password=False))
+    monkeypatch.setattr(database, '_ENGINES', {})
+    monkeypatch.setattr(database, '_REFLECTED_TABLES', {})
+    _upsert(_day_messages(), sqlite_engine)
+    reflected_tables = []
+    # Run in a thread so a deadlock fails the test instead of hanging it.
+    reflect_thread = threading.Thread(target=lambda: reflected_tables.append(database.get_table('chatbot_messages', schema=None)), daemon=True)
+    reflect_thread.start()
+    reflect_thread.join(timeout=10)
+    assert not reflect_thread.is_alive()
+    assert {'id', 'transcript', 'messageStatus'} <= set(reflected_tables[0].c.keys())
+    database.dispose_engine()
+
+
+def test_legacy_table_is_split_into_prospects_and_messages(sqlite_engine, monkeypatch):
+    import database
+    monkeypatch.setenv('SQL_ENGINE_URL', sqlite_engine.url.render_as_string(hide_password=False))
+    monkeypatch.setattr(database, '_ENGINES', {})
+    monkeypatch.setattr(database, '_REFLECTED_TABLES', {})
+    legacy_df = _day_messages().assign(property='Foxchase',
+                                       timeLastMessage=pd.to_datetime(['2022-05-01T10:00:00', '2022-05-01T10:05:00', '2022-05-01T11:00:00']),
+                                       countInboundMessages=[1, 1, 1])
+    legacy_df.to_sql('chatbot_transcripts', sqlite_engine, index=False)
+    assert database.migrate_legacy_transcript_table('test', legacy_table_name='chatbot_transcripts', schema=None, chunksize=2) == 3
+    prospects_df = pd.read_sql('SELECT transcript, timeLastMessage FROM chatbot_prospects ORDER BY transcript', sqlite_engine)
+    assert prospects_df['transcript'].tolist() == ['t/1', 't/2']
+    # The prospect row keeps the values from the transcript's latest message.
+    assert pd.to_datetime(prospects_df['timeLastMessage']).tolist() == [pd.Timestamp('2022-05-01T10:05:00'), pd.Timestamp('2022-05-01T11:00:00')]
+    messages_df = pd.read_sql('SELECT * FROM chatbot_messages ORDER BY id', sqlite_engine)
+    assert messages_df['id'].tolist() == [1, 2, 3]
+    assert 'property' not in messages_df.columns
+    assert database.has_table('chatbot_messages', schema=None)
+    database.dispose_engine()
@@ -0,0 +1,123 @@
+import os
+import time
+import pandas as pd
+import pytest
+import datarobot_scoring
+import prediction_cache
+from benchmarks.prediction_standin import PredictionStandinServer
+from datarobot_scoring import DataRobotScoringError, score_prospects
+from prediction_cache import PredictionCache
+
+
+@pytest.fixture
+def cache(tmp_path, monkeypatch):
+    prospect_prediction_cache = PredictionCache(str(tmp_path / 'prediction_cache.sqlite3'))
+    monkeypatch.setitem(prediction_cache._PREDICTION_CACHES, os.getpid(), prospect_prediction_cache)
+    yield prospect_prediction_cache
+    prospect_prediction_cache.close()
+
+
+@pytest.fixture
+def standin():
+    with PredictionStandinServer() as prediction_standin:
+        yield prediction_standin
+
+
+def _prospects(row_count):
+    return pd.DataFrame({'property': [f'property{row % 3}' for row in range(row_count)],
+                         'countInboundMessages': list(range(row_count)),
+                         'compound_polarity_VS': [round(row / row_count, 4) for row in range(row_count)]},
+                        index=[f'prospect{row}' for row in range(row_count)])
+
+
+def _expected_probabilities(prospects_df):
+    # The stand-in derives each prediction from the row as it appears in the CSV body.
+    csv_lines = prospects_df.to_csv(index=False).splitlines()[1:]
+    return [PredictionStandinServer.predict_row(row_id, csv_line.split(','))['predictionValues'][0]['value']
+            for row_id, csv_line in enumerate(csv_lines)]
+
+
+def _score(prospects_df, standin, **kwargs):
+    return score_prospects(prospects_df, 'deployment1', 'model1', 'test', url_base=standin.base_url,
+                           max_requests_per_second=0, **kwargs)
+
+
+def test_predictions_follow_row_order_when_chunks_finish_out_of_order(standin, cache):
+    # Hold back the chunk holding the first prospect so every later chunk finishes first.
+    finished_chunk_rows = []
+
+    def predict_row(row_id, feature_row):
+        if row_id == 0:
+            if feature_row[1] == '0':
+                time.sleep(0.3)
+            finished_chunk_rows.append(int(feature_row[1]))
+        return PredictionStandinServer.predict_row(row_id, feature_row)
+
+    standin.predict_row = predict_row
+    prospects_df = _prospects(50)
+    predictions_df = _score(prospects_df, standin, chunk_rows=10, max_in_flight=5)
+    assert standin.request_count == 5
+    assert finished_chunk_rows[-1] == 0
+    assert predictions_df.index.tolist() == prospects_df.index.tolist()
+    assert predictions_df['prediction_value_1'].tolist() == pytest.approx(_expected_probabilities(prospects_df))
+    assert predictions_df['prediction'].tolist() == [int(probability >= 0.5) for probability in _expected_probabilities(prospects_df)]
+
+
+def test_cached_chunks_are_not_sent_again(standin, cache):
+    prospects_df = _prospects(30)
+    first_predictions_df = _score(prospects_df, standin, chunk_rows=10)
+    assert (standin.request_count, standin.row_count) == (3, 30)
+    second_predictions_df = _score(prospects_df, standin, chunk_rows=10)
+    assert (standin.request_count, standin.row_count) == (3, 30)
+    pd.testing.assert_frame_equal(first_predictions_df, second_predictions_df)
+    # Only the changed prospect is sent.
+    prospects_df.loc['prospect7', 'countInboundMessages'] = 700
+    changed_predictions_df = _score(prospects_df, standin, chunk_rows=10)
+    assert (standin.request_count, standin.row_count) == (4, 31)
+    assert changed_predictions_df.drop(index='prospect7').equals(first_predictions_df.drop(index='prospect7'))
+    # A new model id is a cache miss for every prospect.
+    score_prospects(prospects_df, 'deployment1', 'model2', 'test', url_base=standin.base_url, chunk_rows=10, max_requests_per_second=0)
+    assert standin.row_count == 61
+
+
+def test_duplicate_prospects_are_sent_once(standin, cache):
+    prospects_df = pd.concat([_prospects(5), _prospects(5)])
+    predictions_df = _score(prospects_df, standin)
+    assert standin.row_count == 5
+    assert predictions_df['prediction_value_1'].tolist()[:5] == predictions_df['prediction_value_1'].tolist()[5:]
+
+
+def test_chunks_are_sent_as_gzipped_csv(standin, cache):
+    _score(_prospects(25), standin, chunk_rows=10, use_cache=False)
+    assert standin.compressed_request_count == standin.request_count == 3
+    assert standin.content_types == {'text/csv; charset=UTF-8'}
+    assert standin.row_count == 25
+
+
+def test_scored_chunks_are_cached_when_another_chunk_fails(standin, cache, monkeypatch):
+    # Fail the third chunk; the other two should still be cached.
+    original_parse = datarobot_scoring._parse_prediction_rows
+    failing_chunk_sizes = {5}
+
+    def parse_prediction_rows(response_json, row_count):
+        if row_count in failing_chunk_sizes:
+            raise DataRobotScoringError('Injected failure.')
+        return original_parse(response_json, row_count)
+
+    monkeypatch.setattr(datarobot_scoring, '_parse_prediction_rows', parse_prediction_rows)
+    prospects_df = _prospects(25)
+    with pytest.raises(DataRobotScoringError):
+        _score(prospects_df, standin, chunk_rows=10)
+    assert standin.row_count == 25
+    failing_chunk_sizes.clear()
+    _score(prospects_df, standin, chunk_rows=10)
+    assert standin.row_count == 30
+
+
+def test_missing_values_hash_the_same_however_they_are_spelled():
+    features_df = pd.DataFrame({'countInboundMessages': pd.array([3, pd.NA, None], dtype='Int64'),
+                                'source': pd.array(['web', pd.NA, None], dtype='string'),
+                                'conversationLengthInSeconds': [10.0, float('nan'), None]})
+    feature_hashes = prediction_cache.hash_prospect_features(features_df)
+    assert feature_hashes[1] == feature_hashes[2]
+    assert feature_hashes[0] != feature_hashes[1]
@@ -0,0 +1,202 @@
+import threading
+import time
+import pytest
+import requests
+from email.utils import format_datetime
+from datetime import datetime, timedelta, timezone
+from benchmarks.standin_server import ChatbotStandinServer
+from request_controller import CircuitOpenError, RequestController, parse_retry_after
+from transcript_fetcher import fetch_transcripts
+
+
+@pytest.fixture
+def standin():
+    with ChatbotStandinServer(n_prospects=200, messages_per_transcript=4) as chatbot_standin:
+        yield chatbot_standin
+
+
+def _transcript_url(standin, transcript_index=0):
+    return f'{standin.base_url}/transcripts/{transcript_index}'
+
+
+def _get(url, on_response=None):
+    def attempt():
+        response = requests.get(url, timeout=10)
+        if on_response is not None:
+            on_response(response)
+        return response.status_code, response.headers, response
+    return attempt
+
+
+def _host_stats(request_controller, standin):
+    return request_controller.stats()[standin.base_url.split('://', 1)[1]]
+
+
+def test_parse_retry_after():
+    assert parse_retry_after('2') == 2.0
+    assert parse_retry_after('-1') == 0.0
+    assert parse_retry_after(None) is None
+    assert parse_retry_after('soon') is None
+    retry_at = datetime.now(timezone.utc) + timedelta(seconds=30)
+    assert 25 <= parse_retry_after(format_datetime(retry_at, usegmt=True)) <= 30
+
+
+def test_limit_grows_by_one_per_limit_of_fast_responses(standin):
+    request_controller = RequestController(initial_concurrency=2, max_concurrency=8, slow_start=False, latency_target_seconds=5)
+    url = _transcript_url(standin)
+    for _ in range(20):
+        assert request_controller.send(url, _get(url)).status_code == 200
+    host_stats = _host_stats(request_controller, standin)
+    assert 5 <= host_stats['limit'] <= 8
+    assert (host_stats['requests'], host_stats['retries'], host_stats['drops']) == (20, 0, 0)
+
+
+def test_slow_start_grows_the_limit_by_one_per_fast_response_until_overload(standin):
+    request_controller = RequestController(initial_concurrency=2, max_concurrency=64, latency_target_seconds=5, max_retries=0)
+    url = _transcript_url(standin)
+    for _ in range(20):
+        request_controller.send(url, _get(url))
+    assert _host_stats(request_controller, standin)['limit'] == 22
+    standin.error_rate = 1.0
+    request_controller.send(url, _get(url))
+    standin.error_rate = 0.0
+    for _ in range(5):
+        request_controller.send(url, _get(url))
+    # Halved on the error, then back to additive increase.
+    assert _host_stats(request_controller, standin)['limit'] == 11
+
+
+def test_limit_stays_under_max_concurrency(standin):
+    request_controller = RequestController(initial_concurrency=2, max_concurrency=3)
+    url = _transcript_url(standin)
+    for _ in range(30):
+        request_controller.send(url, _get(url))
+    assert _host_stats(request_controller, standin)['limit'] == 3
+
+
+def test_slow_responses_shrink_the_limit(standin):
+    standin.latency_seconds = 0.05
+    request_controller = RequestController(initial_concurrency=8, latency_target_seconds=0.01)
+    url = _transcript_url(standin)
+    request_controller.send(url, _get(url))
+    assert _host_stats(request_controller, standin)['limit'] == 4
+
+
+def test_throttles_shrink_the_limit_and_are_given_up_after_the_last_retry(standin):
+    standin.throttle_rate = 1.0
+    standin.retry_after_seconds = 0.01
+    request_controller = RequestController(initial_concurrency=16, max_retries=2, failure_threshold=100)
+    url = _transcript_url(standin)
+    response = request_controller.send(url, _get(url))
+    assert response.status_code == 429
+    assert standin.fault_counts['throttled'] == 3
+    host_stats = _host_stats(request_controller, standin)
+    assert (host_stats['retries'], host_stats['drops']) == (2, 1)
+    assert host_stats['limit'] == 2
+
+
+def test_retry_waits_for_retry_after(standin):
+    standin.throttle_rate = 1.0
+    standin.retry_after_seconds = 0.3
+
+    def stop_throttling(response):
+        standin.throttle_rate = 0.0
+
+    # A backoff this long would make the test time out if Retry-After were ignored.
+    request_controller = RequestController(backoff_base_seconds=60, backoff_max_seconds=60)
+    url = _transcript_url(standin)
+    start_time = time.monotonic()
+    response = request_controller.send(url, _get(url, on_response=stop_throttling))
+    elapsed_seconds = time.monotonic() - start_time
+    assert response.status_code == 200
+    assert 0.3 <= elapsed_seconds < 5
+    assert _host_stats(request_controller, standin)['retries'] == 1
+
+
+def test_connection_errors_are_retried_and_then_raised():
+    request_controller = RequestController(max_retries=2, backoff_base_seconds=0.01)
+    attempt_count = 0
+
+    def attempt():
+        nonlocal attempt_count
+        attempt_count += 1
+        raise requests.ConnectionError('refused')
+
+    with pytest.raises(requests.ConnectionError):
+        request_controller.send('http://127.0.0.1:9/transcripts/0', attempt, retry_exceptions=(requests.ConnectionError,))
+    assert attempt_count == 3
+
+
+def test_circuit_opens_then_probe_reopens_or_closes_it(standin):
+    standin.error_rate = 1.0
+    request_controller = RequestController(max_retries=0, failure_threshold=3, reset_seconds=0.3)
+    url = _transcript_url(standin)
+    for _ in range(3):
+        assert request_controller.send(url, _get(url)).status_code == 503
+    assert _host_stats(request_controller, standin)['circuit_open']
+    # Open: refused without reaching the server.
+    with pytest.raises(CircuitOpenError):
+        request_controller.send(url, _get(url))
+    assert standin.fault_counts['requests'] == 3
+    # Half-open: one probe goes through, and its failure opens the circuit again.
+    time.sleep(0.35)
+    assert request_controller.send(url, _get(url)).status_code == 503
+    assert standin.fault_counts['requests'] == 4
+    with pytest.raises(CircuitOpenError):
+        request_controller.send(url, _get(url))
+    # A successful probe closes it.
+    time.sleep(0.35)
+    standin.error_rate = 0.0
+    assert request_controller.send(url, _get(url)).status_code == 200
+    assert not _host_stats(request_controller, standin)['circuit_open']
+    assert request_controller.send(url, _get(url)).status_code == 200
+    assert _host_stats(request_controller, standin)['drops'] == 6
+
+
+def test_only_one_probe_is_let_through_while_half_open(standin):
+    standin.error_rate = 1.0
+    request_controller = RequestController(max_retries=0, failure_threshold=1, reset_seconds=0.2)
+    url = _transcript_url(standin)
+    request_controller.send(url, _get(url))
+    time.sleep(0.25)
+    standin.error_rate = 0.0
+    standin.latency_seconds = 0.3
+    probe_responses = []
+    probe_thread = threading.Thread(target=lambda: probe_responses.append(request_controller.send(url, _get(url))))
+    probe_thread.start()
+    time.sleep(0.1)
+    with pytest.raises(CircuitOpenError):
+        request_controller.send(url, _get(url))
+    probe_thread.join()
+    assert probe_responses[0].status_code == 200
+    assert request_controller.send(url, _get(url)).status_code == 200
+
+
+def test_fetcher_adapts_to_a_server_concurrency_cap(standin):
+    standin.max_concurrency = 4
+    standin.retry_after_seconds = 0.05
+    standin.latency_seconds = 0.02
+    request_controller = RequestController(initial_concurrency=32, max_retries=8)
+    statuses = []
+    fetch_transcripts(((index, _transcript_url(standin, index)) for index in range(100)),
+                      lambda transcript_response: statuses.append(transcript_response.status),
+                      'test',
+                      request_controller=request_controller)
+    assert statuses == [200] * 100
+    assert standin.fault_counts['over_concurrency'] > 0
+    host_stats = _host_stats(request_controller, standin)
+    assert host_stats['limit'] < 32
+    assert host_stats['drops'] == 0
+
+
+def test_fetcher_skips_transcripts_refused_by_an_open_circuit(standin):
+    standin.error_rate = 1.0
+    request_controller = RequestController(max_retries=0, failure_threshold=5, reset_seconds=60)
+    statuses = []
+    fetch_transcripts(((index, _transcript_url(standin, index)) for index in range(50)),
+                      lambda transcript_response: statuses.append(transcript_response.status),
+                      'test',
+                      request_controller=request_controller)
+    assert statuses == []
+    assert standin.fault_counts['requests'] < 50
+    assert _host_stats(request_controller, standin)['drops'] == 50
@@ -0,0 +1,95 @@
+import json
+import re
+import logging
+from bs4 import BeautifulSoup
+from metrics import timed, counter
+
+
+EXTRACTION_PATH_RAW_DECODE = 'raw_decode'
+EXTRACTION_PATH_SOUP = 'soup'
+
+_SCRIPT_OPEN_PATTERN = re.compile(r'<script\b[^>]*>', re.IGNORECASE)
+_MESSAGES_KEY_PATTERN = re.compile(r'"messages"\s*:\s*')
+_JSON_DECODER = json.JSONDecoder()
+
+EXTRACTION_PATHS = counter('transcript_extraction_path_total', 'Transcript pages parsed by each extraction path.')
+
+
+class TranscriptExtractionError(ValueError):
+    pass
+
+
+def _decode_messages_from(text, start=0, end=None):
+    """
+    Decode the JSON array that follows the first '"messages":' key found in
+    text[start:end], without parsing anything else in the page.
+    """
+    if end is None:
+        end = len(text)
+    key_match = _MESSAGES_KEY_PATTERN.search(text, start, end)
+    if key_match is None:
+        raise TranscriptExtractionError('No "messages" key found.')
+    messages_list, _ = _JSON_DECODER.raw_decode(text, key_match.end())
+    if not isinstance(messages_list, list):
+        raise TranscriptExtractionError('"messages" value is not a JSON array.')
+    return messages_list
+
+
+def _extract_with_raw_decode(transcript_html):
+    # Only the first <script> carries the transcript, matching the original
+    # transcript_soup.find('script') lookup.
+    script_match = _SCRIPT_OPEN_PATTERN.search(transcript_html)
+    if script_match is None:
+        raise TranscriptExtractionError('No <script> tag found.')
+    script_end = transcript_html.find('</script', script_match.end())
+    if script_end == -1:
+        script_end = len(transcript_html)
+    return _decode_messages_from(transcript_html, script_match.end(), script_end)
+
+
+def _extract_with_soup(transcript_html):
+    transcript_soup = BeautifulSoup(transcript_html, features='html.parser')
+    for script in transcript_soup.find_all('script'):
+        soup_script_string = script.text
+        if '"messages"' not in soup_script_string:
+            continue
+        try:
+            return _decode_messages_from(soup_script_string)
+        except ValueError:
+            # Last resort: the fixed-offset slice the transcript layout was first built against.
+            return json.loads(soup_script_string[soup_script_string.index('"messages"')+11:-len('},"messageId":null} })')+1])
+    raise TranscriptExtractionError('No <script> tag with a "messages" array found.')
+
+
+def extract_messages(transcript_html, logger_name):
+    """
+    Pull the embedded "messages" array out of a transcript page.
+
+    The fast path scans to the first <script> tag and decodes only the messages array
+    with json.JSONDecoder.raw_decode. If the page layout no longer matches, the page is
+    parsed with BeautifulSoup instead and every script is searched for the array.
+
+    Parameters
+    ----------
+    transcript_html : str
+        Raw html of the transcript page.
+    logger_name : str
+        Name of the parent logger.
+
+    Returns
+    -------
+    messages_list : list of dict
+        The decoded transcript messages.
+    extraction_path : str
+        EXTRACTION_PATH_RAW_DECODE or EXTRACTION_PATH_SOUP, whichever produced the messages.
+
+    """
+    logger = logging.getLogger(f'{logger_name}.extract_messages')
+    with timed('parse', items=1):
+        try:
+            messages_list, extraction_path = _extract_with_raw_decode(transcript_html), EXTRACTION_PATH_RAW_DECODE
+        except ValueError as e:
+            logger.warning(f'Fast transcript extraction failed ({e}). Falling back to BeautifulSoup.')
+            messages_list, extraction_path = _extract_with_soup(transcript_html), EXTRACTION_PATH_SOUP
+    EXTRACTION_PATHS.inc(path=extraction_path)
+    return messages_list, extraction_path
@@ -0,0 +1,159 @@
+import asyncio
+import aiohttp
+import os
+import time
+import logging
+from collections import namedtuple
+from dotenv import load_dotenv
+from metrics import STAGE_SECONDS, counter
+from request_controller import RETRYABLE_STATUSES, CircuitOpenError, get_request_controller
+
+
+load_dotenv('.env')
+TRANSCRIPT_FETCH_MAX_IN_FLIGHT = int(os.getenv('TRANSCRIPT_FETCH_MAX_IN_FLIGHT', 2048))
+TRANSCRIPT_FETCH_TIMEOUT_SECONDS = float(os.getenv('TRANSCRIPT_FETCH_TIMEOUT_SECONDS', 60))
+TRANSCRIPT_FETCH_KEEPALIVE_SECONDS = float(os.getenv('TRANSCRIPT_FETCH_KEEPALIVE_SECONDS', 30))
+
+# Descriptors left for the log files, SQLite databases and CSV downloads when the
+# in-flight ceiling is fitted under the process's open file limit.
+_RESERVED_FILE_DESCRIPTORS = 64
+
+TRANSCRIPT_FETCH_RESPONSES = counter('transcript_fetch_responses_total', 'Transcript page responses by HTTP status, or error for failed requests.')
+
+TranscriptResponse = namedtuple('TranscriptResponse', ['key', 'url', 'status', 'text', 'headers'])
+
+
+async def _fetch_worker(session, url_queue, on_response, headers_for, request_controller, logger):
+    while True:
+        key, transcript_url = await url_queue.get()
+        request_headers = headers_for(transcript_url) if headers_for is not None else None
+
+        async def fetch_attempt():
+            request_start_time = time.perf_counter()
+            async with session.get(transcript_url, headers=request_headers) as response:
+                # A 304 means the transcript is unchanged since the validators were
+                # recorded, so the body is never downloaded.
+                response_text = None if response.status == 304 else await response.text()
+                transcript_response = TranscriptResponse(key=key,
+                                                         url=transcript_url,
+                                                         status=response.status,
+                                                         text=response_text,
+                                                         headers=response.headers)
+            STAGE_SECONDS.observe(time.perf_counter() - request_start_time, stage='fetch')
+            TRANSCRIPT_FETCH_RESPONSES.inc(status=response.status)
+            return transcript_response.status, transcript_response.headers, transcript_response
+
+        try:
+            transcript_response = await request_controller.send_async(transcript_url, fetch_attempt,
+                                                                      retry_exceptions=(aiohttp.ClientError, asyncio.TimeoutError))
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            TRANSCRIPT_FETCH_RESPONSES.inc(status='error')
+            logger.warning(f'Transcript request failed for {transcript_url}: {e!r}')
+            url_queue.task_done()
+            continue
+        except CircuitOpenError:
+            # Counted in http_request_drops_total; the transcript state is not updated,
+            # so the next run fetches it again.
+            logger.debug('Skipped %s while its circuit is open.', transcript_url)
+            url_queue.task_done()
+            continue
+        if transcript_response.status in RETRYABLE_STATUSES:
+            logger.warning(f'Transcript request for {transcript_url} still failed with HTTP {transcript_response.status} after retries.')
+            url_queue.task_done()
+            continue
+        try:
+            on_response(transcript_response)
+        except Exception:
+            logger.exception(f'Transcript response handler failed for {transcript_url}.')
+        finally:
+            url_queue.task_done()
+
+
+async def _fetch_all(transcript_requests, on_response, max_in_flight, headers_for, request_controller, logger):
+    connector = aiohttp.TCPConnector(limit=max_in_flight,
+                                     keepalive_timeout=TRANSCRIPT_FETCH_KEEPALIVE_SECONDS)
+    timeout = aiohttp.ClientTimeout(total=TRANSCRIPT_FETCH_TIMEOUT_SECONDS)
+    # A bounded queue keeps memory flat when the url iterable is very large; the
+    # workers pull the next url as soon as a socket frees up.
+    url_queue = asyncio.Queue(maxsize=max_in_flight * 2)
+    async with aiohttp.ClientSession(connector=connector, timeout=timeout) as session:
+        workers = [asyncio.create_task(_fetch_worker(session, url_queue, on_response, headers_for, request_controller, logger))
+                   for _ in range(max_in_flight)]
+        try:
+            for key, transcript_url in transcript_requests:
+                await url_queue.put((key, transcript_url))
+            await url_queue.join()
+        finally:
+            for worker in workers:
+                worker.cancel()
+            await asyncio.gather(*workers, return_exceptions=True)
+    return
+
+
+def _fit_open_file_limit(max_in_flight, logger):
+    # Every request in flight holds a socket. Raise the soft open file limit toward the
+    # hard limit if needed, and lower max_in_flight if that is still not enough.
+    try:
+        import resource
+    except ImportError:
+        # Windows has no per-process descriptor limit to fit under.
+        return max_in_flight
+    soft_limit, hard_limit = resource.getrlimit(resource.RLIMIT_NOFILE)
+    needed_limit = max_in_flight + _RESERVED_FILE_DESCRIPTORS
+    if soft_limit != resource.RLIM_INFINITY and soft_limit < needed_limit:
+        new_soft_limit = needed_limit if hard_limit == resource.RLIM_INFINITY else min(needed_limit, hard_limit)
+        try:
+            resource.setrlimit(resource.RLIMIT_NOFILE, (new_soft_limit, hard_limit))
+            soft_limit = new_soft_limit
+        except (ValueError, OSError):
+            pass
+        if soft_limit < needed_limit:
+            max_in_flight = max(1, soft_limit - _RESERVED_FILE_DESCRIPTORS)
+            logger.warning(f'Open file limit of {soft_limit} caps transcript requests in flight at {max_in_flight}.')
+    return max_in_flight
+
+
+def fetch_transcripts(transcript_requests, on_response, logger_name, max_in_flight=None, headers_for=None, request_controller=None):
+    """
+    Fetch transcript pages concurrently over one pooled keep-alive HTTP client and hand
+    each response to on_response as soon as it arrives.
+
+    Requests go through a RequestController, which retries throttled and failed requests
+    and adapts how many are in flight to the server's responses. Requests that still
+    fail after their retries are logged and skipped.
+
+    Parameters
+    ----------
+    transcript_requests : iterable of (hashable, str)
+        Pairs of (key, transcript_url). The key is passed back untouched so the caller
+        can match the response to its prospect row.
+    on_response : callable
+        Called with a TranscriptResponse for every completed request, in completion order.
+    logger_name : str
+        Name of the parent logger.
+    max_in_flight : int, optional
+        Ceiling on the number of requests in flight at once; the request controller's
+        adaptive limit decides how many below it are used. The default is the
+        TRANSCRIPT_FETCH_MAX_IN_FLIGHT environment variable, or 2048. It is lowered to
+        fit the process's open file limit when that cannot be raised far enough.
+    headers_for : callable, optional
+        Called with each transcript url to get extra request headers, such as the
+        conditional GET validators from TranscriptStateStore.conditional_headers.
+        A 304 reply is passed to on_response with text set to None.
+    request_controller : RequestController, optional
+        The default is the process's shared controller from get_request_controller.
+
+    Returns
+    -------
+    None.
+
+    """
+    logger = logging.getLogger(f'{logger_name}.fetch_transcripts')
+    if max_in_flight is None:
+        max_in_flight = TRANSCRIPT_FETCH_MAX_IN_FLIGHT
+    max_in_flight = _fit_open_file_limit(max_in_flight, logger)
+    if request_controller is None:
+        request_controller = get_request_controller()
+    logger.info(f'Fetching transcripts with up to {max_in_flight} requests in flight.')
+    asyncio.run(_fetch_all(transcript_requests, on_response, max_in_flight, headers_for, request_controller, logger))
+    return
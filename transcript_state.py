@@ -0,0 +1,133 @@
+import sqlite3
+import hashlib
+import os
+from datetime import datetime, timezone
+from dotenv import load_dotenv
+
+
+load_dotenv('.env')
+TRANSCRIPT_STATE_DB_PATH = os.getenv('TRANSCRIPT_STATE_DB_PATH', os.path.abspath(os.path.join('csv_temp', 'transcript_state.sqlite3')))
+
+
+def hash_transcript_content(transcript_response_text):
+    return hashlib.sha256(transcript_response_text.encode('utf-8')).hexdigest()
+
+
+class TranscriptStateStore:
+    """
+    SQLite-backed record of the last seen version of every transcript url: a sha256
+    of the page body, the ETag and Last-Modified validators the server sent, and the
+    id of the last message parsed from it.
+
+    Parameters
+    ----------
+    db_path : str, optional
+        Path of the SQLite file. The default is the TRANSCRIPT_STATE_DB_PATH
+        environment variable, or transcript_state.sqlite3 in ./csv_temp.
+
+    """
+
+    def __init__(self, db_path=None):
+        if db_path is None:
+            db_path = TRANSCRIPT_STATE_DB_PATH
+        if db_path != ':memory:':
+            os.makedirs(os.path.dirname(os.path.abspath(db_path)), exist_ok=True)
+        self.db_path = db_path
+        self._connection = sqlite3.connect(db_path, timeout=30, check_same_thread=False)
+        self._connection.row_factory = sqlite3.Row
+        self._connection.execute('PRAGMA journal_mode=WAL')
+        self._connection.execute('''CREATE TABLE IF NOT EXISTS transcript_state (
+                                        url TEXT PRIMARY KEY,
+                                        content_hash TEXT NOT NULL,
+                                        etag TEXT,
+                                        last_modified TEXT,
+                                        last_message_id TEXT,
+                                        updated_at TEXT NOT NULL)''')
+        self._connection.commit()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        # State recorded inside a block that raised may describe transcripts whose
+        # messages were never stored, so it is discarded rather than committed.
+        if exc_type is not None:
+            self._connection.rollback()
+        self.close()
+        return False
+
+    def get(self, url):
+        row = self._connection.execute('SELECT * FROM transcript_state WHERE url = ?', (url,)).fetchone()
+        return dict(row) if row is not None else None
+
+    def conditional_headers(self, url):
+        """
+        Build the If-None-Match/If-Modified-Since headers for a conditional GET of url.
+        Returns an empty dict for urls that have never been seen.
+        """
+        state = self.get(url)
+        headers = {}
+        if state is None:
+            return headers
+        if state['etag']:
+            headers['If-None-Match'] = state['etag']
+        if state['last_modified']:
+            headers['If-Modified-Since'] = state['last_modified']
+        return headers
+
+    def record(self, url, content_hash, etag=None, last_modified=None, last_message_id=None):
+        self._connection.execute('''INSERT INTO transcript_state (url, content_hash, etag, last_modified, last_message_id, updated_at)
+                                    VALUES (?, ?, ?, ?, ?, ?)
+                                    ON CONFLICT(url) DO UPDATE SET
+                                        content_hash = excluded.content_hash,
+                                        etag = excluded.etag,
+                                        last_modified = excluded.last_modified,
+                                        last_message_id = excluded.last_message_id,
+                                        updated_at = excluded.updated_at''',
+                                 (url, content_hash, etag, last_modified,
+                                  None if last_message_id is None else str(last_message_id),
+                                  datetime.now(timezone.utc).isoformat()))
+        return
+
+    def record_many(self, transcript_states):
+        """
+        Record a list of dicts with record's keyword arguments, as read_transcripts
+        collects them in pending_state.
+        """
+        for transcript_state in transcript_states:
+            self.record(**transcript_state)
+        return
+
+    def commit(self):
+        self._connection.commit()
+        return
+
+    def close(self):
+        self._connection.commit()
+        self._connection.close()
+        return
+
+
+def record_transcript_states(transcript_states, db_path=None):
+    """
+    Record and commit the pending state read_transcripts collected, once the messages of
+    those transcripts have been stored. Until then a crash leaves them unrecorded, so
+    the next run fetches and parses them again instead of skipping them as unchanged.
+
+    Parameters
+    ----------
+    transcript_states : list of dict
+        The pending_state list passed to read_transcripts.
+    db_path : str, optional
+        Path of the SQLite file. The default is TRANSCRIPT_STATE_DB_PATH.
+
+    Returns
+    -------
+    None
+
+    """
+    if not transcript_states:
+        return
+    with TranscriptStateStore(db_path) as transcript_state_store:
+        transcript_state_store.record_many(transcript_states)
+    return
@@ -0,0 +1,230 @@
+import os
+import uuid
+import logging
+import pandas as pd
+import pyarrow as pa
+import pyarrow.dataset as ds
+from pyarrow import fs
+from dotenv import load_dotenv
+from message_buffer import (MESSAGE_CATEGORY_COLUMNS, MESSAGE_DATETIME_COLUMNS, PROSPECT_CATEGORY_COLUMNS,
+                            PROSPECT_DATETIME_COLUMNS, compact_frame)
+from metrics import timed
+
+
+load_dotenv('.env')
+TRANSCRIPT_STORAGE_DIR = os.getenv('TRANSCRIPT_STORAGE_DIR', os.path.abspath('transcript_storage'))
+# Prospects whose export row has no property are filed under this partition.
+UNKNOWN_PROPERTY = 'unknown'
+
+_PARTITIONING = ds.partitioning(pa.schema([('date', pa.string()), ('property', pa.string())]), flavor='hive')
+_PARTITION_COLUMNS = ('date', 'property')
+# Time each row was appended. File order within a dataset is arbitrary, so readers
+# sort on it to find the most recent write of a row.
+INGESTED_AT_COLUMN = 'ingestedAt'
+
+
+def _dataset_path(dataset_name, storage_dir):
+    return os.path.join(storage_dir if storage_dir is not None else TRANSCRIPT_STORAGE_DIR, dataset_name)
+
+
+def _partition_dates(df, time_column):
+    # Rows without a parseable time are filed under the day they were stored.
+    write_date = pd.Timestamp.now(tz='UTC').strftime('%Y-%m-%d')
+    if time_column not in df.columns:
+        return pd.Series(write_date, index=df.index)
+    return pd.to_datetime(df[time_column], utc=True, errors='coerce').dt.strftime('%Y-%m-%d').fillna(write_date)
+
+
+def _to_storage_table(df):
+    """
+    Arrow table with one type per column whatever the batch held, so files written on
+    different days share a schema: categoricals are stored as their string values
+    (Parquet dictionary-encodes them anyway), integers as int64, floats as float64 and
+    all-null columns as strings.
+    """
+    storage_columns = {}
+    for column in df.columns:
+        series = df[column]
+        if isinstance(series.dtype, pd.CategoricalDtype):
+            storage_columns[column] = series.astype(object).where(series.notna(), None)
+        elif pd.api.types.is_integer_dtype(series.dtype) and not pd.api.types.is_bool_dtype(series.dtype):
+            storage_columns[column] = series.astype('int64')
+        elif pd.api.types.is_float_dtype(series.dtype):
+            storage_columns[column] = series.astype('float64')
+    table = pa.Table.from_pandas(df.assign(**storage_columns) if storage_columns else df, preserve_index=False)
+    for field_index, field in enumerate(table.schema):
+        if pa.types.is_null(field.type):
+            table = table.set_column(field_index, field.name, table.column(field_index).cast(pa.string()))
+    return table
+
+
+def _append_dataset(frame_df, dataset_name, storage_dir):
+    table = _to_storage_table(frame_df.assign(**{INGESTED_AT_COLUMN: pd.Timestamp.now(tz='UTC')}))
+    # A fresh basename per write keeps every append a new file: nothing already on disk
+    # is rewritten, so readers never see a half-written partition.
+    ds.write_dataset(table,
+                     _dataset_path(dataset_name, storage_dir),
+                     format='parquet',
+                     partitioning=_PARTITIONING,
+                     basename_template=f'part-{uuid.uuid4().hex}-{{i}}.parquet',
+                     existing_data_behavior='overwrite_or_ignore')
+    return table.num_rows
+
+
+def append_transcripts(messages_df, prospects_df, logger_name, storage_dir=None):
+    """
+    Append messages and their prospects to the transcript storage datasets.
+
+    Both are Parquet datasets partitioned as date=YYYY-MM-DD/property=<property>/, by
+    each message's timeCreated and each prospect's timeLastMessage (in UTC), so a query
+    for one property and week opens only that property's files for those days. Every
+    row is stamped with the time of the append in INGESTED_AT_COLUMN.
+
+    Parameters
+    ----------
+    messages_df : Pandas DataFrame
+        Messages joined to prospects_df on 'transcript', as read_transcripts returns them
+        with normalized=True.
+    prospects_df : Pandas DataFrame
+        One row per transcript, with its 'property'.
+    logger_name : str
+        Name of the parent logger.
+    storage_dir : str, optional
+        Root of the datasets. The default is the TRANSCRIPT_STORAGE_DIR environment
+        variable, or ./transcript_storage.
+
+    Returns
+    -------
+    row_counts : dict
+        Rows appended to the 'messages' and 'prospects' datasets.
+
+    """
+    logger = logging.getLogger(f'{logger_name}.append_transcripts')
+    row_counts = {'messages': 0, 'prospects': 0}
+    if prospects_df.empty:
+        return row_counts
+    with timed('storage_write', items=len(messages_df) + len(prospects_df)):
+        property_by_transcript = prospects_df.drop_duplicates('transcript', keep='last').set_index('transcript')['property'].astype(object)
+        prospects_df = prospects_df.assign(date=_partition_dates(prospects_df, 'timeLastMessage'),
+                                           property=prospects_df['property'].astype(object).fillna(UNKNOWN_PROPERTY))
+        row_counts['prospects'] = _append_dataset(prospects_df, 'prospects', storage_dir)
+        if not messages_df.empty:
+            messages_df = messages_df.assign(date=_partition_dates(messages_df, 'timeCreated'),
+                                             property=messages_df['transcript'].map(property_by_transcript).fillna(UNKNOWN_PROPERTY))
+            row_counts['messages'] = _append_dataset(messages_df, 'messages', storage_dir)
+    logger.info(f'Appended {row_counts["messages"]} messages and {row_counts["prospects"]} prospects to {_dataset_path("", storage_dir)}.')
+    return row_counts
+
+
+def _partition_filter(start_date, end_date, properties, filters):
+    conditions = []
+    if start_date is not None:
+        conditions.append(ds.field('date') >= str(start_date))
+    if end_date is not None:
+        conditions.append(ds.field('date') <= str(end_date))
+    if properties is not None:
+        conditions.append(ds.field('property').isin(list(properties)))
+    if filters is not None:
+        conditions.append(filters)
+    filter_expression = None
+    for condition in conditions:
+        filter_expression = condition if filter_expression is None else filter_expression & condition
+    return filter_expression
+
+
+def read_dataset(dataset_name, start_date=None, end_date=None, properties=None, columns=None, filters=None, storage_dir=None):
+    """
+    Read rows of the 'messages' or 'prospects' dataset as an Arrow table.
+
+    Partitions outside [start_date, end_date] and properties are pruned from the file
+    listing before anything is opened, and only columns are decoded from the files that
+    remain. Files are memory-mapped rather than read into buffers.
+
+    Parameters
+    ----------
+    dataset_name : str
+        'messages' or 'prospects'.
+    start_date, end_date : str or datetime.date, optional
+        Inclusive range of partition dates. The defaults are unbounded.
+    properties : list of str, optional
+        Partition properties to read. The default is all of them.
+    columns : list of str, optional
+        Columns to return. Columns that none of the selected files hold are left out. The
+        default is every column.
+    filters : pyarrow.dataset.Expression, optional
+        Extra row filter, e.g. ds.field('isInbound') == True.
+    storage_dir : str, optional
+        Root of the datasets. The default is TRANSCRIPT_STORAGE_DIR.
+
+    Returns
+    -------
+    table : pyarrow.Table
+        The matching rows, with the date and property partition columns.
+
+    """
+    dataset_path = _dataset_path(dataset_name, storage_dir)
+    if not os.path.isdir(dataset_path):
+        return pa.table({column: pa.array([], pa.string()) for column in (columns or _PARTITION_COLUMNS)})
+    local_filesystem = fs.LocalFileSystem(use_mmap=True)
+    filter_expression = _partition_filter(start_date, end_date, properties, filters)
+    dataset = ds.dataset(dataset_path, format='parquet', partitioning=_PARTITIONING, filesystem=local_filesystem)
+    fragments = list(dataset.get_fragments(filter=filter_expression))
+    if not fragments:
+        return dataset.schema.empty_table().select(columns) if columns else dataset.schema.empty_table()
+    # Files appended on different days may hold different columns, e.g. sentiment
+    # scores added later; the union of the selected files' schemas covers them all and
+    # fills the gaps with nulls.
+    schema = pa.unify_schemas([fragment.physical_schema for fragment in fragments] + [_PARTITIONING.schema])
+    if columns is not None:
+        columns = [column for column in columns if column in schema.names]
+    dataset = ds.dataset([fragment.path for fragment in fragments], schema=schema, format='parquet', partitioning=_PARTITIONING,
+                         partition_base_dir=dataset_path, filesystem=local_filesystem)
+    return dataset.to_table(columns=columns, filter=filter_expression)
+
+
+def _latest_rows(df, key_column, order_columns):
+    # Rows written before INGESTED_AT_COLUMN existed have no ingest time and sort first,
+    # so any later write of the same key wins over them.
+    order_columns = [column for column in order_columns if column in df.columns]
+    if order_columns:
+        df = df.sort_values(order_columns, kind='stable', na_position='first')
+    return df.drop_duplicates(key_column, keep='last').sort_index().reset_index(drop=True)
+
+
+def _drop_unrequested_ingested_at(df, requested_columns):
+    if requested_columns is None or INGESTED_AT_COLUMN in requested_columns or INGESTED_AT_COLUMN not in df.columns:
+        return df
+    return df.drop(columns=INGESTED_AT_COLUMN)
+
+
+def read_messages(start_date=None, end_date=None, properties=None, columns=None, filters=None, deduplicate=True, storage_dir=None):
+    """
+    Read stored messages as a compact DataFrame. A changed transcript is stored again in
+    full, so deduplicate keeps the most recently appended row per message id. See
+    read_dataset for the other parameters.
+    """
+    requested_columns = columns
+    if deduplicate and columns is not None:
+        columns = list(dict.fromkeys(list(columns) + ['id', INGESTED_AT_COLUMN]))
+    messages_df = read_dataset('messages', start_date, end_date, properties, columns, filters, storage_dir).to_pandas()
+    if deduplicate and 'id' in messages_df.columns:
+        messages_df = _latest_rows(messages_df, 'id', [INGESTED_AT_COLUMN])
+    messages_df = _drop_unrequested_ingested_at(messages_df, requested_columns)
+    return compact_frame(messages_df, MESSAGE_CATEGORY_COLUMNS, MESSAGE_DATETIME_COLUMNS)
+
+
+def read_prospects(start_date=None, end_date=None, properties=None, columns=None, filters=None, deduplicate=True, storage_dir=None):
+    """
+    Read stored prospects as a compact DataFrame. A prospect is stored again every day
+    its transcript changes, so deduplicate keeps the row with the latest timeLastMessage
+    per transcript, the most recently appended one among rows that tie. See read_dataset
+    for the other parameters.
+    """
+    requested_columns = columns
+    if deduplicate and columns is not None:
+        columns = list(dict.fromkeys(list(columns) + ['transcript', 'timeLastMessage', INGESTED_AT_COLUMN]))
+    prospects_df = read_dataset('prospects', start_date, end_date, properties, columns, filters, storage_dir).to_pandas()
+    if deduplicate and 'transcript' in prospects_df.columns:
+        prospects_df = _latest_rows(prospects_df, 'transcript', ['timeLastMessage', INGESTED_AT_COLUMN])
+    prospects_df = _drop_unrequested_ingested_at(prospects_df, requested_columns)
+    return compact_frame(prospects_df, PROSPECT_CATEGORY_COLUMNS, PROSPECT_DATETIME_COLUMNS)
@@ -0,0 +1,172 @@
+import os
+import logging
+import importlib.metadata
+from dotenv import load_dotenv
+
+
+load_dotenv('.env')
+# A sequence classification checkpoint name or local directory, e.g.
+# distilbert-base-uncased-finetuned-sst-2-english. Empty disables the transformer scores.
+SENTIMENT_TRANSFORMER_MODEL = os.getenv('SENTIMENT_TRANSFORMER_MODEL', '')
+SENTIMENT_TRANSFORMER_BATCH_SIZE = int(os.getenv('SENTIMENT_TRANSFORMER_BATCH_SIZE', 64))
+SENTIMENT_TRANSFORMER_MAX_BATCH_TOKENS = int(os.getenv('SENTIMENT_TRANSFORMER_MAX_BATCH_TOKENS', 4096))
+SENTIMENT_TRANSFORMER_MAX_LENGTH = int(os.getenv('SENTIMENT_TRANSFORMER_MAX_LENGTH', 128))
+SENTIMENT_TRANSFORMER_QUANTIZE = os.getenv('SENTIMENT_TRANSFORMER_QUANTIZE', 'true').lower() in ('1', 'true', 'yes')
+# Intra-op threads per process. 0 keeps torch's default of one per core; with
+# sentiment_main(parallel=True) set it to cores / SENTIMENT_WORKERS to avoid oversubscription.
+SENTIMENT_TRANSFORMER_THREADS = int(os.getenv('SENTIMENT_TRANSFORMER_THREADS', 0))
+
+
+def transformer_sentiment_enabled():
+    return bool(SENTIMENT_TRANSFORMER_MODEL)
+
+
+def transformer_model_version(model_name=None, quantize=None):
+    """
+    Identify the model and runtime the scores come from, for the sentiment score cache.
+    Quantized and full precision scores differ slightly, so they are cached apart.
+    """
+    if model_name is None:
+        model_name = SENTIMENT_TRANSFORMER_MODEL
+    if quantize is None:
+        quantize = SENTIMENT_TRANSFORMER_QUANTIZE
+    package_versions = []
+    for package_name in ('transformers', 'torch'):
+        try:
+            package_versions.append(f'{package_name}-{importlib.metadata.version(package_name)}')
+        except importlib.metadata.PackageNotFoundError:
+            package_versions.append(f'{package_name}-unknown')
+    return f'transformer:{model_name}:{"int8" if quantize else "fp32"}:{":".join(package_versions)}'
+
+
+def length_bucketed_batches(token_lengths, batch_size, max_batch_tokens):
+    """
+    Group positions into batches of similar token length.
+
+    Positions are sorted by length and a batch is closed once it holds batch_size texts
+    or once padding every text in it to its longest one would exceed max_batch_tokens.
+    Short messages therefore share large batches and long ones run in small batches,
+    with almost no padding either way.
+
+    Parameters
+    ----------
+    token_lengths : list of int
+        Token count of each text.
+    batch_size : int
+        Most texts per batch.
+    max_batch_tokens : int
+        Most padded tokens per batch. A single text longer than this still gets a batch.
+
+    Returns
+    -------
+    batches : list of list of int
+        Positions into token_lengths, every position exactly once.
+
+    """
+    batches = []
+    batch_positions = []
+    for position in sorted(range(len(token_lengths)), key=token_lengths.__getitem__):
+        # Sorted ascending, so this text is the longest in the batch it joins.
+        padded_tokens = token_lengths[position] * (len(batch_positions) + 1)
+        if batch_positions and (len(batch_positions) >= batch_size or padded_tokens > max_batch_tokens):
+            batches.append(batch_positions)
+            batch_positions = []
+        batch_positions.append(position)
+    if batch_positions:
+        batches.append(batch_positions)
+    return batches
+
+
+class TransformerSentimentScorer:
+    """
+    CPU sentiment classifier around a Hugging Face sequence classification model.
+
+    torch and transformers are imported here rather than at module level, so the rest
+    of the pipeline does not pay for them unless the transformer scores are enabled.
+
+    Parameters
+    ----------
+    model_name : str, optional
+        Checkpoint name or local directory. The default is SENTIMENT_TRANSFORMER_MODEL.
+    quantize : bool, optional
+        Convert the Linear layers to dynamic int8 with torch.quantization.quantize_dynamic,
+        which runs them roughly twice as fast on CPU for a small change in the scores. The
+        default is SENTIMENT_TRANSFORMER_QUANTIZE.
+    num_threads : int, optional
+        torch intra-op thread count for this process, 0 for torch's default. The default
+        is SENTIMENT_TRANSFORMER_THREADS.
+    max_length : int, optional
+        Tokens kept per message. The default is SENTIMENT_TRANSFORMER_MAX_LENGTH.
+    logger_name : str, optional
+        Name of the parent logger.
+
+    """
+
+    def __init__(self, model_name=None, quantize=None, num_threads=None, max_length=None, logger_name='sentiment'):
+        import torch
+        from transformers import AutoModelForSequenceClassification, AutoTokenizer
+        logger = logging.getLogger(f'{logger_name}.TransformerSentimentScorer')
+        self.model_name = model_name or SENTIMENT_TRANSFORMER_MODEL
+        if not self.model_name:
+            raise ValueError('No transformer sentiment model configured. Set SENTIMENT_TRANSFORMER_MODEL.')
+        self.quantize = SENTIMENT_TRANSFORMER_QUANTIZE if quantize is None else quantize
+        self.max_length = max_length or SENTIMENT_TRANSFORMER_MAX_LENGTH
+        num_threads = SENTIMENT_TRANSFORMER_THREADS if num_threads is None else num_threads
+        if num_threads:
+            torch.set_num_threads(num_threads)
+        self._torch = torch
+        self.tokenizer = AutoTokenizer.from_pretrained(self.model_name)
+        model = AutoModelForSequenceClassification.from_pretrained(self.model_name)
+        model.eval()
+        if self.quantize:
+            model = torch.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+        self.model = model
+        self.labels = {int(label_index): str(label).upper() for label_index, label in model.config.id2label.items()}
+        # sst-2 style checkpoints name their labels POSITIVE/NEGATIVE; fall back to the
+        # usual order of negative first and positive last for LABEL_0/LABEL_1 checkpoints.
+        self.positive_index = next((label_index for label_index, label in self.labels.items() if label.startswith('POS')), max(self.labels))
+        self.negative_index = next((label_index for label_index, label in self.labels.items() if label.startswith('NEG')), min(self.labels))
+        logger.info(f'Loaded {self.model_name} ({"int8" if self.quantize else "fp32"}) with {torch.get_num_threads()} threads.')
+
+    def score(self, texts, batch_size=None, max_batch_tokens=None):
+        """
+        Classify every text, each distinct text once.
+
+        Parameters
+        ----------
+        texts : list of str
+            Messages to score.
+        batch_size : int, optional
+            Most messages per forward pass. The default is SENTIMENT_TRANSFORMER_BATCH_SIZE.
+        max_batch_tokens : int, optional
+            Most padded tokens per forward pass. The default is
+            SENTIMENT_TRANSFORMER_MAX_BATCH_TOKENS.
+
+        Returns
+        -------
+        metric_rows : list of tuple
+            (label, polarity, positive probability) per text. Polarity is the positive
+            minus the negative probability, from -1 to 1.
+
+        """
+        if batch_size is None:
+            batch_size = SENTIMENT_TRANSFORMER_BATCH_SIZE
+        if max_batch_tokens is None:
+            max_batch_tokens = SENTIMENT_TRANSFORMER_MAX_BATCH_TOKENS
+        unique_texts = list(dict.fromkeys(texts))
+        if not unique_texts:
+            return []
+        input_ids = self.tokenizer(unique_texts, truncation=True, max_length=self.max_length)['input_ids']
+        unique_rows = [None] * len(unique_texts)
+        torch = self._torch
+        with torch.inference_mode():
+            for batch_positions in length_bucketed_batches([len(ids) for ids in input_ids], batch_size, max_batch_tokens):
+                batch_inputs = self.tokenizer.pad({'input_ids': [input_ids[position] for position in batch_positions]}, return_tensors='pt')
+                probabilities = torch.softmax(self.model(**batch_inputs).logits, dim=-1).tolist()
+                for position, label_probabilities in zip(batch_positions, probabilities):
+                    label_index = max(range(len(label_probabilities)), key=label_probabilities.__getitem__)
+                    unique_rows[position] = (self.labels[label_index],
+                                             round(label_probabilities[self.positive_index] - label_probabilities[self.negative_index], 4),
+                                             round(label_probabilities[self.positive_index], 4))
+        rows_by_text = dict(zip(unique_texts, unique_rows))
+        return [rows_by_text[text] for text in texts]
@@ -0,0 +1,268 @@
+import os
+import io
+import heapq
+import sqlite3
+import logging
+import threading
+import time
+import pandas as pd
+from dotenv import load_dotenv
+from api_calling import read_transcripts, check_for_targets_and_time_elapsed
+from message_buffer import attach_prospect_columns
+
+
+load_dotenv('.env')
+HOUR_WAITLIST_SECONDS = 3600
+HOUR_WAITLIST_DB_PATH = os.getenv('HOUR_WAITLIST_DB_PATH', os.path.abspath('hour_waitlist.sqlite3'))
+HOUR_WAITLIST_MAX_SLEEP_SECONDS = float(os.getenv('HOUR_WAITLIST_MAX_SLEEP_SECONDS', 30))
+# A due transcript whose re-fetch fails is retried after RETRY_BASE * 2**attempts
+# seconds, capped at RETRY_MAX, and given up on (with a warning) after MAX_ATTEMPTS.
+HOUR_WAITLIST_RETRY_BASE_SECONDS = float(os.getenv('HOUR_WAITLIST_RETRY_BASE_SECONDS', 60))
+HOUR_WAITLIST_RETRY_MAX_SECONDS = float(os.getenv('HOUR_WAITLIST_RETRY_MAX_SECONDS', 3600))
+HOUR_WAITLIST_MAX_ATTEMPTS = int(os.getenv('HOUR_WAITLIST_MAX_ATTEMPTS', 12))
+
+
+class HourWaitlistScheduler:
+    """
+    Persistent deadline queue for target prospects whose last outreach is under an hour
+    old. Each waitlisted transcript is stored with the time its hour expires; when that
+    time comes only that transcript is re-fetched and re-classified, and it is promoted
+    to the outreach set if it still qualifies.
+
+    Deadlines live in SQLite so a restart loses nothing, and in a heap in memory so
+    finding the next due transcript is O(log n). A transcript's row is only deleted once
+    it has been re-classified; if its re-fetch fails it is retried with a backoff.
+
+    Parameters
+    ----------
+    logger_name : str
+        Name of the parent logger.
+    on_promote : callable, optional
+        Called with the outreach_flag_df of every batch of promoted transcripts.
+        Required by start and run_forever; run_due alone may go without it.
+    db_path : str, optional
+        SQLite file. The default is the HOUR_WAITLIST_DB_PATH environment variable, or
+        hour_waitlist.sqlite3 in the working directory.
+
+    """
+
+    def __init__(self, logger_name, on_promote=None, db_path=None):
+        self.logger_name = logger_name
+        self.logger = logging.getLogger(f'{logger_name}.HourWaitlistScheduler')
+        self.on_promote = on_promote
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._stop = threading.Event()
+        self._thread = None
+        self._connection = sqlite3.connect(db_path or HOUR_WAITLIST_DB_PATH, timeout=30, check_same_thread=False)
+        self._connection.execute('''CREATE TABLE IF NOT EXISTS hour_waitlist (
+                                        transcript TEXT PRIMARY KEY,
+                                        due_at REAL NOT NULL,
+                                        prospect_json TEXT NOT NULL,
+                                        attempts INTEGER NOT NULL DEFAULT 0)''')
+        waitlist_columns = [row[1] for row in self._connection.execute('PRAGMA table_info(hour_waitlist)')]
+        if 'attempts' not in waitlist_columns:
+            self._connection.execute('ALTER TABLE hour_waitlist ADD COLUMN attempts INTEGER NOT NULL DEFAULT 0')
+        self._connection.execute('CREATE INDEX IF NOT EXISTS ix_hour_waitlist_due_at ON hour_waitlist (due_at)')
+        self._connection.commit()
+        self._due_at_by_transcript = dict(self._connection.execute('SELECT transcript, due_at FROM hour_waitlist').fetchall())
+        self._deadlines = [(due_at, transcript) for transcript, due_at in self._due_at_by_transcript.items()]
+        heapq.heapify(self._deadlines)
+
+    def __len__(self):
+        with self._lock:
+            return len(self._due_at_by_transcript)
+
+    def schedule(self, hour_waitlist_df, prospects_df, now=None):
+        """
+        Add or move the deadline of every transcript in hour_waitlist_df.
+
+        Parameters
+        ----------
+        hour_waitlist_df : Pandas DataFrame
+            Second frame returned by check_for_targets_and_time_elapsed, with seconds_elapsed.
+        prospects_df : Pandas DataFrame
+            Prospect rows from the export. The rows of waitlisted transcripts are stored so
+            they can be re-fetched later without the export.
+        now : float, optional
+            Current unix time. The default is time.time().
+
+        """
+        if hour_waitlist_df.empty:
+            return
+        if now is None:
+            now = time.time()
+        seconds_elapsed_by_transcript = hour_waitlist_df.groupby('transcript', sort=False)['seconds_elapsed'].last()
+        waitlisted_prospects_df = prospects_df[prospects_df['transcript'].isin(seconds_elapsed_by_transcript.index)].drop_duplicates(subset='transcript', keep='last')
+        waitlist_rows = [(transcript,
+                          now + HOUR_WAITLIST_SECONDS - seconds_elapsed_by_transcript[transcript],
+                          waitlisted_prospects_df.iloc[[position]].to_json(orient='records', date_format='iso'))
+                         for position, transcript in enumerate(waitlisted_prospects_df['transcript'])]
+        with self._lock:
+            self._connection.executemany('INSERT OR REPLACE INTO hour_waitlist (transcript, due_at, prospect_json) VALUES (?, ?, ?)', waitlist_rows)
+            self._connection.commit()
+            for transcript, due_at, prospect_json in waitlist_rows:
+                self._due_at_by_transcript[transcript] = due_at
+                heapq.heappush(self._deadlines, (due_at, transcript))
+        self.logger.info(f'{len(waitlist_rows)} transcripts added to the hour waitlist.')
+        self._wakeup.set()
+        return
+
+    def next_due_at(self):
+        with self._lock:
+            self._discard_stale_deadlines()
+            return self._deadlines[0][0] if self._deadlines else None
+
+    def _discard_stale_deadlines(self):
+        # Rescheduling pushes a new heap entry instead of moving the old one, so skip any
+        # entry whose deadline no longer matches the transcript's current deadline.
+        while self._deadlines and self._due_at_by_transcript.get(self._deadlines[0][1]) != self._deadlines[0][0]:
+            heapq.heappop(self._deadlines)
+        return
+
+    def _claim_due(self, now):
+        # Due transcripts leave the heap but keep their rows until _finish or
+        # _retry_later, so a crash mid-check re-runs them after a restart.
+        with self._lock:
+            due_transcripts = []
+            self._discard_stale_deadlines()
+            while self._deadlines and self._deadlines[0][0] <= now:
+                due_at, transcript = heapq.heappop(self._deadlines)
+                del self._due_at_by_transcript[transcript]
+                due_transcripts.append(transcript)
+                self._discard_stale_deadlines()
+            if not due_transcripts:
+                return pd.DataFrame()
+            placeholders = ','.join('?' * len(due_transcripts))
+            prospect_json_rows = self._connection.execute(f'SELECT prospect_json FROM hour_waitlist WHERE transcript IN ({placeholders})',
+                                                          due_transcripts).fetchall()
+        return pd.concat([pd.read_json(io.StringIO(prospect_json), orient='records') for (prospect_json,) in prospect_json_rows],
+                         axis=0, ignore_index=True)
+
+    def _finish(self, transcripts):
+        transcripts = list(transcripts)
+        if not transcripts:
+            return
+        with self._lock:
+            # Skip transcripts schedule() has just put back on the waitlist.
+            finished_transcripts = [transcript for transcript in transcripts if transcript not in self._due_at_by_transcript]
+            self._connection.executemany('DELETE FROM hour_waitlist WHERE transcript = ?', [(transcript,) for transcript in finished_transcripts])
+            self._connection.commit()
+        return
+
+    def _retry_later(self, transcripts, now):
+        transcripts = list(transcripts)
+        if not transcripts:
+            return
+        with self._lock:
+            given_up_transcripts = []
+            for transcript in transcripts:
+                attempts_row = self._connection.execute('SELECT attempts FROM hour_waitlist WHERE transcript = ?', (transcript,)).fetchone()
+                if attempts_row is None or transcript in self._due_at_by_transcript:
+                    continue
+                attempts = attempts_row[0] + 1
+                if attempts >= HOUR_WAITLIST_MAX_ATTEMPTS:
+                    self._connection.execute('DELETE FROM hour_waitlist WHERE transcript = ?', (transcript,))
+                    given_up_transcripts.append(transcript)
+                    continue
+                due_at = now + min(HOUR_WAITLIST_RETRY_BASE_SECONDS * 2 ** (attempts - 1), HOUR_WAITLIST_RETRY_MAX_SECONDS)
+                self._connection.execute('UPDATE hour_waitlist SET due_at = ?, attempts = ? WHERE transcript = ?', (due_at, attempts, transcript))
+                self._due_at_by_transcript[transcript] = due_at
+                heapq.heappush(self._deadlines, (due_at, transcript))
+            self._connection.commit()
+        if given_up_transcripts:
+            self.logger.warning(f'Dropped {len(given_up_transcripts)} transcripts from the hour waitlist after {HOUR_WAITLIST_MAX_ATTEMPTS} failed re-checks: '
+                                f'{given_up_transcripts}')
+        self.logger.info(f'{len(transcripts)} waitlisted transcripts could not be re-checked and will be retried.')
+        return
+
+    def run_due(self, now=None):
+        """
+        Re-fetch and re-classify every transcript whose hour has expired. Transcripts that
+        still qualify are promoted through on_promote, those with newer outreach go back on
+        the waitlist, and those where the prospect has replied are dropped. Transcripts
+        that could not be fetched, e.g. because of an open circuit or a 5xx left after
+        retries, stay on the waitlist and are retried with a backoff.
+
+        Returns
+        -------
+        outreach_flag_df : Pandas DataFrame
+            Messages of the promoted transcripts, with their prospect columns.
+
+        """
+        if now is None:
+            now = time.time()
+        due_prospects_df = self._claim_due(now)
+        if due_prospects_df.empty:
+            return pd.DataFrame()
+        due_transcripts = set(due_prospects_df['transcript'])
+        self.logger.info(f'Re-checking {len(due_transcripts)} waitlisted transcripts.')
+        try:
+            # Nothing fetched here is stored, so no pending_state is collected and the
+            # change-detection state is left alone: the next refresh still sees these
+            # transcripts as changed and stores their messages.
+            due_messages_df, due_transcript_prospects_df = read_transcripts(due_prospects_df, self.logger_name, skip_unchanged=False, normalized=True)
+            rechecked_transcripts = set(due_messages_df['transcript'].unique()) if not due_messages_df.empty else set()
+            outreach_flag_df, hour_waitlist_df = check_for_targets_and_time_elapsed(due_messages_df, self.logger_name)
+            self.schedule(hour_waitlist_df, due_prospects_df)
+            if not outreach_flag_df.empty:
+                outreach_flag_df = attach_prospect_columns(outreach_flag_df, due_transcript_prospects_df)
+                self.logger.info(f'{outreach_flag_df["transcript"].nunique()} waitlisted transcripts promoted to outreach.')
+                if self.on_promote is not None:
+                    self.on_promote(outreach_flag_df)
+        except Exception:
+            self._retry_later(due_transcripts, now)
+            raise
+        self._finish(rechecked_transcripts)
+        self._retry_later(due_transcripts - rechecked_transcripts, now)
+        return outreach_flag_df
+
+    def run_forever(self):
+        if self.on_promote is None:
+            # Without a callback every promoted transcript would be logged and dropped.
+            raise ValueError('HourWaitlistScheduler needs an on_promote callback to run continuously.')
+        while not self._stop.is_set():
+            try:
+                self.run_due()
+            except Exception:
+                self.logger.exception('Hour waitlist check failed.')
+            next_due_at = self.next_due_at()
+            sleep_seconds = HOUR_WAITLIST_MAX_SLEEP_SECONDS if next_due_at is None else min(max(next_due_at - time.time(), 0), HOUR_WAITLIST_MAX_SLEEP_SECONDS)
+            self._wakeup.wait(sleep_seconds)
+            self._wakeup.clear()
+        return
+
+    def start(self):
+        if self.on_promote is None:
+            raise ValueError('HourWaitlistScheduler needs an on_promote callback to run continuously.')
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self.run_forever, name='hour-waitlist', daemon=True)
+                self._thread.start()
+        return
+
+    def stop(self):
+        self._stop.set()
+        self._wakeup.set()
+        if self._thread is not None:
+            self._thread.join()
+        return
+
+
+def promote_to_outreach_dashboard(outreach_flag_df, logger_name):
+    """
+    Score promoted transcripts and publish them the way the daily job publishes its
+    outreach set. Used by the standalone scheduler, which cannot reach the Flask app's
+    in-process follow-up lists.
+    """
+    from sentiment import sentiment_main
+    from api_calling import update_outreach_dashboard
+    update_outreach_dashboard(sentiment_main(outreach_flag_df), logger_name)
+    return
+
+
+if __name__ == "__main__":
+    logger_name = 'chatbot_prospect_hour_waitlist'
+    scheduler = HourWaitlistScheduler(logger_name=logger_name,
+                                      on_promote=lambda promoted_df: promote_to_outreach_dashboard(promoted_df, logger_name))
+    scheduler.run_forever()